@@ -27,13 +27,19 @@ The order of operations is:
 1. Obtain credentials
 
    We have pre-created a number of credentials and stored them in Amazon KMS.
-   This script makes use of dynamodb to obtain an exclusive lock on a set of
-   credentials.
+   This script makes use of dynamodb to obtain an exclusive lease on a set of
+   credentials: the free indexes are read in one batch, and one of them is
+   claimed with a single conditional write. The lease is renewed while we run,
+   expires if we die, and is released when we exit.
 
    We need the "locking" as if you use credentials that are already
    in use the new runner process will wait (but never error) until they are not
    in use.
 
+   If the instance is being launched in to the ASG's warm pool we only list the
+   possible credentials (and save that list to disk), and take a lease once the
+   instance is moved out of the warm pool and in to service.
+
 2. Complete the ASG lifecycle action so the instance is marked as InService
 
    This might not be strictly necessary, we don't want the instance to be "in
@@ -47,6 +53,8 @@ The order of operations is:
 
    Since we are running in an autoscaling group we can't dictate which instance
    AWS choses to terminate, so we instead have to set scale-in protection when a job is running.
+   Whether we are busy is also published to a DynamoDB "fleet state" item, so the scale-out Lambda
+   doesn't have to describe the whole ASG to find out how many instances are idle.
 
    The way we watch for jobs being executed is using the Netlink Process
    Connector, which is a datagram socket that a (root) process can open to the
@@ -56,7 +64,11 @@ The order of operations is:
    care about we use a BPF filter to drop everything else.
 
    Since it is a datagram socket it is possible we might miss a notification, so
-   we also periodically check if the process is still alive
+   each Runner.Worker we find is also opened as a pidfd, which becomes readable
+   (in the same select loop) the moment it exits. On kernels without pidfds
+   (before 5.3) we fall back to periodically checking if the process is still
+   alive. If a burst of events overruns the socket we rescan the processes
+   straight away.
 
 5. Watch for ASG instance state changing to Terminating:Wait
 
@@ -73,9 +85,9 @@ The order of operations is:
 
 """
 import ctypes
-import datetime
 import enum
 import errno
+import functools
 import json
 import logging
 import os
@@ -84,23 +96,51 @@ import selectors
 import shutil
 import signal
 import socket
+import struct
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import check_call
-from typing import Callable, List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import boto3
 import click
 import psutil
-from python_dynamodb_lock.python_dynamodb_lock import DynamoDBLockClient, DynamoDBLockError
 from tenacity import before_sleep_log, retry, stop_after_delay, wait_exponential
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-logging.getLogger('python_dynamodb_lock').setLevel(logging.WARNING)
-
 
 TABLE_NAME = os.getenv('COUNTER_TABLE', 'GithubRunnerQueue')
+# Work done before the instance went in to the ASG's warm pool, so it isn't repeated once it comes out
+WARM_STATE_FILE = '/var/lib/runner-supervisor/warm-state.json'
+# The non-secret SSM parameters (the credential index list, the config overlay) and their versions, so a
+# restarted supervisor on the same instance doesn't have to fetch them again before claiming credentials
+SSM_CACHE_FILE = '/var/lib/runner-supervisor/ssm-cache.json'
+QUEUE_SHARDS = int(os.getenv('QUEUE_SHARDS', '1'))
+# Each ASG the Lambda routes jobs to has its own counter, e.g. "queued_jobs:arm"
+QUEUE_COUNTER = os.getenv('QUEUE_COUNTER', 'queued_jobs')
+# When the queue is counted from workflow_job events the Lambda tracks jobs starting itself
+QUEUE_SOURCE = os.getenv('QUEUE_SOURCE', 'check_run')
+# Publish whether we are busy to the "fleet#<asg>" item, which the Lambda reads instead of describing the ASG
+FLEET_STATE = os.getenv('FLEET_STATE', 'false').lower() == 'true'
+# Our own "fleet#<asg>#<instance>" item is removed this long after it was last updated
+FLEET_STATE_TTL = int(os.getenv('FLEET_STATE_TTL', str(24 * 3600)))
+# Credential leases are items in this table, in the same shape as the python-dynamodb-lock items that older
+# supervisors create, so the two never hand out the same credentials. A lease lasts LEASE_SECONDS unless it
+# is renewed, which we do every LEASE_HEARTBEAT seconds
+LOCK_TABLE = os.getenv('LOCK_TABLE', 'GitHubRunnerLocks')
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '300'))
+LEASE_HEARTBEAT = int(os.getenv('LEASE_HEARTBEAT', '10'))
+# Jobs fork a lot, so give the proc connector socket room for a burst of events before the kernel drops them
+PROC_CONNECTOR_RCVBUF = int(os.getenv('PROC_CONNECTOR_RCVBUF', str(4 * 1024 * 1024)))
+# Big enough for a datagram holding several proc connector messages
+PROC_CONNECTOR_BUFFER = 4096
+# Counters for the proc connector (events, overruns, ...), rewritten every time we check the processes
+PROC_STATS_FILE = '/run/runner-supervisor/proc-connector.json'
 
 
 @click.command()
@@ -124,55 +164,233 @@ def main(repo, output_folder, user):
     log.info("Starting on %s...", INSTANCE_ID)
 
     output_folder = os.path.expanduser(output_folder)
+    store = ParameterStore()
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='startup')
 
-    short_time = datetime.timedelta(microseconds=1)
+    # The credential list and config overlay don't depend on our lifecycle state, so fetch them meanwhile
+    prefetch = pool.submit(store.get, [runners_list_name(repo), config_overlay_name(repo)], True)
+    lifecycle_state = get_lifecycle_state()
+    prefetch.result()
 
-    dynamodb = boto3.resource('dynamodb')
-    client = DynamoDBLockClient(
-        dynamodb,
-        table_name='GitHubRunnerLocks',
-        expiry_period=datetime.timedelta(0, 300),
-        heartbeat_period=datetime.timedelta(seconds=10),
-    )
+    if lifecycle_state.startswith('Warmed:'):
+        # We are being launched in to the ASG's warm pool. Do what we can now, before we are stopped or
+        # hibernated, so that we start quicker when we are taken out of it.
+        prepare_warm_start(repo, store)
+        wait_to_leave_warm_pool()
+
+    warm_state = load_warm_state(repo)
 
     # Just keep trying until we get some credentials.
     while True:
-        # Have each runner try to get a credential in a random order.
-        possibles = get_possible_credentials(repo)
-        random.shuffle(possibles)
-
-        log.info("Trying to get a set of credentials in this order: %r", possibles)
+        if warm_state:
+            possibles = warm_state['possibles']
+            warm_state = None
+        else:
+            possibles = get_possible_credentials(repo, store)
+
+        lease = CredentialLease.claim(repo, possibles)
+        if not lease:
+            log.info("All %d credentials are in use, waiting for one to be released", len(possibles))
+            time.sleep(random.uniform(5, 15))
+            continue
 
         notify = get_sd_notify_func()
 
-        for index in possibles:
+        with lease:
+            lifecycle = pool.submit(get_lifecycle_state)
+            # One call for the credentials, which also checks the cached parameters are still current
+            names = runner_parameter_names(repo, lease.index)
+            params = store.get(names + [runners_list_name(repo), config_overlay_name(repo)])
+            write_credentials_to_files(repo, lease.index, output_folder, user, params)
+            merge_in_settings(repo, output_folder, params)
+            notify(f"STATUS=Obtained lease on {lease.index}")
+
+            if lifecycle.result() == "Pending:Wait":
+                complete_asg_lifecycle_hook()
+
+            notify("READY=1")
+            log.info("Watching for Runner.Worker processes")
+            ProcessWatcher().run()
+
+        exit()
+
+
+def prepare_warm_start(repo: str, store: Optional['ParameterStore'] = None):
+    """
+    Do the work that doesn't need a credential lock before this instance goes in to the warm pool
+
+    We must not hold on to a set of credentials while stopped, so the lock is still obtained once we are
+    started, but the (slow, and likely to be throttled in a mass scale-out) credential listing is done
+    now and saved to disk.
+    """
+    state = {'repo': repo, 'possibles': get_possible_credentials(repo, store)}
+
+    os.makedirs(os.path.dirname(WARM_STATE_FILE), exist_ok=True)
+    with open(WARM_STATE_FILE, 'w') as fh:
+        json.dump(state, fh)
+    log.info("Saved warm start state to %s", WARM_STATE_FILE)
+
+    if get_lifecycle_state() == 'Warmed:Pending:Wait':
+        complete_asg_lifecycle_hook()
+
+
+def wait_to_leave_warm_pool():
+    """
+    Wait until the ASG takes us out of the warm pool
+
+    If the pool is hibernated then we carry on from here when we are woken up. If it is stopped then we will
+    be killed, and systemd will start us afresh when the instance is started again.
+    """
+    while True:
+        state = get_lifecycle_state()
+        if not state.startswith('Warmed:'):
+            log.info("Left the warm pool, now %s", state)
+            return
+        time.sleep(5)
+
+
+def load_warm_state(repo: str) -> Optional[dict]:
+    """Load (and remove, so it is only used once) the state saved by prepare_warm_start"""
+    try:
+        with open(WARM_STATE_FILE) as fh:
+            state = json.load(fh)
+        os.unlink(WARM_STATE_FILE)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('repo') != repo:
+        return None
+    log.info("Warm start, using credential indexes from %s", WARM_STATE_FILE)
+    return state
+
+
+class CredentialLease:
+    """
+    An exclusive, expiring claim on one of the repo's credential indexes
+
+    A lease is an item in LOCK_TABLE that only exists (or hasn't expired) while its index is in use, so
+    finding the free indexes is one batch read, and claiming one is a single conditional write -- rather
+    than a lock attempt on each index in turn, which in a mass scale-out costs the fleet O(N^2) calls.
+    Losing the race for an index just means trying another of the free ones we already know about.
+    """
+
+    def __init__(self, dynamodb, repo: str, index: str, version: str):
+        self.dynamodb = dynamodb
+        self.repo = repo
+        self.index = index
+        self.version = version
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @staticmethod
+    def key(repo: str, index: str) -> dict:
+        return {'lock_key': {'S': f'{repo}/{index}'}, 'sort_key': {'S': '-'}}
+
+    @classmethod
+    def free_indexes(cls, dynamodb, repo: str, possibles: List[str]) -> List[str]:
+        now = int(time.time())
+        held = set()
+        for start in range(0, len(possibles), 100):
+            request = {
+                LOCK_TABLE: {
+                    'Keys': [cls.key(repo, index) for index in possibles[start : start + 100]],
+                    'ProjectionExpression': 'lock_key, expiry_time',
+                }
+            }
+            while request:
+                resp = dynamodb.batch_get_item(RequestItems=request)
+                for item in resp['Responses'].get(LOCK_TABLE, []):
+                    if int(item['expiry_time']['N']) >= now:
+                        held.add(item['lock_key']['S'])
+                request = resp.get('UnprocessedKeys')
+        return [index for index in possibles if f'{repo}/{index}' not in held]
+
+    @classmethod
+    def claim(cls, repo: str, possibles: List[str], dynamodb=None) -> Optional['CredentialLease']:
+        """Claim one of the free ``possibles`` (in a random order), or return None if they are all in use"""
+        dynamodb = dynamodb or boto3.client('dynamodb')
+        version = str(uuid.uuid4())
+        lost = 0
+        free = []
+        while True:
+            if not free or lost >= 2:
+                # In a herd everyone is racing for the same indexes, so after losing a couple of them our list
+                # is likely to be out of date
+                free = cls.free_indexes(dynamodb, repo, possibles)
+                random.shuffle(free)
+                lost = 0
+                if not free:
+                    return None
+            index = free.pop()
+            now = int(time.time())
             try:
-                lock = client.acquire_lock(
-                    f'{repo}/{index}',
-                    retry_period=short_time,
-                    retry_timeout=short_time,
-                    raise_context_exception=True,
+                dynamodb.put_item(
+                    TableName=LOCK_TABLE,
+                    Item={
+                        **cls.key(repo, index),
+                        'owner_name': {'S': INSTANCE_ID or socket.gethostname()},
+                        'lease_duration': {'N': str(LEASE_SECONDS)},
+                        'record_version_number': {'S': version},
+                        'expiry_time': {'N': str(now + LEASE_SECONDS)},
+                    },
+                    ConditionExpression='attribute_not_exists(lock_key) OR expiry_time < :now',
+                    ExpressionAttributeValues={':now': {'N': str(now)}},
                 )
-            except DynamoDBLockError as e:
-                log.info("Could not lock %s (%s)", index, e)
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                log.info("Could not claim %s, someone else got there first", index)
+                lost += 1
                 continue
+            log.info("Obtained lease on %s", index)
+            return cls(dynamodb, repo, index, version)
 
-            with lock:
-                log.info("Obtained lock on %s", index)
-                write_credentials_to_files(repo, index, output_folder, user)
-                merge_in_settings(repo, output_folder)
-                notify(f"STATUS=Obtained lock on {index}")
-
-                if get_lifecycle_state() == "Pending:Wait":
-                    complete_asg_lifecycle_hook()
-
-                notify("READY=1")
-                log.info("Watching for Runner.Worker processes")
-                ProcessWatcher().run()
+    def renew(self) -> bool:
+        try:
+            self.dynamodb.update_item(
+                TableName=LOCK_TABLE,
+                Key=self.key(self.repo, self.index),
+                UpdateExpression='SET expiry_time = :expires',
+                ConditionExpression='record_version_number = :version',
+                ExpressionAttributeValues={
+                    ':expires': {'N': str(int(time.time()) + LEASE_SECONDS)},
+                    ':version': {'S': self.version},
+                },
+            )
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            log.error("Lost the lease on %s to another instance", self.index)
+            return False
+        except self.dynamodb.exceptions.ClientError as e:
+            # Try again at the next heartbeat; the lease has plenty of time left
+            log.warning("Failed to renew the lease on %s: %s", self.index, str(e))
+        return True
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        try:
+            self.dynamodb.delete_item(
+                TableName=LOCK_TABLE,
+                Key=self.key(self.repo, self.index),
+                ConditionExpression='record_version_number = :version',
+                ExpressionAttributeValues={':version': {'S': self.version}},
+            )
+            log.info("Released lease on %s", self.index)
+        except self.dynamodb.exceptions.ClientError as e:
+            # It will expire on its own
+            log.warning("Failed to release the lease on %s: %s", self.index, str(e))
+
+    def _keep_alive(self):
+        while not self._stop.wait(LEASE_HEARTBEAT):
+            if not self.renew():
+                return
 
-            client.close()
+    def __enter__(self):
+        self._heartbeat = threading.Thread(target=self._keep_alive, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+        return self
 
-            exit()
+    def __exit__(self, *exc_info):
+        self.release()
 
 
 def get_sd_notify_func() -> Callable[[str], None]:
@@ -192,51 +410,138 @@ def get_sd_notify_func() -> Callable[[str], None]:
     return notify
 
 
-def write_credentials_to_files(
-    repo: str, index: str, out_folder: str = '~runner/actions-runner', user: str = 'runner'
-):
-    param_path = os.path.join('/runners/', repo, index)
+RUNNER_FILES = {
+    'config': '.runner',
+    'credentials': '.credentials',
+    'rsaparams': '.credentials_rsaparams',
+}
 
-    resp = boto3.client("ssm").get_parameters_by_path(Path=param_path, Recursive=False, WithDecryption=True)
 
-    param_to_file = {
-        'config': '.runner',
-        'credentials': '.credentials',
-        'rsaparams': '.credentials_rsaparams',
-    }
+def runner_parameter_names(repo: str, index: str) -> List[str]:
+    return [os.path.join('/runners/', repo, index, name) for name in RUNNER_FILES]
+
+
+def runners_list_name(repo: str) -> str:
+    return os.path.join('/runners/', repo, 'runnersList')
+
+
+def config_overlay_name(repo: str) -> str:
+    return os.path.join('/runners/', repo, 'configOverlay')
+
+
+class ParameterStore:
+    """
+    Fetch SSM parameters in as few ``get_parameters`` calls as possible
+
+    Every parameter a call needs is asked for at once (in batches of 10, the most SSM allows, made
+    concurrently), rather than with a call each. Parameters that aren't SecureStrings are also kept, with
+    their version, in SSM_CACHE_FILE: ``use_cache`` answers from it without calling SSM at all, and any
+    later fetch that includes a cached parameter replaces it if its version has changed.
+    """
 
-    for param in resp['Parameters']:
-        # "/runners/apache/airflow/config" -> "config"
-        name = os.path.basename(param['Name'])
-        filename = param_to_file.get(name, None)
-        if filename is None:
-            log.info("Unknown Parameter from SSM: %r", param['Name'])
+    BATCH_SIZE = 10
+
+    def __init__(self, client=None, cache_file: Optional[str] = None):
+        self.client = client or boto3.client('ssm')
+        self.cache_file = cache_file or SSM_CACHE_FILE
+        try:
+            with open(self.cache_file) as fh:
+                self.cache: Dict[str, dict] = json.load(fh)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def get(self, names: List[str], use_cache: bool = False) -> Dict[str, Optional[str]]:
+        """The value of each of ``names``, or None for those that don't exist"""
+        values: Dict[str, Optional[str]] = {}
+        if use_cache:
+            values = {name: self.cache[name]['value'] for name in names if name in self.cache}
+        wanted = [name for name in names if name not in values]
+        if not wanted:
+            return values
+
+        size = self.BATCH_SIZE
+        batches = [wanted[start : start + size] for start in range(0, len(wanted), size)]
+        if len(batches) == 1:
+            responses = [self._get_parameters(batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(batches), thread_name_prefix='ssm') as pool:
+                responses = list(pool.map(self._get_parameters, batches))
+
+        changed = False
+        for resp in responses:
+            for param in resp['Parameters']:
+                values[param['Name']] = param['Value']
+                if param['Type'] == 'SecureString':
+                    continue
+                cached = self.cache.get(param['Name'])
+                if cached is None or cached['version'] != param['Version']:
+                    if cached is not None:
+                        log.info(
+                            "%s is now version %s (was %s)",
+                            param['Name'],
+                            param['Version'],
+                            cached['version'],
+                        )
+                    self.cache[param['Name']] = {'value': param['Value'], 'version': param['Version']}
+                    changed = True
+            for name in resp['InvalidParameters']:
+                values[name] = None
+                changed |= self.cache.pop(name, None) is not None
+        if changed:
+            self._save()
+        return values
+
+    def _get_parameters(self, names: List[str]) -> dict:
+        return self.client.get_parameters(Names=names, WithDecryption=True)
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file + '.tmp', 'w') as fh:
+                json.dump(self.cache, fh)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as e:
+            log.warning("Failed to save SSM cache: %s", str(e))
+
+
+def write_credentials_to_files(
+    repo: str,
+    index: str,
+    out_folder: str = '~runner/actions-runner',
+    user: str = 'runner',
+    params: Optional[Dict[str, Optional[str]]] = None,
+):
+    names = runner_parameter_names(repo, index)
+    if params is None:
+        params = ParameterStore().get(names)
+
+    missing = []
+    for name, filename in zip(names, RUNNER_FILES.values()):
+        value = params.get(name)
+        if value is None:
+            missing.append(os.path.basename(name))
             continue
-        log.info("Writing %r to %r", param['Name'], filename)
+        log.info("Writing %r to %r", name, filename)
         with open(os.path.join(out_folder, filename), "w") as fh:
-            fh.write(param['Value'])
+            fh.write(value)
             shutil.chown(fh.name, user)
             os.chmod(fh.name, 0o600)
-        del param_to_file[name]
-    if param_to_file:
-        raise RuntimeError(f"Missing expected params: {list(param_to_file.keys())}")
-
+    if missing:
+        raise RuntimeError(f"Missing expected params: {missing}")
 
-def merge_in_settings(repo: str, out_folder: str) -> None:
-    client = boto3.client('ssm')
 
-    param_path = os.path.join('/runners/', repo, 'configOverlay')
+def merge_in_settings(repo: str, out_folder: str, params: Optional[Dict[str, Optional[str]]] = None) -> None:
+    param_path = config_overlay_name(repo)
     log.info("Loading config overlay from %s", param_path)
+    if params is None:
+        params = ParameterStore().get([param_path])
 
-    try:
-
-        resp = client.get_parameter(Name=param_path, WithDecryption=True)
-    except client.exceptions.ParameterNotFound:
-        log.debug("Failed to load config overlay", exc_info=True)
+    if params.get(param_path) is None:
+        log.debug("No config overlay at %s", param_path)
         return
 
     try:
-        overlay = json.loads(resp['Parameter']['Value'])
+        overlay = json.loads(params[param_path])  # type: ignore
     except ValueError:
         log.debug("Failed to parse config overlay", exc_info=True)
         return
@@ -252,21 +557,20 @@ def merge_in_settings(repo: str, out_folder: str) -> None:
         json.dump(settings, fh, indent=2)
 
 
-def get_possible_credentials(repo: str) -> List[str]:
-    client = boto3.client("ssm")
+def get_possible_credentials(repo: str, store: Optional[ParameterStore] = None) -> List[str]:
+    store = store or ParameterStore()
+    client = store.client
     paginator = client.get_paginator("describe_parameters")
 
     path = os.path.join('/runners/', repo, '')
-    baked_path = os.path.join(path, 'runnersList')
+    baked_path = runners_list_name(repo)
 
     # Pre-compute the list, to avoid making lots of requests and getting throttled by SSM API in case of
     # thundering herd
-    try:
+    baked = store.get([baked_path], use_cache=True)[baked_path]
+    if baked is not None:
         log.info("Using pre-computed credentials indexes from %s", baked_path)
-        resp = client.get_parameter(Name=baked_path)
-        return resp['Parameter']['Value'].split(',')
-    except client.exceptions.ParameterNotFound:
-        pass
+        return baked.split(',')
 
     log.info("Looking at %s for possible credentials", path)
 
@@ -311,9 +615,7 @@ def get_possible_credentials(repo: str) -> List[str]:
         raise RuntimeError(f'No credentials found in SSM ParameterStore for {repo!r}')
 
     try:
-        resp = client.put_parameter(
-            Name=baked_path, Type='StringList', Value=','.join(list(seen)), Overwrite=False
-        )
+        client.put_parameter(Name=baked_path, Type='StringList', Value=','.join(list(seen)), Overwrite=False)
         log.info("Stored pre-computed credentials indexes at %s", baked_path)
     except client.exceptions.ParameterAlreadyExists:
         # Race, we lost, never mind!
@@ -377,6 +679,96 @@ def complete_asg_lifecycle_hook(hook_name='WaitForInstanceReportReady', retry=Fa
         pass
 
 
+def publish_fleet_state(busy: bool):
+    """
+    Record whether we are busy in our fleet-state item, and count us in (or out of) the ASG's busy total
+
+    Both items are updated in one transaction, conditional on our own item, so a repeated (or lost)
+    update can never count us twice. If we have no item yet (we've only just started) being idle doesn't
+    change the total. The Lambda reconciles the total with the ASG every so often in case we die busy.
+    """
+    dynamodb = boto3.client('dynamodb')
+    now = int(time.time())
+    own = {
+        'TableName': TABLE_NAME,
+        'Key': {'id': {'S': f'fleet#{OWN_ASG}#{INSTANCE_ID}'}},
+        'UpdateExpression': 'SET busy = :busy, expires = :expires',
+        'ExpressionAttributeValues': {
+            ':busy': {'BOOL': busy},
+            ':expires': {'N': str(now + FLEET_STATE_TTL)},
+        },
+    }
+    total = {
+        'TableName': TABLE_NAME,
+        'Key': {'id': {'S': f'fleet#{OWN_ASG}'}},
+        'UpdateExpression': 'ADD busy :delta, version :one',
+        'ExpressionAttributeValues': {':delta': {'N': '1' if busy else '-1'}, ':one': {'N': '1'}},
+    }
+    if busy:
+        own['ConditionExpression'] = 'attribute_not_exists(busy) OR busy = :was'
+    else:
+        own['ConditionExpression'] = 'busy = :was'
+    own['ExpressionAttributeValues'][':was'] = {'BOOL': not busy}
+
+    try:
+        dynamodb.transact_write_items(TransactItems=[{'Update': own}, {'Update': total}])
+        log.info("Published fleet state busy=%s", busy)
+        return
+    except dynamodb.exceptions.TransactionCanceledException:
+        # We were already in this state (or had no item), so only our own item needs updating
+        pass
+    except dynamodb.exceptions.ClientError as e:
+        log.warning("Failed to publish fleet state: %s", str(e))
+        return
+
+    del own['ConditionExpression']
+    del own['ExpressionAttributeValues'][':was']
+    try:
+        dynamodb.update_item(**own)
+    except dynamodb.exceptions.ClientError as e:
+        log.warning("Failed to publish fleet state: %s", str(e))
+
+
+# The same number on every architecture, as it was added after the syscall tables were unified
+SYS_PIDFD_OPEN = 434
+_libc = None
+
+
+def pidfd_open(pid: int) -> int:
+    """
+    A file descriptor that becomes readable once ``pid`` exits
+
+    Raises OSError with ENOSYS if the kernel doesn't support them, or ESRCH if the process has gone.
+    """
+    if hasattr(os, 'pidfd_open'):
+        return os.pidfd_open(pid)  # type: ignore
+
+    # Python < 3.9 has no wrapper, so make the syscall ourselves
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    fd = _libc.syscall(SYS_PIDFD_OPEN, ctypes.c_int(pid), ctypes.c_uint(0))
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return fd
+
+
+def set_receive_buffer(sock: socket.socket, size: int) -> int:
+    """Ask for a ``size`` byte receive buffer, going over net.core.rmem_max if we are allowed to"""
+    # Missing from most/all pythons
+    SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33)
+    try:
+        # Needs CAP_NET_ADMIN, which we have as root
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except PermissionError:
+        # Capped at net.core.rmem_max
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    log.info("Socket receive buffer is %d bytes", actual)
+    return actual
+
+
 # Constants and types from
 # https://github.com/torvalds/linux/blob/fcadab740480e0e0e9fa9bd272acd409884d431a/include/uapi/linux/cn_proc.h
 class NlMsgFlag(enum.IntEnum):
@@ -498,17 +890,61 @@ class exit_proc_event(ctypes.Structure):
     ]
 
 
+# The same layouts as the structures above, for decoding straight out of the receive buffer
+_NLMSGHDR = struct.Struct('=IHHII')
+# cn_msg, then proc_event, then the pid every proc_event's event_data starts with
+_PROC_CN_MSG = struct.Struct('=IIIIHHIIQi')
+assert _NLMSGHDR.size == ctypes.sizeof(NLMsgHdr)
+assert _PROC_CN_MSG.size == ctypes.sizeof(cn_msg) + ctypes.sizeof(proc_event) + 4
+
+PROC_EVENT_EXEC = int(ProcEventWhat.EXEC)
+PROC_EVENT_EXIT = int(ProcEventWhat.EXIT)
+
+
+def parse_proc_events(buf, nbytes: int) -> Iterator[Tuple[int, int]]:
+    """
+    The (what, pid) of every proc connector event in the first ``nbytes`` of ``buf``
+
+    A datagram can hold several netlink messages, each padded to 4 bytes. The fields are unpacked in
+    place, so nothing is copied out of ``buf``, and ``what`` is left a plain int to compare against
+    PROC_EVENT_EXEC/PROC_EVENT_EXIT.
+    """
+    offset = 0
+    while offset + _NLMSGHDR.size <= nbytes:
+        length, msg_type, _, _, _ = _NLMSGHDR.unpack_from(buf, offset)
+        if length < _NLMSGHDR.size or offset + length > nbytes:
+            # Truncated or corrupt
+            return
+        if msg_type == NlMsgFlag.Done and length >= _NLMSGHDR.size + _PROC_CN_MSG.size:
+            idx, val, _, _, _, _, what, _, _, pid = _PROC_CN_MSG.unpack_from(buf, offset + _NLMSGHDR.size)
+            # The BPF filter only looks at the first message in each datagram
+            if idx == cn_msg.CN_IDX_PROC and val == cn_msg.CN_VAL_PROC:
+                yield what, pid
+        offset += (length + 3) & ~3
+
+
 class ProcessWatcher:
     interesting_processes = {}
+    # How much we've received from the proc connector, and how often the kernel had to drop events
+    stats = {'datagrams': 0, 'events': 0, 'overruns': 0, 'resyncs': 0}
+    _last_report: Tuple[float, int] = (0.0, 0)
+    # pid -> pidfd, for the interesting processes we could open one for
+    pidfds: Dict[int, int] = {}
+    pidfd_supported = True
 
     protected = None
     in_termating_lifecycle = False
+    sel: Optional[selectors.BaseSelector] = None
+    # Every datagram is received in to (and parsed out of) this one buffer
+    _recv_buffer: Optional[bytearray] = None
 
     def run(self):
         # Create a signal pipe that we can poll on
         sig_read, sig_write = socket.socketpair()
 
-        sel = selectors.DefaultSelector()
+        sel = self.sel = selectors.DefaultSelector()
+        self.stats = dict.fromkeys(self.stats, 0)
+        self._last_report = (time.monotonic(), 0)
 
         def sig_handler(signal, frame):
             # no-op
@@ -561,7 +997,7 @@ class ProcessWatcher:
                         proc.pid,
                         proc.cmdline(),
                     )
-                    self.interesting_processes[proc.pid] = proc
+                    self.track(proc)
                     self.protect_from_scale_in(protect=True)
                     self.dynamodb_atomic_decrement()
                 if proc.name() == "Runner.Listener":
@@ -588,27 +1024,100 @@ class ProcessWatcher:
             elif state == 'Pending:Wait':
                 complete_asg_lifecycle_hook()
 
-        # proc_connector is un-reliable (UDP) so periodically check if the processes are still alive
+        self.report_stats()
+
+        # proc_connector is un-reliable (UDP) so periodically check if the processes are still alive -- unless
+        # we have a pidfd for them, which can't miss the exit
         if not self.interesting_processes:
             self.pgrep()
             return
 
-        # list() is used to prevent "Dict changed size during iteration" during loop below
-        pids = list(self.interesting_processes.keys())
-        log.info("Checking processes %r are still alive", pids)
+        self.check_tracked_processes()
+
+        if not self.interesting_processes:
+            log.info("No interesting processes left, unprotecting from scale in")
+            self.protect_from_scale_in(protect=False)
+        elif not self.protected:
+            # If we didn't manage to protect last time, try again
+            self.protect_from_scale_in()
+
+    def check_tracked_processes(self):
+        pids = [pid for pid in self.interesting_processes if pid not in self.pidfds]
+        if pids:
+            log.info("Checking processes %r are still alive", pids)
 
         for pid in pids:
             proc = self.interesting_processes[pid]
             if not proc.is_running() or proc.status() == psutil.STATUS_ZOMBIE:
                 log.info("Proc %d dead but we didn't notice!", pid)
-                del self.interesting_processes[pid]
+                self.untrack(pid)
 
-        if not self.interesting_processes:
+    def resync(self):
+        """Find what the proc connector events we lost would have told us about"""
+        self.stats['resyncs'] += 1
+        had_processes = bool(self.interesting_processes)
+        self.check_tracked_processes()
+        self.pgrep()
+        if had_processes and not self.interesting_processes:
             log.info("No interesting processes left, unprotecting from scale in")
             self.protect_from_scale_in(protect=False)
-        elif not self.protected:
-            # If we didn't manage to protect last time, try again
-            self.protect_from_scale_in()
+
+    def report_stats(self):
+        now = time.monotonic()
+        since, events = self._last_report
+        rate = (self.stats['events'] - events) / max(now - since, 1)
+        stats = {**self.stats, 'events_per_second': round(rate, 2)}
+        self._last_report = (now, self.stats['events'])
+        if stats['overruns']:
+            log.info("Proc connector stats: %s", stats)
+        try:
+            os.makedirs(os.path.dirname(PROC_STATS_FILE), exist_ok=True)
+            with open(PROC_STATS_FILE + '.tmp', 'w') as fh:
+                json.dump(stats, fh)
+            os.replace(PROC_STATS_FILE + '.tmp', PROC_STATS_FILE)
+        except OSError as e:
+            log.debug("Failed to write %s: %s", PROC_STATS_FILE, e)
+
+    def track(self, proc: psutil.Process):
+        """Watch ``proc`` until it exits, with a pidfd in the select loop if the kernel supports them"""
+        self.interesting_processes[proc.pid] = proc
+        if not self.pidfd_supported or self.sel is None or proc.pid in self.pidfds:
+            return
+        try:
+            fd = pidfd_open(proc.pid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                # Already gone, which the proc connector or check_still_alive will notice
+                return
+            log.warning("Unable to open a pidfd for %d (%s), polling for it to exit instead", proc.pid, e)
+            if e.errno == errno.ENOSYS:
+                ProcessWatcher.pidfd_supported = False
+            return
+        self.pidfds[proc.pid] = fd
+        self.sel.register(fd, selectors.EVENT_READ, functools.partial(self.handle_pidfd_exit, proc.pid))
+
+    def untrack(self, pid: int):
+        del self.interesting_processes[pid]
+        fd = self.pidfds.pop(pid, None)
+        if fd is not None:
+            if self.sel:
+                self.sel.unregister(fd)
+            os.close(fd)
+
+    def handle_pidfd_exit(self, pid: int, fd: int, mask):
+        # The proc connector can report the exit in the same select() batch, in which case the pidfd has
+        # already been closed (and its number maybe re-used by a newer one) by the time we are called
+        if self.pidfds.get(pid) != fd:
+            return
+        self.process_exited(pid)
+
+    def process_exited(self, pid: int):
+        log.info("Interesting process %d exited", pid)
+        self.untrack(pid)
+
+        if not self.interesting_processes:
+            log.info("Watching no processes, disabling termination protection")
+            self.protect_from_scale_in(protect=False)
 
     def gracefully_terminate_runner(self):
         check_call(['systemctl', 'stop', 'actions.runner', '--no-block'])
@@ -626,11 +1135,15 @@ class ProcessWatcher:
         asg_client = boto3.client('autoscaling')
         try:
             self._protect_from_scale_in(asg_client, protect)
-            self.protected = protect
         except asg_client.exceptions.ClientError as e:
             # This can happen if this the runner picks up a job "too quick", and the ASG still has the state
             # as Pending:Proceed, so we can't yet set it as protected
             log.warning("Failed to set scale in protection: %s", str(e))
+            return
+
+        if FLEET_STATE and protect != self.protected:
+            publish_fleet_state(busy=protect)
+        self.protected = protect
 
     @retry(
         wait=wait_exponential(multiplier=1, max=10),
@@ -646,46 +1159,79 @@ class ProcessWatcher:
         )
 
     def dynamodb_atomic_decrement(self):
+        if QUEUE_SOURCE == 'workflow_job':
+            return
+
         dynamodb = boto3.client('dynamodb')
-        try:
-            resp = dynamodb.update_item(
-                TableName=TABLE_NAME,
-                Key={'id': {'S': 'queued_jobs'}},
-                ExpressionAttributeValues={':delta': {'N': '-1'}, ':limit': {'N': '0'}},
-                UpdateExpression='ADD queued :delta',
-                # Make sure it never goes below zero!
-                ConditionExpression='queued > :limit',
-                ReturnValues='UPDATED_NEW',
-            )
 
-            log.info("Updated DynamoDB queue length: %s", resp['Attributes']['queued']['N'])
-        except dynamodb.exceptions.ConditionalCheckFailedException:
-            log.warning("%s.queued was already 0, we won't decrease it any further!", TABLE_NAME)
+        # The counter is spread over QUEUE_SHARDS items (shard 0 keeping the un-sharded name) -- see
+        # increment_dynamodb_counter in the scale_out_runner lambda. Take one from whichever shard has any.
+        keys = [QUEUE_COUNTER] + [f'{QUEUE_COUNTER}#{n}' for n in range(1, QUEUE_SHARDS)]
+        random.shuffle(keys)
 
-    def handle_proc_event(self, sock, mask):
-        try:
-            data, (nlpid, nlgrps) = sock.recvfrom(1024)
-        except OSError as e:
-            if e.errno == errno.ENOBUFS:
-                return
-            raise
-        if nlpid != 0:
-            # Ignore messages from non-root processes
+        for key in keys:
+            try:
+                resp = dynamodb.update_item(
+                    TableName=TABLE_NAME,
+                    Key={'id': {'S': key}},
+                    ExpressionAttributeValues={':delta': {'N': '-1'}, ':limit': {'N': '0'}},
+                    UpdateExpression='ADD queued :delta',
+                    # Make sure it never goes below zero!
+                    ConditionExpression='queued > :limit',
+                    ReturnValues='UPDATED_NEW',
+                )
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                continue
+
+            log.info("Updated DynamoDB queue length (%s): %s", key, resp['Attributes']['queued']['N'])
             return
+        log.warning("%s.%s was already 0, we won't decrease it any further!", TABLE_NAME, QUEUE_COUNTER)
 
-        event, detail = proc_event.from_netlink_packet(data)
-        if event.what == ProcEventWhat.EXEC:
+    def handle_proc_event(self, sock, mask):
+        """Handle every datagram waiting on the (non-blocking) proc connector socket"""
+        if self._recv_buffer is None:
+            self._recv_buffer = bytearray(PROC_CONNECTOR_BUFFER)
+        buf = self._recv_buffer
+        overrun = False
+        while True:
             try:
-                proc = psutil.Process(detail.pid)
+                nbytes, (nlpid, nlgrps) = sock.recvfrom_into(buf)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The socket buffer filled up and the kernel dropped some events. Keep reading what it did
+                # keep, and then go and look for whatever we missed
+                self.stats['overruns'] += 1
+                overrun = True
+                continue
+
+            self.stats['datagrams'] += 1
+            if nlpid != 0:
+                # Ignore messages from non-root processes
+                continue
+            for what, pid in parse_proc_events(buf, nbytes):
+                self.stats['events'] += 1
+                self.handle_proc_message(what, pid)
+
+        if overrun:
+            log.warning("Proc connector overrun (%d so far), rescanning processes", self.stats['overruns'])
+            self.resync()
+
+    def handle_proc_message(self, what: int, pid: int):
+        if what == PROC_EVENT_EXEC:
+            try:
+                proc = psutil.Process(pid)
 
                 with proc.oneshot():
                     if proc.name() == "Runner.Worker":
                         log.info(
                             "Found new interesting processes, protecting from scale in %d: %s",
-                            detail.pid,
+                            pid,
                             proc.cmdline(),
                         )
-                        self.interesting_processes[detail.pid] = proc
+                        self.track(proc)
                         self.protect_from_scale_in(protect=True)
                         self.dynamodb_atomic_decrement()
 
@@ -693,19 +1239,14 @@ class ProcessWatcher:
                 # We lost the race, process has already exited. If it was that short lived it wasn't that
                 # interesting anyway
                 pass
-        elif event.what == ProcEventWhat.EXIT:
-            if detail.pid in self.interesting_processes:
-                log.info("Interesting process %d exited", detail.pid)
-                del self.interesting_processes[detail.pid]
-
-                if not self.interesting_processes:
-                    log.info("Watching no processes, disabling termination protection")
-                    self.protect_from_scale_in(protect=False)
+        elif what == PROC_EVENT_EXIT:
+            if pid in self.interesting_processes:
+                self.process_exited(pid)
             elif self.in_termating_lifecycle:
                 try:
-                    proc = psutil.Process(detail.pid)
+                    proc = psutil.Process(pid)
                     if proc.name() == "Runner.Listener":
-                        log.info("Runner.Listener process %d exited - OkayToTerminate instance", detail.pid)
+                        log.info("Runner.Listener process %d exited - OkayToTerminate instance", pid)
                         complete_asg_lifecycle_hook('OkayToTerminate')
                 except psutil.NoSuchProcess:
                     # We lost the race, process has already exited. If it was that short lived it wasn't that
@@ -825,6 +1366,7 @@ class ProcessWatcher:
         SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
 
         sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        set_receive_buffer(sock, PROC_CONNECTOR_RCVBUF)
 
         filter_prog = packet_filter_prog()
         sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(filter_prog))  # type: ignore
@@ -33,7 +33,7 @@ cd ~runner/actions-runner
 curl -L "https://github.com/ashb/runner/releases/download/v${RUNNER_VERSION}/actions-runner-linux-x64-${RUNNER_VERSION}.tar.gz" | tar -zx
 
 python3 -mvenv /opt/runner-supervisor
-/opt/runner-supervisor/bin/pip install -U pip python-dynamodb-lock-whatnick==0.9.3 click==7.1.2 psutil 'tenacity~=6.0'
+/opt/runner-supervisor/bin/pip install -U pip boto3 click==7.1.2 psutil 'tenacity~=6.0'
 
 install --owner root --mode 0755 /tmp/runner-supervisor /opt/runner-supervisor/bin/runner-supervisor
 
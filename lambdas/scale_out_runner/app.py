@@ -16,15 +16,30 @@
 # under the License.
 
 import codecs
+import datetime
 import hmac
 import json
 import logging
+import math
 import os
-from typing import cast
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, List, NamedTuple, Optional, Tuple, cast
 
 import boto3
-from chalice import BadRequestError, Chalice, ForbiddenError
+from botocore.config import Config
+from chalice import BadRequestError, Chalice, ForbiddenError, Rate, Response
 from chalice.app import Request
+from chalicelib.audit import decision_record, format_record, table_item
+from chalicelib.forecast import DynamoDBArrivalHistory, prescale_target
+from chalicelib.github import GitHubAPI
+from chalicelib.metrics import Metrics, write_line
+from chalicelib.policy import Policy
+from chalicelib.scaling import Decision, GroupState, decide
 
 app = Chalice(app_name='scale_out_runner')
 app.log.setLevel(logging.INFO)
@@ -32,11 +47,49 @@ app.log.setLevel(logging.INFO)
 ASG_GROUP_NAME = os.getenv('ASG_NAME', 'AshbRunnerASG')
 ASG_REGION_NAME = os.getenv('ASG_REGION_NAME', None)
 TABLE_NAME = os.getenv('COUNTER_TABLE', 'GithubRunnerQueue')
-_commiters = set()
+QUEUE_COUNTER = 'queued_jobs'
+# Number of DynamoDB items the queue counter is spread over. Must match the runner-supervisor setting
+QUEUE_SHARDS = int(os.getenv('QUEUE_SHARDS', '1'))
+SSM_REPO_NAME = os.getenv('SSM_REPO_NAME', 'apache/airflow')
+# Which webhook event drives the queue counter: 'check_run', or 'workflow_job' to use the per-job ledger.
+# The runner-supervisor needs the same setting.
+QUEUE_SOURCE = os.getenv('QUEUE_SOURCE', 'check_run')
+LEDGER_TABLE = os.getenv('LEDGER_TABLE', TABLE_NAME)
+LEDGER_TTL = int(os.getenv('LEDGER_TTL', str(7 * 24 * 3600)))
+# A workflow_job is only for us if it asks for (at least) one of these labels
+RUNNER_LABELS = frozenset(json.loads(os.getenv('RUNNER_LABELS', '["airflow-runner", "vm-runner"]')))
+# The order a job moves through its states in
+JOB_STATES = {'queued': 0, 'in_progress': 1, 'completed': 2}
+
+# Reserve capacity for the (learned) number of jobs in a workflow as soon as its workflow_run is requested.
+# Needs QUEUE_SOURCE=workflow_job
+BURST_PRESCALING = os.getenv('BURST_PRESCALING', 'false').lower() == 'true'
+RESERVED_COUNTER = 'reserved_jobs'
+# How quickly the learned job count for a workflow follows its latest run
+FANOUT_ALPHA = float(os.getenv('FANOUT_ALPHA', '0.3'))
+
+# Where (and for how long) to remember which X-GitHub-Delivery IDs we have already processed
+DELIVERY_TABLE = os.getenv('DELIVERY_TABLE', TABLE_NAME)
+DELIVERY_TTL = int(os.getenv('DELIVERY_TTL', str(3 * 24 * 3600)))
+# Until it has been counted, a delivery's claim lapses after this long (at least the Lambda's timeout), so a
+# retry can have another go if the first attempt died part way through
+DELIVERY_LEASE = int(os.getenv('DELIVERY_LEASE', '60'))
+DELIVERY_CACHE_SIZE = int(os.getenv('DELIVERY_CACHE_SIZE', '1024'))
 GH_WEBHOOK_TOKEN = None
 
+# Acknowledge check_run webhooks as soon as they are on the SCALING_QUEUE SQS queue, and update the counter
+# and ASG from there, merging each batch of messages in to one scaling decision
+ASYNC_SCALING = os.getenv('ASYNC_SCALING', 'false').lower() == 'true'
+SCALING_QUEUE = os.getenv('SCALING_QUEUE', 'GithubRunnerScaling')
+SCALING_BATCH_SIZE = int(os.getenv('SCALING_BATCH_SIZE', '10'))
+SCALING_BATCH_WINDOW = int(os.getenv('SCALING_BATCH_WINDOW', '1'))
+# When the ASG is busy with another scaling activity, try again this many times, this many seconds apart
+SCALING_MAX_RETRIES = int(os.getenv('SCALING_MAX_RETRIES', '5'))
+SCALING_RETRY_DELAY = int(os.getenv('SCALING_RETRY_DELAY', '15'))
+
 REPOS = os.getenv('REPOS')
 if REPOS:
+    # See chalicelib/policy.py for the rules that can be given for each repo
     REPO_CONFIGURATION = json.loads(REPOS)
 else:
     REPO_CONFIGURATION = {
@@ -44,88 +97,1206 @@ else:
         'apache/airflow': {'main', 'master'},
     }
 del REPOS
+POLICY = Policy(REPO_CONFIGURATION, RUNNER_LABELS)
+
+
+class Route(NamedTuple):
+    """Which ASG (and queue counter) jobs asking for a particular set of runner labels go to"""
+
+    name: str
+    asg: str
+    region: Optional[str] = None
+    # A job goes to the first route whose labels are all in the job's labels
+    labels: FrozenSet[str] = frozenset()
+    # (asg, region) pairs to use, in order, when ``asg`` is at its MaxSize
+    overflow: Tuple[Tuple[str, Optional[str]], ...] = ()
+
+    @property
+    def counter(self) -> str:
+        if self.name == 'default':
+            return QUEUE_COUNTER
+        return f'{QUEUE_COUNTER}:{self.name}'
+
+
+def _overflow_groups(config: List[dict]) -> Tuple[Tuple[str, Optional[str]], ...]:
+    return tuple((group['asg'], group.get('region')) for group in config)
+
+
+DEFAULT_ROUTE = Route(
+    'default',
+    ASG_GROUP_NAME,
+    ASG_REGION_NAME,
+    # [{"asg": "RunnerASG-c5", "region": "us-east-2"}, ...]. prod_iam.json only allows scaling *RunnerASG*
+    overflow=_overflow_groups(json.loads(os.getenv('OVERFLOW_ASGS', '[]'))),
+)
+
+ROUTES = os.getenv('ROUTES')
+if ROUTES:
+    ROUTING_TABLE = [
+        # [{"name": "arm", "labels": ["arm64"], "asg": "ArmRunnerASG", "region": "us-east-2", "overflow": []}]
+        Route(
+            r['name'],
+            r['asg'],
+            r.get('region'),
+            frozenset(r.get('labels', ())),
+            _overflow_groups(r.get('overflow', [])),
+        )
+        for r in json.loads(ROUTES)
+    ]
+else:
+    ROUTING_TABLE = []
+del ROUTES
+# How long to avoid an overflow ASG after it failed to scale or launch instances
+OVERFLOW_COOLDOWN = int(os.getenv('OVERFLOW_COOLDOWN', '600'))
+
+# Pre-scale ahead of the bursts we saw at the same time last week. See chalicelib/forecast.py
+PREDICTIVE_SCALING = os.getenv('PREDICTIVE_SCALING', 'false').lower() == 'true'
+PREDICTIVE_BUCKET_MINUTES = int(os.getenv('PREDICTIVE_BUCKET_MINUTES', '15'))
+PREDICTIVE_LOOKAHEAD_MINUTES = int(os.getenv('PREDICTIVE_LOOKAHEAD_MINUTES', '30'))
+# Fraction of the expected arrivals to have idle instances ready for ...
+PREDICTIVE_FACTOR = float(os.getenv('PREDICTIVE_FACTOR', '0.5'))
+# ... but never more than this many per route (the cost ceiling)
+PREDICTIVE_MAX_INSTANCES = int(os.getenv('PREDICTIVE_MAX_INSTANCES', '10'))
+
+# Use (and size) the ASG warm pools of pre-initialized, stopped or hibernated, instances.
+WARM_POOL = os.getenv('WARM_POOL', 'false').lower() == 'true'
+WARM_POOL_STATE = os.getenv('WARM_POOL_STATE', 'Hibernated')
+# The warm pool is kept at WARM_POOL_FACTOR * the jobs that arrived in the last WARM_POOL_WINDOW_MINUTES,
+# but no fewer than WARM_POOL_MIN_SIZE or more than WARM_POOL_MAX_SIZE instances
+WARM_POOL_WINDOW_MINUTES = int(os.getenv('WARM_POOL_WINDOW_MINUTES', '60'))
+WARM_POOL_FACTOR = float(os.getenv('WARM_POOL_FACTOR', '0.25'))
+WARM_POOL_MIN_SIZE = int(os.getenv('WARM_POOL_MIN_SIZE', '0'))
+WARM_POOL_MAX_SIZE = int(os.getenv('WARM_POOL_MAX_SIZE', '10'))
+
+# Write the time spent in each phase (and AWS call) of every webhook to the log as CloudWatch Embedded
+# Metric Format, which CloudWatch turns in to metrics without any extra API calls
+metrics = Metrics(
+    os.getenv('METRICS_NAMESPACE', 'GithubRunners/ScaleOut'),
+    enabled=os.getenv('EMF_METRICS', 'true').lower() == 'true',
+)
+
+# Write the inputs and outcome of every scale-out decision to the log as a compact JSON line (and, if set,
+# to AUDIT_TABLE for AUDIT_TTL seconds), so they can be replayed with ``python -m chalicelib.audit``
+AUDIT_LOG = os.getenv('AUDIT_LOG', 'true').lower() == 'true'
+AUDIT_TABLE = os.getenv('AUDIT_TABLE')
+AUDIT_TTL = int(os.getenv('AUDIT_TTL', str(7 * 24 * 3600)))
+
+# Read each ASG's busy instances (published by the runner-supervisors) and capacity from a "fleet#<asg>"
+# item, instead of describing the ASG for every event. The ASG is only described to reconcile the item
+# once it is older than FLEET_RECONCILE_SECONDS
+FLEET_STATE = os.getenv('FLEET_STATE', 'false').lower() == 'true'
+FLEET_RECONCILE_SECONDS = int(os.getenv('FLEET_RECONCILE_SECONDS', '60'))
+
+# Remove idle instances beyond the queue (plus SCALE_IN_WARM_BUFFER, plus the predictive pre-scaling target)
+# every minute, rather than waiting for the CloudWatch alarm on the (once a minute) jobs-running metric
+SCALE_IN = os.getenv('SCALE_IN', 'false').lower() == 'true'
+SCALE_IN_WARM_BUFFER = int(os.getenv('SCALE_IN_WARM_BUFFER', '1'))
+
+# Correct the queue counters from the jobs the GitHub API says are waiting for a runner, every few minutes
+QUEUE_RECONCILIATION = os.getenv('QUEUE_RECONCILIATION', 'false').lower() == 'true'
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+# An SSM SecureString holding a token that can read the repos' Actions runs
+GH_API_TOKEN_PARAMETER = os.getenv('GH_API_TOKEN_PARAMETER', '/runners/github-api-token')
+GH_API_TOKEN = None
+
+# Clients are created once per Lambda container and re-used by every (warm) invocation, so we don't pay for
+# endpoint resolution, credential lookup and a fresh TLS handshake on each webhook.
+AWS_CLIENT_CONFIG = Config(
+    connect_timeout=2,
+    read_timeout=5,
+    max_pool_connections=int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '10')),
+    tcp_keepalive=True,
+    retries={'mode': 'standard', 'max_attempts': 3},
+)
+# Independent AWS calls (e.g. describing the ASGs while the queue counter is updated) are made on this many
+# threads at once. 0 makes every call in turn on the request thread
+AWS_CALL_CONCURRENCY = int(os.getenv('AWS_CALL_CONCURRENCY', '4'))
+_clients: Dict[Tuple[str, Optional[str]], Any] = {}
+_clients_lock = threading.Lock()
+_recent_deliveries: 'OrderedDict[str, dict]' = OrderedDict()
+_overflow_cooldown: Dict[Tuple[str, Optional[str]], float] = {}
+_queue_urls: Dict[str, str] = {}
+_executor = ThreadPoolExecutor(max_workers=AWS_CALL_CONCURRENCY or 1, thread_name_prefix='aws')
 
 
 @app.route('/', methods=['POST'])
 def index():
-    validate_gh_sig(app.current_request)
+    with metrics.invocation():
+        metrics.set_property('delivery', app.current_request.headers.get('X-GitHub-Delivery'))
+        payload = handle_webhook()
+        metrics.set_dimension('Outcome', decision_outcome(payload))
+    if 'accepted' in payload:
+        return Response(body=payload, status_code=202)
+    return payload
 
-    if app.current_request.headers.get('X-GitHub-Event', None) != "check_run":
+
+def handle_webhook() -> dict:
+    with metrics.timer('SignatureCheck'):
+        validate_gh_sig(app.current_request)
+
+    event = app.current_request.headers.get('X-GitHub-Event', None)
+    metrics.set_property('event', event)
+    if event == 'workflow_job':
+        return handle_workflow_job(app.current_request.json_body)
+    if event == 'workflow_run':
+        return handle_workflow_run(app.current_request.json_body)
+
+    if event != "check_run":
         # Ignore things about installs/permissions etc
         return {'ignored': 'not about check_runs'}
 
-    body = app.current_request.json_body
+    if QUEUE_SOURCE != 'check_run':
+        return {'ignored': 'queue is counted from workflow_job events'}
 
-    repo = body['repository']['full_name']
-
-    sender = body['sender']['login']
+    body = app.current_request.json_body
+    delivery = app.current_request.headers.get('X-GitHub-Delivery', None)
+    intent = check_run_intent(body, delivery)
 
     # Other repos configured with this app, but we don't do anything with them
     # yet.
-    if repo not in REPO_CONFIGURATION:
-        app.log.info("Ignoring event for %r", repo)
+    if POLICY.repo(intent['repo']) is None:
+        app.log.info("Ignoring event for %r", intent['repo'])
         return {'ignored': 'Other repo'}
 
-    interested_branches = REPO_CONFIGURATION[repo]
+    if ASYNC_SCALING:
+        if not delivery:
+            # We need it to only count each intent once
+            raise BadRequestError('X-GitHub-Delivery header missing')
+        # Only the events that could change the queue are worth a message
+        if classify_check_run(intent, use_self_hosted=True)[0]:
+            return enqueue_scaling_intent(intent)
+        return classify_check_run(intent, use_self_hosted=False)[1]
+
+    branch = intent['branch']
+    groups = None
+    if (
+        classify_check_run(intent, use_self_hosted=True)[0] > 0
+        and not POLICY.decide(intent['repo'], branch, intent['sender']).use_self_hosted
+        and _commiters.needs_load()
+    ):
+        # Don't make the ASG wait behind SSM on a cold container -- if the sender turns out to be a
+        # committer we will need it.
+        groups = prefetch_groups(DEFAULT_ROUTE)
+
+    delta, payload = classify_check_run(intent, uses_self_hosted(intent))
+    if delta:
+        # GitHub (and Lambda) retry deliveries, and we must only count each one once
+        payload = apply_queue_change(delta, payload, delivery, groups)
+    if groups:
+        # In case it wasn't needed after all: don't leave it running once we have returned
+        groups.exception()
+    app.log.info(
+        "delivery=%s branch=%s: %r commiters_cache=%r",
+        delivery,
+        branch,
+        payload,
+        _commiters.stats,
+    )
+    return payload
+
+
+def check_run_intent(body: dict, delivery: Optional[str]) -> dict:
+    """The parts of a check_run event we make our scaling decision on"""
+    check_run = body['check_run']
+    return {
+        'delivery': delivery,
+        'repo': body['repository']['full_name'],
+        'sender': body['sender']['login'],
+        'branch': check_run['check_suite']['head_branch'],
+        'action': body['action'],
+        'status': check_run['status'],
+        'conclusion': check_run['conclusion'],
+    }
 
-    branch = body['check_run']['check_suite']['head_branch']
 
-    use_self_hosted = sender in commiters() or branch in interested_branches
-    payload = {'sender': sender, 'use_self_hosted': use_self_hosted}
+def uses_self_hosted(intent: dict) -> bool:
+    return POLICY.decide(intent['repo'], intent['branch'], intent['sender'], commiters).use_self_hosted
 
-    if body['action'] == 'completed' and body['check_run']['conclusion'] == 'cancelled':
+
+def classify_check_run(intent: dict, use_self_hosted: bool) -> Tuple[int, dict]:
+    """
+    How a check_run event changes the queue (+1, -1 or 0), and the payload to respond with
+
+    ``use_self_hosted`` is whether the run is for a branch or committer that we run jobs for.
+    """
+    payload = {'sender': intent['sender'], 'use_self_hosted': use_self_hosted}
+
+    delta = 0
+    if intent['action'] == 'completed' and intent['conclusion'] == 'cancelled':
         if use_self_hosted:
             # The only time we get a "cancelled" job is when it wasn't yet running.
-            queue_length = increment_dynamodb_counter(-1)
-            # Don't scale in the ASG -- let the CloudWatch alarm do that.
-            payload['new_queue'] = queue_length
+            delta = -1
         else:
             payload = {'ignored': 'unknown sender'}
 
-    elif body['action'] != 'created':
+    elif intent['action'] != 'created':
         payload = {'ignored': "action is not 'created'"}
 
-    elif body['check_run']['status'] != 'queued':
+    elif intent['status'] != 'queued':
         # Skipped runs are "created", but are instantly completed. Ignore anything that is not queued
         payload = {'ignored': "check_run.status is not 'queued'"}
-    else:
-        if use_self_hosted:
-            # Increment counter in DynamoDB
-            queue_length = increment_dynamodb_counter()
-            payload.update(**scale_asg_if_needed(queue_length))
-    app.log.info(
-        "delivery=%s branch=%s: %r",
-        app.current_request.headers.get('X-GitHub-Delivery', None),
-        branch,
-        payload,
+    elif use_self_hosted:
+        delta = 1
+    return delta, payload
+
+
+def enqueue_scaling_intent(intent: dict, delay: int = 0) -> dict:
+    sqs = aws_client('sqs')
+    resp = sqs.send_message(
+        QueueUrl=queue_url(SCALING_QUEUE), MessageBody=json.dumps(intent), DelaySeconds=delay
     )
+    return {'accepted': resp['MessageId']}
+
+
+def queue_url(queue_name: str) -> str:
+    try:
+        return _queue_urls[queue_name]
+    except KeyError:
+        pass
+    url = _queue_urls[queue_name] = aws_client('sqs').get_queue_url(QueueName=queue_name)['QueueUrl']
+    return url
+
+
+def process_scaling_intents(event):
+    """Apply a batch of the check_run intents queued by :func:`index` (in ASYNC_SCALING mode)"""
+    intents = [json.loads(record.body) for record in event]
+    with metrics.invocation():
+        result = scale_for_intents(intents)
+        metrics.set_dimension('Outcome', decision_outcome(result))
+    app.log.info("Batch of %d intents: %r", len(intents), result)
+
+
+def subscribe_to_scaling_queue():
+    """Have the messages on SCALING_QUEUE delivered to :func:`process_scaling_intents`"""
+    app.on_sqs_message(
+        queue=SCALING_QUEUE,
+        batch_size=SCALING_BATCH_SIZE,
+        maximum_batching_window_in_seconds=SCALING_BATCH_WINDOW,
+    )(process_scaling_intents)
+
+
+if ASYNC_SCALING:
+    # Deploying the event source mapping needs the queue to exist, so only subscribe when it is in use
+    subscribe_to_scaling_queue()
+
+
+def scale_for_intents(intents: List[dict]) -> dict:
+    """
+    Apply the intents' counter changes, and then scale the ASG once for the whole batch
+
+    Each intent is only counted once (SQS, like GitHub, can deliver a message more than once), and the
+    changes are netted in to a single counter update. If the ASG is busy with another scaling activity
+    then, rather than dropping the scale-up, a delayed "retry" intent is queued to try again. Any other
+    failure is left for SQS to redeliver the batch, which scales again even though it counts nothing.
+    """
+    retries = max((intent['retry'] for intent in intents if 'retry' in intent), default=0)
+    changes = []
+    seen = set()
+    duplicates = 0
+    # Even if every job in the batch was already counted, SQS may be redelivering it because the scaling
+    # step failed, so scale whenever a job was queued
+    queued = bool(retries)
+    for intent in intents:
+        if 'retry' in intent:
+            continue
+        delta, _ = classify_check_run(intent, uses_self_hosted(intent))
+        if not delta:
+            continue
+        queued = queued or delta > 0
+        if intent['delivery'] in seen or intent['delivery'] in _recent_deliveries:
+            duplicates += 1
+            continue
+        seen.add(intent['delivery'])
+        changes.append((intent, delta))
+
+    groups = None
+    if queued:
+        # The ASGs' state doesn't depend on the counter, so fetch it at the same time
+        groups = prefetch_groups(DEFAULT_ROUTE)
+
+    counted, writes = count_intents(changes)
+    arrivals = sum(delta for _, delta in counted if delta > 0)
+    result: Dict[str, Any] = {
+        'batch_size': len(intents),
+        'counted': len(counted),
+        'duplicates': duplicates + len(changes) - len(counted),
+    }
+    metrics.set_property('deliveries', [intent['delivery'] for intent, _ in counted])
+
+    scaled = 0
+    if groups:
+        if arrivals:
+            record_arrival(DEFAULT_ROUTE, arrivals)
+        result.update(**scale_asg_if_needed(read_dynamodb_counter(), prefetched=groups))
+        # The counter read, the describe, and maybe a capacity change
+        scaled = 2 + ('new_capcity' in result)
+        if 'error' in result:
+            if retries < SCALING_MAX_RETRIES:
+                enqueue_scaling_intent({'retry': retries + 1}, delay=SCALING_RETRY_DELAY)
+                result['retry'] = retries + 1
+            else:
+                app.log.error("Giving up scaling after %d retries", retries)
+
+    # One at a time, each counted intent would have been claimed, counted and had its payload recorded,
+    # and each arrival would have had its own describe and capacity change
+    unbatched = 3 * len(counted) + 2 * sum(1 for _, delta in counted if delta > 0)
+    result['api_calls_saved'] = max(0, unbatched - writes - scaled)
+
+    metrics.count('BatchSize', len(intents))
+    metrics.count('IntentsCounted', len(counted))
+    metrics.count('ApiCallsSaved', result['api_calls_saved'])
+    return result
+
+
+def count_intents(changes: List[Tuple[dict, int]]) -> Tuple[List[Tuple[dict, int]], int]:
+    """
+    Claim the intents' deliveries, and add their net change to the queue counter, in one transaction
+
+    Intents whose delivery has already been processed are dropped (and the transaction tried again
+    without them). Returns the intents that were counted, and how many DynamoDB writes that took.
+    """
+    dynamodb = aws_client('dynamodb')
+    keys = counter_shard_keys()
+    counted: List[Tuple[dict, int]] = []
+    writes = 0
+    pending = list(changes)
+    while pending:
+        # A transaction is limited to 100 items, and one of them is the counter
+        chunk = pending[:99]
+        net = sum(delta for _, delta in chunk)
+        now = int(time.time())
+        actions = [
+            {
+                'Put': {
+                    'TableName': DELIVERY_TABLE,
+                    'Item': {
+                        'id': {'S': f"delivery#{intent['delivery']}"},
+                        'expires': {'N': str(now + DELIVERY_TTL)},
+                        'payload': {'S': json.dumps({'delta': delta, 'batched': True})},
+                    },
+                    # The TTL reaper can take a while to delete items, so ignore any that have already expired
+                    'ConditionExpression': 'attribute_not_exists(id) OR expires < :now',
+                    'ExpressionAttributeValues': {':now': {'N': str(now)}},
+                }
+            }
+            for intent, delta in chunk
+        ]
+        if net > 0:
+            actions.append(
+                {
+                    'Update': {
+                        'TableName': TABLE_NAME,
+                        'Key': {'id': {'S': keys[_pick_shard(keys, None)]}},
+                        'UpdateExpression': 'ADD queued :delta',
+                        'ExpressionAttributeValues': {':delta': {'N': str(net)}},
+                    }
+                }
+            )
+
+        writes += 1
+        try:
+            dynamodb.transact_write_items(TransactItems=actions)
+        except dynamodb.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get('CancellationReasons', [])
+            duplicates = {
+                n
+                for n, reason in enumerate(reasons[: len(chunk)])
+                if reason.get('Code') == 'ConditionalCheckFailed'
+            }
+            if not duplicates:
+                raise
+            pending = [change for n, change in enumerate(chunk) if n not in duplicates] + pending[
+                len(chunk) :
+            ]
+            continue
+
+        if net < 0:
+            # Decrements have to go through increment_dynamodb_counter to never go below zero. If this
+            # fails the deliveries are already claimed, so the counter stays high -- the safe direction
+            increment_dynamodb_counter(net)
+            writes += 1
+        for intent, delta in chunk:
+            _remember_delivery(intent['delivery'], {'delta': delta, 'batched': True})
+        counted += chunk
+        pending = pending[len(chunk) :]
+    return counted, writes
+
+
+def decision_outcome(payload: dict) -> str:
+    """Summarize what we did with a webhook, for the metrics' Outcome dimension"""
+    if 'ignored' in payload:
+        return 'ignored'
+    if 'accepted' in payload:
+        return 'accepted'
+    if 'error' in payload:
+        return 'error'
+    if payload.get('new_capcity') or payload.get('overflow'):
+        return 'scaled'
+    if payload.get('capacity_at_max'):
+        return 'capacity_at_max'
+    if payload.get('idle_instances'):
+        return 'idle_instances'
+    if 'new_queue' in payload or 'released' in payload:
+        return 'dequeued'
+    return 'no_change'
+
+
+def handle_workflow_job(body: dict) -> dict:
+    job = body['workflow_job']
+    repo = body['repository']['full_name']
+    labels = job.get('labels') or []
+    payload = {'job': job['id']}
+    policy = POLICY.repo(repo)
+
+    if QUEUE_SOURCE != 'workflow_job':
+        payload = {'ignored': 'queue is counted from check_run events'}
+    elif policy is None:
+        payload = {'ignored': 'Other repo'}
+    elif not policy.wants_labels(labels):
+        payload = {'ignored': 'not for a self-hosted runner'}
+    elif body['action'] not in JOB_STATES:
+        payload = {'ignored': f"action {body['action']!r} is not a job state"}
+    else:
+        route = route_for_labels(labels)
+        payload['route'] = route.name
+        groups = prefetch_groups(route) if body['action'] == 'queued' else None
+        delta = record_job_transition(job['id'], body['action'], labels, route, run_id=job.get('run_id'))
+        if delta is None:
+            payload['ignored'] = 'duplicate or out of order'
+        elif delta > 0:
+            record_arrival(route)
+            if BURST_PRESCALING and route == DEFAULT_ROUTE and job.get('run_id'):
+                payload['reserved'] = consume_run_reservation(job['run_id'])
+            payload.update(**scale_asg_if_needed(queue_demand(route), route, groups))
+        elif delta < 0:
+            payload['new_queue'] = read_dynamodb_counter(route.counter)
+        if groups:
+            groups.exception()
+
+    app.log.info("workflow_job %s job=%s labels=%r: %r", body['action'], job['id'], labels, payload)
+    return payload
+
+
+def handle_workflow_run(body: dict) -> dict:
+    """
+    Reserve capacity for all of a workflow's jobs as soon as the run is requested
+
+    How many self-hosted jobs a run of each workflow has is learned as the runs complete, and reserved
+    up-front (in one scaling call) when the next run is requested. Each job that then turns up uses one
+    of the run's reservations instead of scaling again, and anything left over once the run completes
+    (skipped jobs, say) is released.
+    """
+    run = body['workflow_run']
+    repo = body['repository']['full_name']
+    payload = {'run': run['id']}
+
+    if not BURST_PRESCALING or QUEUE_SOURCE != 'workflow_job':
+        payload = {'ignored': 'burst pre-scaling is not enabled'}
+    elif POLICY.repo(repo) is None:
+        payload = {'ignored': 'Other repo'}
+    elif not POLICY.decide(repo, run['head_branch'], body['sender']['login'], commiters).use_self_hosted:
+        payload = {'ignored': 'not using self-hosted runners'}
+    elif body['action'] == 'requested':
+        payload['reserved'] = reserve_run_capacity(repo, run['name'], run['id'])
+        if payload['reserved']:
+            payload.update(**scale_asg_if_needed(queue_demand(DEFAULT_ROUTE)))
+    elif body['action'] == 'completed':
+        payload['released'] = release_run_capacity(repo, run['name'], run['id'])
+    else:
+        payload = {'ignored': f"action {body['action']!r} is not requested or completed"}
+
+    app.log.info("workflow_run %s run=%s workflow=%r: %r", body['action'], run['id'], run['name'], payload)
     return payload
 
 
-def commiters(ssm_repo_name: str = os.getenv('SSM_REPO_NAME', 'apache/airflow')):
-    global _commiters
+def queue_demand(route: Route) -> int:
+    """The number of jobs ``route`` needs capacity for: those queued, plus any reserved for workflow runs"""
+    keys = counter_shard_keys(route.counter)
+    if BURST_PRESCALING and route == DEFAULT_ROUTE:
+        keys.append(RESERVED_COUNTER)
+    return sum(_read_counter_shards(keys).values())
+
+
+def _fanout_key(repo: str, workflow: str) -> dict:
+    return {'id': {'S': f'fanout#{repo}#{workflow}'}}
+
+
+def _run_key(run_id: int) -> dict:
+    return {'id': {'S': f'run#{run_id}'}}
+
+
+def reserve_run_capacity(repo: str, workflow: str, run_id: int) -> int:
+    dynamodb = aws_client('dynamodb')
+    item = dynamodb.get_item(TableName=LEDGER_TABLE, Key=_fanout_key(repo, workflow)).get('Item')
+    expected = round(float(item['jobs']['N'])) if item else 0
+    if not expected:
+        return 0
+
+    try:
+        dynamodb.put_item(
+            TableName=LEDGER_TABLE,
+            Item={
+                **_run_key(run_id),
+                'reserved': {'N': str(expected)},
+                'remaining': {'N': str(expected)},
+                'seen': {'N': '0'},
+                'expires': {'N': str(int(time.time()) + LEDGER_TTL)},
+            },
+            ConditionExpression='attribute_not_exists(id)',
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # A redelivery, or the run's jobs got here first -- either way it's too late to reserve anything
+        return 0
+
+    increment_dynamodb_counter(expected, RESERVED_COUNTER)
+    return expected
+
+
+def consume_run_reservation(run_id: int) -> bool:
+    """Count a job for its run, and take it from the run's reservation if it has one left"""
+    dynamodb = aws_client('dynamodb')
+    try:
+        dynamodb.update_item(
+            TableName=LEDGER_TABLE,
+            Key=_run_key(run_id),
+            UpdateExpression='ADD seen :one, remaining :minus_one',
+            ConditionExpression='remaining > :zero',
+            ExpressionAttributeValues={':one': {'N': '1'}, ':minus_one': {'N': '-1'}, ':zero': {'N': '0'}},
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        dynamodb.update_item(
+            TableName=LEDGER_TABLE,
+            Key=_run_key(run_id),
+            UpdateExpression='ADD seen :one SET expires = if_not_exists(expires, :expires)',
+            ExpressionAttributeValues={
+                ':one': {'N': '1'},
+                ':expires': {'N': str(int(time.time()) + LEDGER_TTL)},
+            },
+        )
+        return False
+
+    # This job is now in the queued count instead
+    increment_dynamodb_counter(-1, RESERVED_COUNTER)
+    return True
+
+
+def release_run_capacity(repo: str, workflow: str, run_id: int) -> int:
+    """Release what is left of a completed run's reservation, and learn how many jobs it had"""
+    dynamodb = aws_client('dynamodb')
+    try:
+        resp = dynamodb.update_item(
+            TableName=LEDGER_TABLE,
+            Key=_run_key(run_id),
+            UpdateExpression='SET finished = :true, remaining = :zero, expires = :expires',
+            ConditionExpression='attribute_not_exists(finished)',
+            ExpressionAttributeValues={
+                ':true': {'BOOL': True},
+                ':zero': {'N': '0'},
+                ':expires': {'N': str(int(time.time()) + LEDGER_TTL)},
+            },
+            ReturnValues='ALL_OLD',
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return 0
+
+    old = resp.get('Attributes', {})
+    leftover = int(old.get('remaining', {}).get('N', 0))
+    if leftover:
+        increment_dynamodb_counter(-leftover, RESERVED_COUNTER)
 
-    if not _commiters:
-        client = boto3.client('ssm')
-        param_path = os.path.join('/runners/', ssm_repo_name, 'configOverlay')
-        app.log.info("Loading config overlay from %s", param_path)
+    seen = int(old.get('seen', {}).get('N', 0))
+    item = dynamodb.get_item(TableName=LEDGER_TABLE, Key=_fanout_key(repo, workflow)).get('Item')
+    jobs = seen if not item else FANOUT_ALPHA * seen + (1 - FANOUT_ALPHA) * float(item['jobs']['N'])
+    dynamodb.put_item(
+        TableName=LEDGER_TABLE,
+        Item={**_fanout_key(repo, workflow), 'jobs': {'N': f'{jobs:.2f}'}},
+    )
+    return leftover
+
+
+def route_for_labels(labels: List[str]) -> Route:
+    for route in ROUTING_TABLE:
+        if route.labels.issubset(labels):
+            return route
+    return DEFAULT_ROUTE
+
+
+def record_job_transition(
+    job_id: int, state: str, labels: List[str], route: Route = DEFAULT_ROUTE, run_id: Optional[int] = None
+) -> Optional[int]:
+    """
+    Move a job forward to ``state`` in the job ledger, adjusting the queue counter to match
+
+    The ledger item and the counter are updated in a single transaction, conditional on the job's previous
+    state, so the counter is always exactly the number of jobs whose ledger state is ``queued`` no matter
+    how many times (or in what order) GitHub delivers the events. If the job's shard has been emptied
+    some other way, the decrement is taken from the other shards instead, never below zero.
+
+    Returns the change made to the queue length, or ``None`` if the job was already at (or past)
+    ``state``.
+    """
+    dynamodb = aws_client('dynamodb')
+    key = {'id': {'S': f'job#{job_id}'}}
+
+    for _ in range(5):
+        item = dynamodb.get_item(TableName=LEDGER_TABLE, Key=key, ConsistentRead=True).get('Item', {})
+        prev = item.get('state', {}).get('S')
+        if prev and JOB_STATES[prev] >= JOB_STATES[state]:
+            return None
+
+        new_item = {
+            **key,
+            'state': {'S': state},
+            'labels': {'S': json.dumps(labels)},
+            'updated': {'N': str(int(time.time()))},
+            'expires': {'N': str(int(time.time()) + LEDGER_TTL)},
+        }
+        if run_id is not None:
+            new_item['run_id'] = {'N': str(run_id)}
+
+        if prev:
+            condition = {
+                'ConditionExpression': '#state = :prev',
+                'ExpressionAttributeNames': {'#state': 'state'},
+                'ExpressionAttributeValues': {':prev': {'S': prev}},
+            }
+        else:
+            condition = {'ConditionExpression': 'attribute_not_exists(id)'}
+        actions = [{'Put': {'TableName': LEDGER_TABLE, 'Item': new_item, **condition}}]
+
+        delta = 0
+        shard = item.get('shard', {}).get('S')
+        if state == 'queued':
+            delta = 1
+            keys = counter_shard_keys(route.counter)
+            shard = keys[_pick_shard(keys, str(job_id))]
+        elif prev == 'queued':
+            # Take it back off the same shard we added it to, so no shard ever goes below zero
+            delta = -1
+        if shard:
+            new_item['shard'] = {'S': shard}
+
+        if delta:
+            update: Dict[str, Any] = {
+                'TableName': TABLE_NAME,
+                'Key': {'id': {'S': shard}},
+                'UpdateExpression': 'ADD queued :delta',
+                'ExpressionAttributeValues': {':delta': {'N': str(delta)}},
+            }
+            if delta < 0:
+                update['ConditionExpression'] = 'queued >= :limit'
+                update['ExpressionAttributeValues'][':limit'] = {'N': str(-delta)}
+            actions.append({'Update': update})
 
         try:
+            dynamodb.transact_write_items(TransactItems=actions)
+            return delta
+        except dynamodb.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if delta < 0 and reasons[:2] == ['None', 'ConditionalCheckFailed']:
+                # The job's shard is already empty: record the transition on its own, and take the job off
+                # whichever shards still have some
+                try:
+                    dynamodb.put_item(**actions[0]['Put'])
+                except dynamodb.exceptions.ConditionalCheckFailedException:
+                    continue
+                increment_dynamodb_counter(delta, route.counter)
+                return delta
+            # Someone else moved this job on at the same time; look again
+            app.log.debug("Transaction for job %s cancelled, retrying", job_id, exc_info=True)
+
+    raise RuntimeError(f"Unable to record job {job_id} as {state}")
+
+
+def apply_queue_change(
+    delta: int, payload: dict, delivery: Optional[str], groups: Optional['Future[dict]'] = None
+) -> dict:
+    """Add ``delta`` to the queue (once per ``delivery``) and scale for it"""
+    if delta > 0 and groups is None:
+        # The ASGs' state doesn't depend on the counter, so fetch it at the same time
+        groups = prefetch_groups(DEFAULT_ROUTE)
+
+    def count() -> int:
+        queue_length = increment_dynamodb_counter(delta, shard_hint=delivery)
+        if delta > 0:
+            record_arrival(DEFAULT_ROUTE, delta)
+        return queue_length
+
+    def finish(queue_length: Optional[int]) -> dict:
+        result = dict(payload)
+        if queue_length is None:
+            # A retry of a delivery that was counted, but not scaled for
+            queue_length = read_dynamodb_counter()
+        if delta > 0:
+            result.update(**scale_asg_if_needed(queue_length, prefetched=groups))
+        else:
+            # Don't scale in the ASG here -- the scale_in_idle schedule (or the CloudWatch alarm) does that.
+            result['new_queue'] = queue_length
+        return result
+
+    return process_once(delivery, count, finish)
+
+
+def arrival_history(route: Route) -> DynamoDBArrivalHistory:
+    return DynamoDBArrivalHistory(
+        aws_client('dynamodb'), TABLE_NAME, f'arrivals:{route.name}', PREDICTIVE_BUCKET_MINUTES
+    )
+
+
+def record_arrival(route: Route, count: int = 1):
+    if PREDICTIVE_SCALING or WARM_POOL:
+        arrival_history(route).record(time.time(), count)
+
+
+def predictive_scale(event):
+    """Have idle instances ready for the jobs we expect in the next few minutes"""
+    for route in [DEFAULT_ROUTE] + ROUTING_TABLE:
+        expected = arrival_history(route).expected_arrivals(time.time(), PREDICTIVE_LOOKAHEAD_MINUTES)
+        extra = prescale_target(expected, PREDICTIVE_FACTOR, PREDICTIVE_MAX_INSTANCES)
+        if not extra:
+            continue
+        queued = read_dynamodb_counter(route.counter)
+        result = scale_asg_if_needed(queued + extra, route)
+        app.log.info("%s: expecting %d jobs, pre-scaling for %d: %r", route.name, expected, extra, result)
+
+
+# Each schedule is only added when its feature is enabled, so the Lambda isn't invoked just to return
+if PREDICTIVE_SCALING:
+    app.schedule(Rate(5, unit=Rate.MINUTES))(predictive_scale)
+
+
+def size_warm_pools(event):
+    """Keep each ASG's warm pool in proportion to the recent demand"""
+    for route in [DEFAULT_ROUTE] + ROUTING_TABLE:
+        recent = arrival_history(route).recent_arrivals(time.time(), WARM_POOL_WINDOW_MINUTES)
+        size = max(WARM_POOL_MIN_SIZE, min(math.ceil(recent * WARM_POOL_FACTOR), WARM_POOL_MAX_SIZE))
+
+        asg = aws_client('autoscaling', region_name=route.region)
+        config = asg.describe_warm_pool(AutoScalingGroupName=route.asg).get('WarmPoolConfiguration', {})
+        if config.get('MinSize') == size and config.get('PoolState') == WARM_POOL_STATE:
+            continue
+
+        app.log.info(
+            "%s: %d jobs in the last %d minutes, warm pool size %d",
+            route.asg,
+            recent,
+            WARM_POOL_WINDOW_MINUTES,
+            size,
+        )
+        asg.put_warm_pool(AutoScalingGroupName=route.asg, MinSize=size, PoolState=WARM_POOL_STATE)
+
 
-            resp = client.get_parameter(Name=param_path, WithDecryption=True)
-        except client.exceptions.ParameterNotFound:
-            app.log.debug("Failed to load config overlay", exc_info=True)
-            return set()
+if WARM_POOL:
+    app.schedule(Rate(5, unit=Rate.MINUTES))(size_warm_pools)
+
+
+def scale_in_idle(event):
+    """Remove the idle instances we don't need any more"""
+    for route in [DEFAULT_ROUTE] + ROUTING_TABLE:
+        result = scale_in_if_idle(route)
+        if result:
+            app.log.info("%s: scaled in to %r", route.name, result)
+
+
+if SCALE_IN:
+    app.schedule(Rate(1, unit=Rate.MINUTES))(scale_in_idle)
+
+
+def scale_in_target(route: Route) -> int:
+    """How many idle instances ``route`` should keep"""
+    keep = queue_demand(route) + SCALE_IN_WARM_BUFFER
+    if PREDICTIVE_SCALING:
+        expected = arrival_history(route).expected_arrivals(time.time(), PREDICTIVE_LOOKAHEAD_MINUTES)
+        keep += prescale_target(expected, PREDICTIVE_FACTOR, PREDICTIVE_MAX_INSTANCES)
+    return keep
+
+
+def scale_in_if_idle(route: Route) -> Dict[str, int]:
+    """
+    Lower the desired capacity of ``route``'s ASGs by however many idle instances are beyond what it needs
+
+    Only the desired capacity is changed, and overflow groups are shrunk before the primary one. The ASG
+    chooses which instances to remove, never picking busy ones (they are protected from scale in), and
+    each one it does pick goes through the Terminating:Wait lifecycle hook, where the runner-supervisor
+    stops the runner gracefully (so it can't pick up a job) before letting the instance go.
+    """
+    groups = _route_groups(route)
+    infos = group_states(groups)
+    idle = {
+        group: asg_info['DesiredCapacity'] - busy_instances(asg_info) for group, asg_info in infos.items()
+    }
+    excess = sum(idle.values()) - scale_in_target(route)
+
+    result = {}
+    for group in reversed(groups):
+        if excess <= 0:
+            break
+        if group not in infos:
+            continue
+        asg_info = infos[group]
+        remove = min(excess, idle[group], asg_info['DesiredCapacity'] - asg_info['MinSize'])
+        if remove <= 0:
+            continue
+
+        asg_name, region = group
+        new_size = asg_info['DesiredCapacity'] - remove
+        asg = aws_client('autoscaling', region_name=region)
+        try:
+            asg.set_desired_capacity(
+                AutoScalingGroupName=asg_name, DesiredCapacity=new_size, HonorCooldown=False
+            )
+        except asg.exceptions.ScalingActivityInProgressFault as e:
+            app.log.warning("Unable to scale in %s: %s", asg_name, e)
+            continue
+        if FLEET_STATE:
+            record_fleet_capacity(asg_name, new_size)
+        result[asg_name] = new_size
+        excess -= remove
+    return result
+
+
+def reconcile_queue(event):
+    """Correct the queue counters that have drifted from what GitHub says is waiting for a runner"""
+    if QUEUE_SOURCE == 'workflow_job':
+        # The job ledger is the source of truth then: each job is taken off the shard it was added to
+        app.log.warning("Not reconciling the queue: it is counted from the job ledger")
+        return
+
+    if POLICY.has_globs:
+        app.log.warning("Not reconciling the queue: repos configured by a glob can't be listed")
+        return
+
+    github = GitHubAPI(github_token(), GITHUB_API_URL)
+    actual = {route.counter: 0 for route in [DEFAULT_ROUTE] + ROUTING_TABLE}
+    for repo in POLICY.repos():
+        for job in github.queued_jobs(repo):
+            if POLICY.exact[repo].wants_labels(job['labels']):
+                actual[route_for_labels(job['labels']).counter] += 1
+
+    with metrics.invocation():
+        corrections = {counter: reconcile_counter(counter, queued) for counter, queued in actual.items()}
+        metrics.set_dimension('Outcome', 'corrected' if any(corrections.values()) else 'no_change')
+        metrics.count('QueueCorrection', sum(abs(correction) for correction in corrections.values()))
+        metrics.set_property('corrections', corrections)
+    app.log.info("Queued jobs according to GitHub: %r, corrections: %r", actual, corrections)
+
+
+if QUEUE_RECONCILIATION:
+    app.schedule(Rate(5, unit=Rate.MINUTES))(reconcile_queue)
+
+
+def reconcile_counter(counter: str, actual: int) -> int:
+    """
+    Correct ``counter`` towards ``actual``, returning how much it was changed by
+
+    A webhook that is still on its way (or a runner that has started a job but not yet taken it off the
+    counter) makes the counter look wrong for a moment, so only drift that was also there the last time
+    we looked is corrected. The new value is written in one transaction, conditional on none of the
+    shards having changed since we read them.
+    """
+    dynamodb = aws_client('dynamodb')
+    keys = counter_shard_keys(counter)
+    for _ in range(3):
+        resp = dynamodb.batch_get_item(
+            RequestItems={
+                TABLE_NAME: {
+                    'Keys': [{'id': {'S': key}} for key in keys],
+                    'ProjectionExpression': 'id, queued, drift',
+                    'ConsistentRead': True,
+                }
+            }
+        )
+        items = {item['id']['S']: item for item in resp['Responses'].get(TABLE_NAME, [])}
+        seen = {key: int(items.get(key, {}).get('queued', {}).get('N', 0)) for key in keys}
+        previous = int(items.get(keys[0], {}).get('drift', {}).get('N', 0))
+
+        drift = actual - sum(seen.values())
+        correction = 0
+        if drift > 0 and previous > 0:
+            correction = min(drift, previous)
+        elif drift < 0 and previous < 0:
+            correction = max(drift, previous)
+
+        if not correction:
+            dynamodb.update_item(
+                TableName=TABLE_NAME,
+                Key={'id': {'S': keys[0]}},
+                UpdateExpression='SET drift = :drift',
+                ExpressionAttributeValues={':drift': {'N': str(drift)}},
+            )
+            return 0
+
+        # Put the corrected total on the first shard, conditional on every shard being as we saw it
+        actions = []
+        for n, key in enumerate(keys):
+            update: Dict[str, Any] = {
+                'TableName': TABLE_NAME,
+                'Key': {'id': {'S': key}},
+                'UpdateExpression': 'SET queued = :new',
+                'ExpressionAttributeValues': {
+                    ':new': {'N': str(sum(seen.values()) + correction if n == 0 else 0)},
+                    ':seen': {'N': str(seen[key])},
+                },
+                'ConditionExpression': 'queued = :seen',
+            }
+            if not seen[key]:
+                update['ConditionExpression'] = 'attribute_not_exists(queued) OR queued = :seen'
+            if n == 0:
+                update['UpdateExpression'] += ', drift = :drift'
+                update['ExpressionAttributeValues'][':drift'] = {'N': str(drift - correction)}
+            actions.append({'Update': update})
 
         try:
-            overlay = json.loads(resp['Parameter']['Value'])
-        except ValueError:
-            app.log.debug("Failed to parse config overlay", exc_info=True)
-            return set()
+            dynamodb.transact_write_items(TransactItems=actions)
+        except dynamodb.exceptions.TransactionCanceledException:
+            # The counter changed under us, look again
+            continue
+        app.log.warning(
+            "%s was %d, GitHub says %d: corrected by %d", counter, sum(seen.values()), actual, correction
+        )
+        return correction
+    app.log.warning("%s kept changing, not reconciled this time", counter)
+    return 0
+
+
+def github_token() -> str:
+    global GH_API_TOKEN
+    if GH_API_TOKEN is None:
+        if 'GH_API_TOKEN' in os.environ:
+            # Local dev support:
+            GH_API_TOKEN = os.environ['GH_API_TOKEN']
+        else:
+            resp = aws_client('ssm').get_parameter(Name=GH_API_TOKEN_PARAMETER, WithDecryption=True)
+            GH_API_TOKEN = resp['Parameter']['Value']
+    return GH_API_TOKEN
+
+
+def warm_pool_instances(asg_name: str, region: Optional[str]) -> int:
+    """How many instances are waiting in the ASG's warm pool, ready to be started"""
+    asg = aws_client('autoscaling', region_name=region)
+    paginator = asg.get_paginator('describe_warm_pool')
+    return sum(
+        1
+        for page in paginator.paginate(AutoScalingGroupName=asg_name)
+        for instance in page['Instances']
+        if instance['LifecycleState'] in ('Warmed:Stopped', 'Warmed:Hibernated', 'Warmed:Running')
+    )
+
+
+def process_once(
+    delivery: Optional[str], count: Callable[[], int], finish: Callable[[Optional[int]], dict]
+) -> dict:
+    """
+    Call ``count`` then ``finish`` for the first time we see ``delivery``, and return the result
+
+    ``count`` commits the change to the queue and returns its new length, which is passed to ``finish``.
+    Repeated deliveries of the same event return the payload from the first time it was processed, without
+    calling either again. The delivery IDs are remembered in DynamoDB (with an ``expires`` TTL attribute)
+    and, to catch retries that land on the same container, in memory.
+
+    Until the event has been counted the claim is only a DELIVERY_LEASE long lease, so a retry can take
+    over from an attempt that timed out or died. If ``finish`` fails once the event has been counted, the
+    claim is kept (marked ``counted``) so that a retry calls only ``finish`` -- with ``None``, as the queue
+    length will have moved on since.
+    """
+    if not delivery:
+        return finish(count())
+
+    try:
+        return _recent_deliveries[delivery]
+    except KeyError:
+        pass
+
+    dynamodb = aws_client('dynamodb')
+    key = {'id': {'S': f'delivery#{delivery}'}}
+    now = int(time.time())
+    try:
+        dynamodb.put_item(
+            TableName=DELIVERY_TABLE,
+            Item={**key, 'expires': {'N': str(now + DELIVERY_LEASE)}},
+            # The TTL reaper can take a while to delete items, so ignore any that have already expired
+            ConditionExpression='attribute_not_exists(id) OR expires < :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}},
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        item = dynamodb.get_item(TableName=DELIVERY_TABLE, Key=key, ConsistentRead=True).get('Item', {})
+        if 'payload' in item:
+            payload = json.loads(item['payload']['S'])
+        elif 'counted' in item:
+            # Counted by an earlier attempt that failed after that -- don't count it again
+            payload = _finish_delivery(dynamodb, key, finish, None)
+        else:
+            # The first delivery is still being processed. If that fails, its lease runs out before the retry
+            return {'ignored': 'duplicate delivery'}
+        _remember_delivery(delivery, payload)
+        return payload
+
+    try:
+        queue_length = count()
+    except Exception:
+        # Nothing was counted, so let a retry of this delivery have another go
+        dynamodb.delete_item(TableName=DELIVERY_TABLE, Key=key)
+        raise
+
+    dynamodb.update_item(
+        TableName=DELIVERY_TABLE,
+        Key=key,
+        UpdateExpression='SET counted = :counted, expires = :expires',
+        ExpressionAttributeValues={
+            ':counted': {'N': str(queue_length)},
+            ':expires': {'N': str(int(time.time()) + DELIVERY_TTL)},
+        },
+    )
+    payload = _finish_delivery(dynamodb, key, finish, queue_length)
+    _remember_delivery(delivery, payload)
+    return payload
+
+
+def _finish_delivery(
+    dynamodb, key: dict, finish: Callable[[Optional[int]], dict], queue_length: Optional[int]
+):
+    payload = finish(queue_length)
+    dynamodb.update_item(
+        TableName=DELIVERY_TABLE,
+        Key=key,
+        UpdateExpression='SET payload = :payload',
+        ExpressionAttributeValues={':payload': {'S': json.dumps(payload)}},
+    )
+    return payload
+
+
+def _remember_delivery(delivery: str, payload: dict):
+    _recent_deliveries[delivery] = payload
+    while len(_recent_deliveries) > DELIVERY_CACHE_SIZE:
+        _recent_deliveries.popitem(last=False)
+
+
+def aws_client(service_name: str, region_name: Optional[str] = None):
+    """Return the shared boto3 client for ``service_name``, creating it on first use"""
+    key = (service_name, region_name)
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+
+    # boto3's default session isn't thread safe, so make sure only one thread creates clients at a time
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = metrics.instrument(
+                boto3.client(service_name, region_name=region_name, config=AWS_CLIENT_CONFIG)
+            )
+        return _clients[key]
+
+
+class TTLCache:
+    """
+    Cache the result of ``loader`` for ``ttl`` seconds.
+
+    Once the value has expired it is still served for up to ``stale_ttl`` more seconds while a background
+    thread fetches a fresh copy, so only a cold (or very stale) container ever waits on the loader. If the
+    loader returns ``None`` (i.e. "not found") then ``default`` is cached instead, but only for
+    ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, loader, ttl: float, stale_ttl: float, negative_ttl: float, default=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.default = default
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'negative': 0}
+
+        self._value = default
+        self._expires = float('-inf')
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        now = time.monotonic()
+        if now < self._expires:
+            self.stats['hits'] += 1
+            return self._value
+
+        if now < self._expires + self.stale_ttl:
+            self.stats['stale_hits'] += 1
+            self._refresh_in_background()
+            return self._value
+
+        self.stats['misses'] += 1
+        with self._lock:
+            # Another thread might have loaded it while we waited for the lock
+            if time.monotonic() >= self._expires:
+                self._load()
+            return self._value
+
+    def needs_load(self) -> bool:
+        """Would :meth:`get` have to wait for the loader?"""
+        return time.monotonic() >= self._expires + self.stale_ttl
+
+    def invalidate(self):
+        self._expires = float('-inf')
+
+    def _load(self):
+        value = self.loader()
+        if value is None:
+            self.stats['negative'] += 1
+            self._value = self.default
+            self._expires = time.monotonic() + self.negative_ttl
+        else:
+            self._value = value
+            self._expires = time.monotonic() + self.ttl
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    self.stats['refreshes'] += 1
+                    self._load()
+            except Exception:
+                # Keep serving the stale value, and try again on the next call
+                app.log.warning("Failed to refresh cached value", exc_info=True)
+            finally:
+                self._refreshing = False
 
-        _commiters = set(overlay['pullRequestSecurity']['allowedAuthors'])
+        threading.Thread(target=refresh, daemon=True).start()
 
-    return _commiters
+
+def load_commiters(ssm_repo_name: str = SSM_REPO_NAME) -> Optional[FrozenSet[str]]:
+    client = aws_client('ssm')
+    param_path = os.path.join('/runners/', ssm_repo_name, 'configOverlay')
+    app.log.info("Loading config overlay from %s", param_path)
+
+    try:
+
+        resp = client.get_parameter(Name=param_path, WithDecryption=True)
+    except client.exceptions.ParameterNotFound:
+        app.log.debug("Failed to load config overlay", exc_info=True)
+        return None
+
+    try:
+        overlay = json.loads(resp['Parameter']['Value'])
+        return frozenset(overlay['pullRequestSecurity']['allowedAuthors'])
+    except (ValueError, KeyError, TypeError):
+        app.log.debug("Failed to parse config overlay", exc_info=True)
+        return None
+
+
+_commiters = TTLCache(
+    load_commiters,
+    ttl=int(os.getenv('COMMITERS_CACHE_TTL', '300')),
+    stale_ttl=int(os.getenv('COMMITERS_CACHE_STALE_TTL', '3600')),
+    negative_ttl=int(os.getenv('COMMITERS_CACHE_NEGATIVE_TTL', '60')),
+    default=frozenset(),
+)
+
+
+def commiters() -> FrozenSet[str]:
+    return _commiters.get()
 
 
 def validate_gh_sig(request: Request):
@@ -151,18 +1322,65 @@ def sign_request_body(request: Request) -> str:
         else:
             encrypted = os.environb[b'GH_WEBHOOK_TOKEN_ENCRYPTED']
 
-            kms = boto3.client('kms')
+            kms = aws_client('kms')
             response = kms.decrypt(CiphertextBlob=codecs.decode(encrypted, 'base64'))
             GH_WEBHOOK_TOKEN = response['Plaintext']
     body = cast(bytes, request.raw_body)
     return hmac.new(GH_WEBHOOK_TOKEN, body, digestmod='SHA256').hexdigest()  # type: ignore
 
 
-def increment_dynamodb_counter(delta: int = 1) -> int:
-    dynamodb = boto3.client('dynamodb')
+def counter_shard_keys(counter: str = QUEUE_COUNTER, shards: Optional[int] = None) -> List[str]:
+    """
+    The DynamoDB item ids that together hold the value of ``counter``
+
+    Shard 0 keeps the un-sharded name, so that changing ``QUEUE_SHARDS`` doesn't lose the existing count.
+    """
+    if shards is None:
+        shards = QUEUE_SHARDS
+    return [counter] + [f'{counter}#{n}' for n in range(1, shards)]
+
+
+def _pick_shard(keys: List[str], hint: Optional[str]) -> int:
+    if len(keys) == 1:
+        return 0
+    if hint:
+        return zlib.crc32(hint.encode('utf-8')) % len(keys)
+    return random.randrange(len(keys))
+
+
+def read_dynamodb_counter(counter: str = QUEUE_COUNTER) -> int:
+    """Return the total value of ``counter``, summed over all of its shards"""
+    return sum(_read_counter_shards(counter_shard_keys(counter)).values())
+
+
+def _read_counter_shards(keys: List[str]) -> Dict[str, int]:
+    dynamodb = aws_client('dynamodb')
+    request = {
+        TABLE_NAME: {
+            'Keys': [{'id': {'S': key}} for key in keys],
+            'ProjectionExpression': 'id, queued',
+            'ConsistentRead': True,
+        }
+    }
+    values = dict.fromkeys(keys, 0)
+    while request:
+        resp = dynamodb.batch_get_item(RequestItems=request)
+        for item in resp['Responses'].get(TABLE_NAME, []):
+            values[item['id']['S']] = int(item.get('queued', {}).get('N', 0))
+        request = resp.get('UnprocessedKeys')
+    return values
+
+
+def _update_counter_shard(key: str, delta: int) -> Optional[int]:
+    """
+    Add ``delta`` to a single shard, returning the new value of the shard.
+
+    Returns ``None`` if the shard would have gone below zero (and so wasn't changed.)
+    """
+    dynamodb = aws_client('dynamodb')
     args = dict(
         TableName=TABLE_NAME,
-        Key={'id': {'S': 'queued_jobs'}},
+        Key={'id': {'S': key}},
         ExpressionAttributeValues={':delta': {'N': str(delta)}},
         UpdateExpression='ADD queued :delta',
         ReturnValues='UPDATED_NEW',
@@ -173,38 +1391,328 @@ def increment_dynamodb_counter(delta: int = 1) -> int:
         args['ExpressionAttributeValues'][':limit'] = {'N': str(-delta)}
         args['ConditionExpression'] = 'queued >= :limit'
 
-    resp = dynamodb.update_item(**args)
+    try:
+        resp = dynamodb.update_item(**args)
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
     return int(resp['Attributes']['queued']['N'])
 
 
-def scale_asg_if_needed(num_queued_jobs: int) -> dict:
-    asg = boto3.client('autoscaling', region_name=ASG_REGION_NAME)
+def increment_dynamodb_counter(
+    delta: int = 1, counter: str = QUEUE_COUNTER, shard_hint: Optional[str] = None
+) -> int:
+    """
+    Atomically add ``delta`` to the (sharded) ``counter`` and return its new total
+
+    The shard to update is picked from a hash of ``shard_hint`` (or at random) so that concurrent updates
+    are spread over several DynamoDB items rather than all contending for one. A negative delta will
+    never take the total below zero.
+    """
+    keys = counter_shard_keys(counter)
+    idx = _pick_shard(keys, shard_hint)
+
+    # Common case: the chosen shard is big enough, so this is a single write
+    value = _update_counter_shard(keys[idx], delta)
+    if value is not None:
+        if len(keys) == 1:
+            return value
+        return read_dynamodb_counter(counter)
+
+    # Decrement, and the chosen shard didn't have enough in it. Take what we need from the others instead
+    remaining = -delta
+    for _ in range(3):
+        shards = _read_counter_shards(keys)
+        for key, available in shards.items():
+            take = min(available, remaining)
+            if take and _update_counter_shard(key, -take) is not None:
+                remaining -= take
+            if not remaining:
+                break
+        if not remaining or not any(shards.values()):
+            break
+
+    if remaining:
+        app.log.warning("%s.%s was already 0, we won't decrease it any further!", TABLE_NAME, counter)
+    return read_dynamodb_counter(counter)
+
+
+def scale_asg_if_needed(
+    num_queued_jobs: int, route: Route = DEFAULT_ROUTE, prefetched: Optional['Future[dict]'] = None
+) -> dict:
+    """
+    Make sure there is enough capacity in ``route``'s ASG (and if needed, its overflow ASGs) for the jobs
+
+    Capacity is only ever added here, never removed. Demand that doesn't fit in the primary group (because
+    it is at MaxSize, or is busy with another scaling activity) spills over to the overflow groups in
+    priority order, skipping any that have recently failed to launch instances. ``prefetched`` is the
+    (already started) :func:`prefetch_groups` for ``route``, if the caller has one.
+    """
+    groups = _route_groups(route)
+    infos = prefetched.result() if prefetched else group_states(groups)
+    states = []
+    for asg_name, region in groups:
+        if (asg_name, region) in infos:
+            info = infos[asg_name, region]
+            states.append(
+                GroupState(asg_name, region, info['DesiredCapacity'], info['MaxSize'], busy_instances(info))
+            )
+    inputs = list(states)
 
-    resp = asg.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[ASG_GROUP_NAME],
+    app.log.info(
+        "%s: Busy instances: %d, num_queued_jobs: %d, current_size: %d",
+        route.asg,
+        states[0].busy,
+        num_queued_jobs,
+        states[0].desired,
     )
 
-    asg_info = resp['AutoScalingGroups'][0]
+    planned = decision = decide(num_queued_jobs, states)
+    if decision.needed <= 0:
+        result: Dict[str, Any] = {'idle_instances': True}
+        audit_decision(route, num_queued_jobs, inputs, planned, result)
+        return result
 
-    current = asg_info['DesiredCapacity']
-    max_size = asg_info['MaxSize']
+    result = {}
+    placements = []
+    # Apply the first change, and then decide again from the groups' new state -- so demand that a group
+    # can't take after all (it's busy with another scaling activity, or has recently failed to launch
+    # instances) spills over to the next group in priority order
+    while decision.changes:
+        n, new_size = decision.changes[0]
+        state = states[n]
+        group = (state.asg, state.region)
+        if n > 0 and _recently_failed(*group):
+            states[n] = state._replace(available=False)
+            decision = decide(num_queued_jobs, states)
+            continue
 
-    busy = 0
-    for instance in asg_info['Instances']:
-        if instance['LifecycleState'] == 'InService' and instance['ProtectedFromScaleIn']:
-            busy += 1
-    app.log.info("Busy instances: %d, num_queued_jobs: %d, current_size: %d", busy, num_queued_jobs, current)
+        asg = aws_client('autoscaling', region_name=state.region)
+        try:
+            asg.set_desired_capacity(AutoScalingGroupName=state.asg, DesiredCapacity=new_size)
+        except asg.exceptions.ClientError as e:
+            if n == 0 and not isinstance(e, asg.exceptions.ScalingActivityInProgressFault):
+                raise
+            # An overflow group we can't scale (missing, or not allowed by the IAM policy, say) is as good
+            # as one that failed to launch: give it a rest, and spill over to the next one
+            app.log.warning("Unable to scale %s: %s", state.asg, e)
+            if n == 0:
+                result['error'] = str(e)
+            else:
+                _overflow_cooldown[group] = time.monotonic() + OVERFLOW_COOLDOWN
+            states[n] = state._replace(available=False)
+            decision = decide(num_queued_jobs, states)
+            continue
 
-    new_size = num_queued_jobs + busy
-    if new_size > current:
-        if new_size <= max_size or current < max_size:
-            try:
-                new_size = min(new_size, max_size)
-                asg.set_desired_capacity(AutoScalingGroupName=ASG_GROUP_NAME, DesiredCapacity=new_size)
-                return {'new_capcity': new_size}
-            except asg.exceptions.ScalingActivityInProgressFault as e:
-                return {'error': str(e)}
+        placements.append(group)
+        if FLEET_STATE:
+            record_fleet_capacity(state.asg, new_size)
+        if n == 0:
+            result['new_capcity'] = new_size
+            if WARM_POOL and has_warm_pool(infos[group]):
+                # The ASG takes instances from the warm pool first, and only launches the rest from scratch
+                added = new_size - state.desired
+                result['from_warm_pool'] = min(added, warm_pool_instances(state.asg, state.region))
+                result['cold_starts'] = added - result['from_warm_pool']
         else:
-            return {'capacity_at_max': True}
+            result.setdefault('overflow', []).append(
+                {'asg': state.asg, 'region': state.region, 'new_capacity': new_size}
+            )
+        states[n] = state._replace(desired=new_size)
+        decision = decide(num_queued_jobs, states)
+
+    if decision.needed > 0 and not placements and 'error' not in result:
+        result['capacity_at_max'] = True
+    elif decision.needed > 0 and placements:
+        result['unplaced'] = decision.needed
+    audit_decision(route, num_queued_jobs, inputs, planned, result)
+    return result
+
+
+def audit_decision(
+    route: Route, num_queued_jobs: int, inputs: List[GroupState], planned: Decision, result: dict
+):
+    """Record a scale-out decision, for :mod:`chalicelib.audit` to replay"""
+    if not AUDIT_LOG and not AUDIT_TABLE:
+        return
+    delivery = metrics.properties.get('delivery')
+    record = decision_record(
+        route.name,
+        num_queued_jobs,
+        inputs,
+        planned,
+        result,
+        deliveries=metrics.properties.get('deliveries') or ([delivery] if delivery else []),
+        timings=metrics.timings,
+    )
+    if AUDIT_LOG:
+        write_line(format_record(record))
+    if AUDIT_TABLE:
+        try:
+            aws_client('dynamodb').put_item(TableName=AUDIT_TABLE, Item=table_item(record, AUDIT_TTL))
+        except Exception:
+            # Losing an audit record mustn't fail the scaling it describes
+            app.log.warning("Unable to write audit record", exc_info=True)
+
+
+def _route_groups(route: Route) -> List[Tuple[str, Optional[str]]]:
+    return [(route.asg, route.region)] + list(route.overflow)
+
+
+def prefetch_groups(route: Route) -> 'Future[dict]':
+    """Start describing ``route``'s ASGs, for a :func:`scale_asg_if_needed` call we expect to make"""
+    return run_concurrently(group_states, _route_groups(route))
+
+
+def run_concurrently(fn: Callable, *args) -> Future:
+    """Call ``fn`` on the AWS call thread pool (or right now, if AWS_CALL_CONCURRENCY is 0)"""
+    if AWS_CALL_CONCURRENCY:
+        return _executor.submit(fn, *args)
+    future: Future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def group_states(groups: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], dict]:
+    """The DesiredCapacity, MaxSize and busy instances of each ASG, from the fleet state if it is enabled"""
+    if FLEET_STATE:
+        return _fleet_groups(groups)
+    return _describe_groups(groups)
+
+
+def busy_instances(asg_info: dict) -> int:
+    if 'Busy' in asg_info:
+        return asg_info['Busy']
+    return sum(
+        1
+        for instance in asg_info['Instances']
+        if instance['LifecycleState'] == 'InService' and instance['ProtectedFromScaleIn']
+    )
+
+
+def has_warm_pool(asg_info: dict) -> bool:
+    if 'WarmPool' in asg_info:
+        return asg_info['WarmPool']
+    return 'WarmPoolConfiguration' in asg_info
+
+
+def _fleet_key(asg_name: str) -> dict:
+    return {'id': {'S': f'fleet#{asg_name}'}}
+
+
+def _fleet_groups(groups: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], dict]:
+    """
+    Read the ASGs' state from their fleet items, describing (and reconciling) any that are out of date
+
+    The runner-supervisors keep ``busy`` up to date as they protect and unprotect themselves, and we keep
+    ``desired`` up to date when we scale. Anything else changing the ASG (the scale-in alarm, an instance
+    that died while busy) is picked up when the item is next reconciled.
+    """
+    dynamodb = aws_client('dynamodb')
+    request = {TABLE_NAME: {'Keys': [_fleet_key(asg_name) for asg_name, _ in groups], 'ConsistentRead': True}}
+    items = {}
+    while request:
+        resp = dynamodb.batch_get_item(RequestItems=request)
+        for item in resp['Responses'].get(TABLE_NAME, []):
+            items[item['id']['S']] = item
+        request = resp.get('UnprocessedKeys')
+
+    infos = {}
+    stale = []
+    now = int(time.time())
+    for group in groups:
+        item = items.get(_fleet_key(group[0])['id']['S'])
+        if not item or now - int(item.get('reconciled', {}).get('N', 0)) > FLEET_RECONCILE_SECONDS:
+            stale.append(group)
+            continue
+        infos[group] = {
+            'AutoScalingGroupName': group[0],
+            'DesiredCapacity': int(item['desired']['N']),
+            'MaxSize': int(item['max_size']['N']),
+            'MinSize': int(item.get('min_size', {}).get('N', 0)),
+            'Busy': max(0, int(item.get('busy', {}).get('N', 0))),
+            'WarmPool': item.get('warm_pool', {}).get('BOOL', False),
+        }
+
+    if stale:
+        for group, asg_info in _describe_groups(stale).items():
+            item = items.get(_fleet_key(group[0])['id']['S'], {})
+            _reconcile_fleet(group[0], asg_info, item.get('version', {}).get('N'))
+            infos[group] = asg_info
+    return infos
+
+
+def _reconcile_fleet(asg_name: str, asg_info: dict, version: Optional[str]):
+    """Overwrite the fleet item with what DescribeAutoScalingGroups says, unless a supervisor beat us to it"""
+    dynamodb = aws_client('dynamodb')
+    values = {
+        ':busy': {'N': str(busy_instances(asg_info))},
+        ':desired': {'N': str(asg_info['DesiredCapacity'])},
+        ':max': {'N': str(asg_info['MaxSize'])},
+        ':min': {'N': str(asg_info['MinSize'])},
+        ':now': {'N': str(int(time.time()))},
+        ':one': {'N': '1'},
+        ':warm_pool': {'BOOL': has_warm_pool(asg_info)},
+    }
+    if version is None:
+        condition = 'attribute_not_exists(version)'
     else:
-        return {'idle_instances': True}
+        condition = 'version = :version'
+        values[':version'] = {'N': version}
+    try:
+        dynamodb.update_item(
+            TableName=TABLE_NAME,
+            Key=_fleet_key(asg_name),
+            UpdateExpression='SET busy = :busy, desired = :desired, max_size = :max, min_size = :min, '
+            'warm_pool = :warm_pool, reconciled = :now ADD version :one',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        # An instance changed state since we read the item, so the busy count we have might be out of date
+        # already. Try again next time
+        app.log.info("Fleet state for %s changed while reconciling it", asg_name)
+
+
+def record_fleet_capacity(asg_name: str, desired: int):
+    aws_client('dynamodb').update_item(
+        TableName=TABLE_NAME,
+        Key=_fleet_key(asg_name),
+        # If there's no item yet this creates one without ``reconciled``, so it is reconciled next time
+        UpdateExpression='SET desired = :desired',
+        ExpressionAttributeValues={':desired': {'N': str(desired)}},
+    )
+
+
+def _describe_groups(groups: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], dict]:
+    """Describe the ASGs, making one call per region"""
+    by_region: Dict[Optional[str], List[str]] = {}
+    for asg_name, region in groups:
+        by_region.setdefault(region, []).append(asg_name)
+
+    infos = {}
+    for region, names in by_region.items():
+        asg = aws_client('autoscaling', region_name=region)
+        resp = asg.describe_auto_scaling_groups(AutoScalingGroupNames=names)
+        for asg_info in resp['AutoScalingGroups']:
+            infos[(asg_info['AutoScalingGroupName'], region)] = asg_info
+    return infos
+
+
+def _recently_failed(asg_name: str, region: Optional[str]) -> bool:
+    """Has this (overflow) ASG been unable to scale, or failed to launch instances, recently?"""
+    group = (asg_name, region)
+    if _overflow_cooldown.get(group, 0) > time.monotonic():
+        return True
+
+    asg = aws_client('autoscaling', region_name=region)
+    resp = asg.describe_scaling_activities(AutoScalingGroupName=asg_name, MaxRecords=10)
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=OVERFLOW_COOLDOWN)
+    for activity in resp['Activities']:
+        if activity['StatusCode'] == 'Failed' and activity['StartTime'] >= since:
+            app.log.info("Skipping %s: %s", asg_name, activity.get('StatusMessage', activity['StatusCode']))
+            _overflow_cooldown[group] = time.monotonic() + OVERFLOW_COOLDOWN
+            return True
+    return False
@@ -0,0 +1,199 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+An append-only record of every scale-out decision, and a tool to replay them
+
+``app.scale_asg_if_needed`` writes one compact JSON line per decision to the log (and, optionally, to a
+DynamoDB table with a TTL): the queue length and the state of each group that
+:func:`chalicelib.scaling.decide` was given, the changes it planned, what actually happened, the
+delivery(s) that caused it and how long the AWS calls took.
+
+Run as a script, a day of these records (exported from CloudWatch Logs, or read back from the table) is
+replayed through the current decision and an alternative one, to check a policy change against real
+traffic before it is deployed::
+
+    python -m chalicelib.audit decisions.log --decide mymodule:decide
+    python -m chalicelib.audit --table GithubRunnerQueue --since 2021-04-01 --decide mymodule:decide
+
+The alternative is any function with the same signature as :func:`chalicelib.scaling.decide`.
+"""
+import argparse
+import importlib
+import json
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from chalicelib.forecast import parse_time
+from chalicelib.scaling import Decision, GroupState, decide
+
+KIND = 'scale_out'
+ID_PREFIX = 'audit#'
+
+DecideFunction = Callable[[int, Sequence[GroupState]], Decision]
+
+
+def decision_record(
+    route: str,
+    queued: int,
+    groups: Sequence[GroupState],
+    decision: Decision,
+    result: dict,
+    deliveries: Sequence[str] = (),
+    timings: Optional[Dict[str, float]] = None,
+) -> dict:
+    return {
+        'audit': KIND,
+        'ts': round(time.time(), 3),
+        'route': route,
+        'deliveries': list(deliveries),
+        'queued': queued,
+        # The decision's inputs, as [asg, region, desired, max_size, busy] (every group starts available)
+        'groups': [list(group[:5]) for group in groups],
+        'changes': [list(change) for change in decision.changes],
+        'result': result,
+        'timings': {name: round(value, 3) for name, value in (timings or {}).items()},
+    }
+
+
+def format_record(record: dict) -> str:
+    return json.dumps(record, separators=(',', ':'), default=str)
+
+
+def table_item(record: dict, ttl: int) -> dict:
+    key = record['deliveries'][0] if record['deliveries'] else uuid.uuid4().hex
+    return {
+        'id': {'S': f"{ID_PREFIX}{record['route']}#{int(record['ts'] * 1000)}#{key}"},
+        'record': {'S': format_record(record)},
+        'expires': {'N': str(int(record['ts']) + ttl)},
+    }
+
+
+def read_log(lines: Iterable[str]) -> Iterator[dict]:
+    """The audit records in ``lines``, ignoring anything else (and any timestamp/request id prefix)"""
+    for line in lines:
+        start = line.find('{')
+        if start < 0 or f'"audit":"{KIND}"' not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if record.get('audit') == KIND:
+            yield record
+
+
+def read_table(dynamodb, table: str) -> Iterator[dict]:
+    kwargs: Dict[str, Any] = {
+        'TableName': table,
+        'FilterExpression': 'begins_with(id, :prefix)',
+        'ExpressionAttributeValues': {':prefix': {'S': ID_PREFIX}},
+    }
+    while True:
+        page = dynamodb.scan(**kwargs)
+        for item in page['Items']:
+            yield json.loads(item['record']['S'])
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def load_function(spec: str) -> DecideFunction:
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name or 'decide')
+
+
+def _added(decision: Decision, groups: Sequence[GroupState]) -> int:
+    return sum(size - groups[n].desired for n, size in decision.changes)
+
+
+def replay(
+    records: Iterable[dict], alternative: DecideFunction, baseline: DecideFunction = decide, show: int = 20
+) -> dict:
+    """Compare what ``baseline`` and ``alternative`` decide for each recorded set of inputs"""
+    totals = {
+        name: {'scale_outs': 0, 'instances_added': 0, 'unplaced': 0} for name in ('baseline', 'alternative')
+    }
+    report: Dict[str, Any] = {'records': 0, 'changed': 0, 'not_as_recorded': 0, **totals, 'differences': []}
+    for record in sorted(records, key=lambda record: record['ts']):
+        groups = [GroupState(*group) for group in record['groups']]
+        decisions = {
+            'baseline': baseline(record['queued'], groups),
+            'alternative': alternative(record['queued'], groups),
+        }
+        report['records'] += 1
+        for name, decision in decisions.items():
+            report[name]['scale_outs'] += bool(decision.changes)
+            report[name]['instances_added'] += _added(decision, groups)
+            report[name]['unplaced'] += decision.unplaced
+
+        # The baseline isn't the code that made the recorded decision
+        planned = [tuple(change) for change in record['changes']]
+        report['not_as_recorded'] += list(decisions['baseline'].changes) != planned
+
+        base, alt = decisions['baseline'], decisions['alternative']
+        if (base.changes, base.unplaced) != (alt.changes, alt.unplaced):
+            report['changed'] += 1
+            if len(report['differences']) < show:
+                report['differences'].append(
+                    {
+                        'ts': record['ts'],
+                        'route': record['route'],
+                        'deliveries': record['deliveries'],
+                        'queued': record['queued'],
+                        'groups': record['groups'],
+                        'baseline': [list(change) for change in base.changes],
+                        'alternative': [list(change) for change in alt.changes],
+                    }
+                )
+    return report
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay recorded scale-out decisions through another policy")
+    parser.add_argument('log', nargs='?', type=argparse.FileType('r'), help="Log lines holding audit records")
+    parser.add_argument('--table', help="Read the records from this DynamoDB table instead")
+    parser.add_argument('--decide', required=True, help="The alternative decision, as module:function")
+    parser.add_argument('--baseline', default='chalicelib.scaling:decide')
+    parser.add_argument('--since', type=parse_time)
+    parser.add_argument('--until', type=parse_time)
+    parser.add_argument('--show', type=int, default=20, help="How many differing decisions to list")
+    args = parser.parse_args(argv)
+
+    if args.table:
+        import boto3
+
+        records: Iterable[dict] = read_table(boto3.client('dynamodb'), args.table)
+    elif args.log:
+        records = read_log(args.log)
+    else:
+        parser.error("either a log file or --table is required")
+
+    records = [
+        record
+        for record in records
+        if (args.since is None or record['ts'] >= args.since)
+        and (args.until is None or record['ts'] < args.until)
+    ]
+    report = replay(records, load_function(args.decide), load_function(args.baseline), args.show)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Predict bursts of queued jobs from when they arrived last week
+
+Job arrivals are counted in a ring buffer of ``bucket_minutes`` wide buckets that covers exactly one
+week. The bucket we are about to write to still holds the count from the same time last week, so
+"what is about to happen" is a read of the next few buckets -- which captures the weekday push peaks
+without keeping any more history than that.
+
+This can also be run as a script to backtest the reactive and predictive scaling against a file of
+historic arrival times (one ISO-8601 timestamp or unix epoch per line)::
+
+    python -m chalicelib.forecast arrivals.txt --boot-minutes 5 --job-minutes 40
+"""
+import abc
+import argparse
+import datetime
+import json
+import math
+import statistics
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+WEEK_MINUTES = 7 * 24 * 60
+
+
+class ArrivalHistory(abc.ABC):
+    """A one week ring buffer of job arrival counts"""
+
+    def __init__(self, bucket_minutes: int = 15):
+        if WEEK_MINUTES % bucket_minutes:
+            raise ValueError("bucket_minutes must divide a week exactly")
+        self.bucket_minutes = bucket_minutes
+        self.slots = WEEK_MINUTES // bucket_minutes
+
+    def bucket_start(self, when: float) -> int:
+        """The start (in minutes since the epoch) of the bucket that ``when`` falls in"""
+        minute = int(when // 60)
+        return minute - minute % self.bucket_minutes
+
+    def slot(self, bucket_start: int) -> int:
+        return (bucket_start // self.bucket_minutes) % self.slots
+
+    def record(self, when: float, count: int = 1):
+        self._add(self.bucket_start(when), count)
+
+    def expected_arrivals(self, now: float, lookahead_minutes: int) -> int:
+        """How many jobs arrived in the ``lookahead_minutes`` after this time last week"""
+        first = self.bucket_start(now)
+        starts = range(first, int(now // 60) + lookahead_minutes + 1, self.bucket_minutes)
+        buckets = self._load([self.slot(start) for start in starts])
+
+        total = 0
+        for start in starts:
+            last_week = buckets.get(self.slot(start))
+            # Skip buckets that haven't been written to for more than a week -- they aren't last week's
+            if last_week and last_week[0] == start - WEEK_MINUTES:
+                total += last_week[1]
+        return total
+
+    def recent_arrivals(self, now: float, window_minutes: int) -> int:
+        """How many jobs arrived in (roughly) the last ``window_minutes``"""
+        last = self.bucket_start(now)
+        starts = range(last, int(now // 60) - window_minutes, -self.bucket_minutes)
+        buckets = self._load([self.slot(start) for start in starts])
+        return sum(n for start, n in buckets.values() if start in starts)
+
+    @abc.abstractmethod
+    def _add(self, bucket_start: int, count: int):
+        ...
+
+    @abc.abstractmethod
+    def _load(self, slots: List[int]) -> Dict[int, Tuple[int, int]]:
+        """Return ``{slot: (bucket_start, count)}`` for the slots that have been written to"""
+
+
+class MemoryArrivalHistory(ArrivalHistory):
+    def __init__(self, bucket_minutes: int = 15):
+        super().__init__(bucket_minutes)
+        self.buckets: Dict[int, Tuple[int, int]] = {}
+
+    def _add(self, bucket_start: int, count: int):
+        slot = self.slot(bucket_start)
+        start, n = self.buckets.get(slot, (bucket_start, 0))
+        if start != bucket_start:
+            n = 0
+        self.buckets[slot] = (bucket_start, n + count)
+
+    def _load(self, slots: List[int]) -> Dict[int, Tuple[int, int]]:
+        return {slot: self.buckets[slot] for slot in slots if slot in self.buckets}
+
+
+class DynamoDBArrivalHistory(ArrivalHistory):
+    """
+    Store the ring buffer as one DynamoDB item per bucket
+
+    Each item holds the bucket's start minute along with its count, and the first write to a bucket in a
+    new week resets the count. Recording an arrival is a single conditional write in the common case.
+    """
+
+    def __init__(self, client, table_name: str, prefix: str, bucket_minutes: int = 15):
+        super().__init__(bucket_minutes)
+        self.client = client
+        self.table_name = table_name
+        self.prefix = prefix
+
+    def _key(self, slot: int) -> dict:
+        return {'id': {'S': f'{self.prefix}#{slot}'}}
+
+    def _add(self, bucket_start: int, count: int):
+        key = self._key(self.slot(bucket_start))
+        values = {':start': {'N': str(bucket_start)}, ':n': {'N': str(count)}}
+        conflict = self.client.exceptions.ConditionalCheckFailedException
+
+        for _ in range(3):
+            try:
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key=key,
+                    UpdateExpression='ADD n :n',
+                    ConditionExpression='bucket_start = :start',
+                    ExpressionAttributeValues=values,
+                )
+                return
+            except conflict:
+                pass
+
+            # First arrival in this bucket this week: replace last week's count
+            try:
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key=key,
+                    UpdateExpression='SET bucket_start = :start, n = :n',
+                    ConditionExpression='attribute_not_exists(bucket_start) OR bucket_start < :start',
+                    ExpressionAttributeValues=values,
+                )
+                return
+            except conflict:
+                # Someone else started the bucket first, so add to theirs
+                pass
+
+    def _load(self, slots: List[int]) -> Dict[int, Tuple[int, int]]:
+        keys = {self._key(slot)['id']['S']: slot for slot in slots}
+        request = {
+            self.table_name: {
+                'Keys': [{'id': {'S': key}} for key in keys],
+                'ProjectionExpression': 'id, bucket_start, n',
+            }
+        }
+        buckets = {}
+        while request:
+            resp = self.client.batch_get_item(RequestItems=request)
+            for item in resp['Responses'].get(self.table_name, []):
+                buckets[keys[item['id']['S']]] = (int(item['bucket_start']['N']), int(item['n']['N']))
+            request = resp.get('UnprocessedKeys')
+        return buckets
+
+
+def prescale_target(expected_arrivals: int, factor: float, max_instances: int) -> int:
+    """How many idle instances to have ready for the expected arrivals, within the cost ceiling"""
+    return min(math.ceil(expected_arrivals * factor), max_instances)
+
+
+def backtest(
+    arrivals: Iterable[float],
+    boot_minutes: int = 5,
+    job_minutes: int = 40,
+    idle_minutes: int = 10,
+    bucket_minutes: int = 15,
+    lookahead_minutes: int = 30,
+    factor: float = 0.5,
+    max_instances: int = 10,
+    predictive: bool = True,
+) -> dict:
+    """
+    Simulate scaling for the given job arrival times, minute by minute
+
+    Every job takes ``job_minutes`` once it gets an instance, instances take ``boot_minutes`` to be
+    ready, and idle instances are scaled in after ``idle_minutes`` (like the CloudWatch alarm does).
+    The simulation runs until the queue is empty, giving up a week after the last job would have finished;
+    any jobs still queued then are reported as ``unserved``.
+    """
+    per_minute: Dict[int, int] = {}
+    for when in arrivals:
+        per_minute[int(when // 60)] = per_minute.get(int(when // 60), 0) + 1
+    if not per_minute:
+        raise ValueError("No arrivals to replay")
+
+    history = MemoryArrivalHistory(bucket_minutes)
+    # Each instance is [ready_at, busy_until]
+    instances: List[List[int]] = []
+    queue: List[int] = []
+    waits: List[int] = []
+    idle_instance_minutes = 0
+    peak = 0
+
+    first, last = min(per_minute), max(per_minute)
+    end = last + job_minutes
+    minute = first - 1
+    while minute < end or (queue and minute < end + WEEK_MINUTES):
+        minute += 1
+        arrived = per_minute.get(minute, 0)
+        queue.extend([minute] * arrived)
+        if arrived:
+            history.record(minute * 60, arrived)
+
+        busy = sum(1 for i in instances if i[1] > minute)
+        target = busy + len(queue)
+        if predictive:
+            expected = history.expected_arrivals(minute * 60, lookahead_minutes)
+            target += prescale_target(expected, factor, max_instances)
+        for _ in range(target - len(instances)):
+            instances.append([minute + boot_minutes, 0])
+
+        for instance in instances:
+            if queue and instance[0] <= minute and instance[1] <= minute:
+                waits.append(minute - queue.pop(0))
+                instance[1] = minute + job_minutes
+
+        idle = [i for i in instances if i[0] <= minute and i[1] <= minute]
+        idle_instance_minutes += len(idle)
+        # Scale in idle instances beyond what we want to keep around
+        surplus = len(instances) - target
+        for instance in idle:
+            if surplus <= 0:
+                break
+            if minute - max(instance) >= idle_minutes:
+                instances.remove(instance)
+                surplus -= 1
+        peak = max(peak, len(instances))
+
+    waits.sort()
+    return {
+        'jobs': len(waits),
+        'unserved': len(queue),
+        'queue_wait_minutes': sum(waits),
+        'mean_wait': statistics.mean(waits) if waits else 0,
+        'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0,
+        'idle_instance_minutes': idle_instance_minutes,
+        'peak_instances': peak,
+    }
+
+
+def parse_time(value: str) -> float:
+    """A unix epoch, or an ISO-8601 timestamp (with a trailing ``Z`` for UTC), as seconds since the epoch"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Backtest predictive scaling against historic arrivals")
+    parser.add_argument('arrivals', type=argparse.FileType('r'), help="One arrival time per line")
+    parser.add_argument('--boot-minutes', type=int, default=5)
+    parser.add_argument('--job-minutes', type=int, default=40)
+    parser.add_argument('--idle-minutes', type=int, default=10)
+    parser.add_argument('--bucket-minutes', type=int, default=15)
+    parser.add_argument('--lookahead-minutes', type=int, default=30)
+    parser.add_argument('--factor', type=float, default=0.5)
+    parser.add_argument('--max-instances', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    arrivals = sorted(parse_time(line.strip()) for line in args.arrivals if line.strip())
+    options = vars(args)
+    del options['arrivals']
+
+    report = {
+        'reactive': backtest(arrivals, predictive=False, **options),
+        'predictive': backtest(arrivals, predictive=True, **options),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+A minimal (urllib based) client for the parts of the GitHub REST API we need to reconcile the queue
+
+Kept dependency free so the Lambda bundle doesn't grow.
+"""
+import json
+import re
+import urllib.parse
+import urllib.request
+from typing import Iterator, List, Optional
+
+_NEXT_LINK = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+class GitHubAPI:
+    def __init__(self, token: str, base_url: str = 'https://api.github.com', timeout: float = 10):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def pages(self, path: str, **params) -> Iterator[dict]:
+        """Yield each page of a (paginated) GET request, following the ``Link: rel="next"`` headers"""
+        url: Optional[str] = f'{self.base_url}{path}?{urllib.parse.urlencode({"per_page": 100, **params})}'
+        while url:
+            request = urllib.request.Request(
+                url,
+                headers={
+                    'Accept': 'application/vnd.github+json',
+                    'Authorization': f'Bearer {self.token}',
+                    'X-GitHub-Api-Version': '2022-11-28',
+                },
+            )
+            with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+                yield json.load(resp)
+                match = _NEXT_LINK.search(resp.headers.get('Link', ''))
+            url = match.group(1) if match else None
+
+    def queued_jobs(self, repo: str) -> List[dict]:
+        """
+        The jobs in ``repo`` that are waiting for a runner
+
+        Runs that are already in progress can still have jobs waiting (a matrix bigger than the runners
+        available, say), so both queued and in progress runs are checked.
+        """
+        jobs = []
+        # A run can move from queued to in progress between the two listings
+        seen = set()
+        for status in ('queued', 'in_progress'):
+            for page in self.pages(f'/repos/{repo}/actions/runs', status=status):
+                for run in page['workflow_runs']:
+                    if run['id'] in seen:
+                        continue
+                    seen.add(run['id'])
+                    for jobs_page in self.pages(f'/repos/{repo}/actions/runs/{run["id"]}/jobs'):
+                        jobs.extend(job for job in jobs_page['jobs'] if job['status'] == 'queued')
+        return jobs
@@ -0,0 +1,160 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Which repos, branches, senders and runner labels we provide self-hosted runners for
+
+The configuration (the ``REPOS`` environment variable) maps each repo -- or a glob of repos, such as
+``apache/*`` -- to either a list of branches, or to a dict of rules::
+
+    {
+        "apache/airflow": {
+            "branches": ["main", "v2-*-test"],
+            "senders": ["ashb"],
+            "labels": ["airflow-runner"],
+            "commiters": true
+        }
+    }
+
+Branch and repo patterns can use ``*`` (any run of characters) and ``?`` (any one character). A run uses
+self-hosted runners if its branch matches, its sender is in ``senders``, or (unless ``commiters`` is
+false) its sender is a committer. A workflow_job is ours if it asks for one of ``labels``.
+
+The configuration is compiled once per container: the literal branches of each repo in to a set and its
+patterns in to one regex, and all the repo globs in to one regex (whose result is remembered for each
+repo). Deciding on an event is then a couple of dict lookups and at most one regex match, however many
+rules there are.
+"""
+import re
+from typing import Any, Callable, Collection, Dict, Iterable, List, Mapping, NamedTuple, Optional
+
+_GLOB_CHARS = re.compile(r'[*?]')
+# How many repo names to remember the matching glob for
+MATCH_CACHE_SIZE = 1024
+
+
+def _is_glob(pattern: str) -> bool:
+    return _GLOB_CHARS.search(pattern) is not None
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate ``*`` and ``?``, without introducing any groups of our own (unlike fnmatch.translate)"""
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+
+
+class Decision(NamedTuple):
+    # Whether the repo is in the configuration at all
+    configured: bool
+    use_self_hosted: bool
+    # Which rule decided it
+    reason: str
+
+
+class RepoPolicy:
+    __slots__ = ('branches', 'branch_pattern', 'senders', 'labels', 'use_commiters')
+
+    def __init__(self, rules: Any, default_labels: Iterable[str]):
+        if not isinstance(rules, Mapping):
+            # The original format: just a list of branches
+            rules = {'branches': rules}
+
+        patterns = rules.get('branches', ())
+        self.branches = frozenset(p for p in patterns if not _is_glob(p))
+        globs = [_glob_to_regex(p) for p in patterns if _is_glob(p)]
+        self.branch_pattern = re.compile('|'.join(globs), re.DOTALL) if globs else None
+        self.senders = frozenset(rules.get('senders', ()))
+        self.labels = frozenset(rules.get('labels', default_labels))
+        self.use_commiters = bool(rules.get('commiters', True))
+
+    def matches_branch(self, branch: Optional[str]) -> bool:
+        if branch is None:
+            return False
+        if branch in self.branches:
+            return True
+        return self.branch_pattern is not None and self.branch_pattern.fullmatch(branch) is not None
+
+    def wants_labels(self, labels: Iterable[str]) -> bool:
+        return not self.labels.isdisjoint(labels)
+
+
+class Policy:
+    def __init__(self, config: Mapping[str, Any], default_labels: Iterable[str]):
+        default_labels = frozenset(default_labels)
+        self.exact: Dict[str, RepoPolicy] = {}
+        self._globs: List[RepoPolicy] = []
+        patterns = []
+        for repo, rules in config.items():
+            policy = RepoPolicy(rules, default_labels)
+            if _is_glob(repo):
+                patterns.append(f'(?P<r{len(self._globs)}>{_glob_to_regex(repo)})')
+                self._globs.append(policy)
+            else:
+                self.exact[repo] = policy
+        # The first glob that matches wins, so they apply in the order they were configured
+        self._repo_pattern = re.compile('|'.join(patterns), re.DOTALL) if patterns else None
+        self._matched: Dict[str, Optional[RepoPolicy]] = {}
+
+    def repos(self) -> List[str]:
+        """The repos that are configured by name (i.e. not by a glob)"""
+        return list(self.exact)
+
+    @property
+    def has_globs(self) -> bool:
+        return bool(self._globs)
+
+    def repo(self, repo: str) -> Optional[RepoPolicy]:
+        """The rules for ``repo``, or None if we don't provide runners for it"""
+        try:
+            return self.exact[repo]
+        except KeyError:
+            pass
+        if self._repo_pattern is None:
+            return None
+        try:
+            return self._matched[repo]
+        except KeyError:
+            pass
+
+        match = self._repo_pattern.fullmatch(repo)
+        policy = self._globs[int(match.lastgroup[1:])] if match else None  # type: ignore
+        if len(self._matched) >= MATCH_CACHE_SIZE:
+            self._matched.clear()
+        self._matched[repo] = policy
+        return policy
+
+    def decide(
+        self,
+        repo: str,
+        branch: Optional[str],
+        sender: str,
+        commiters: Optional[Callable[[], Collection[str]]] = None,
+    ) -> Decision:
+        """
+        Whether a run of ``repo`` on ``branch`` by ``sender`` should use self-hosted runners
+
+        ``commiters`` is only called if nothing cheaper decided it; if it is None then the committers are
+        not consulted at all.
+        """
+        policy = self.repo(repo)
+        if policy is None:
+            return Decision(False, False, 'other repo')
+        if policy.matches_branch(branch):
+            return Decision(True, True, 'branch')
+        if sender in policy.senders:
+            return Decision(True, True, 'sender')
+        if commiters is not None and policy.use_commiters and sender in commiters():
+            return Decision(True, True, 'commiter')
+        return Decision(True, False, 'no rule matched')
@@ -0,0 +1,62 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+The scale-out decision, kept free of any AWS calls so it can be replayed offline
+
+:func:`decide` only sees the queue length and the state of each of a route's ASGs, and says how big each
+group should become. ``app.scale_asg_if_needed`` gathers the inputs, applies the first change and asks
+again, and ``chalicelib.audit`` replays recorded inputs through alternative versions of it.
+"""
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+
+class GroupState(NamedTuple):
+    asg: str
+    region: Optional[str]
+    desired: int
+    max_size: int
+    busy: int
+    # False once the group has failed to scale during this decision, or is in its overflow cooldown
+    available: bool = True
+
+
+class Decision(NamedTuple):
+    # Instances that are running (or booting) but not busy with a job
+    idle: int
+    # How many more instances the queue needs, after using the idle ones
+    needed: int
+    # (index in to the groups, new desired capacity) in the order they should be applied
+    changes: Tuple[Tuple[int, int], ...]
+    # Demand that doesn't fit in any available group
+    unplaced: int
+
+
+def decide(num_queued_jobs: int, groups: Sequence[GroupState]) -> Decision:
+    """Fill the groups in priority order (the primary first) until the queue is covered"""
+    idle = sum(group.desired - group.busy for group in groups)
+    needed = num_queued_jobs - idle
+    remaining = needed
+    changes = []
+    for n, group in enumerate(groups):
+        if remaining <= 0:
+            break
+        headroom = group.max_size - group.desired
+        if not group.available or headroom <= 0:
+            continue
+        changes.append((n, group.desired + min(remaining, headroom)))
+        remaining -= min(remaining, headroom)
+    return Decision(idle, max(needed, 0), tuple(changes), max(remaining, 0))
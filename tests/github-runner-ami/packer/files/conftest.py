@@ -0,0 +1,80 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import importlib.util
+import os
+import struct
+
+import boto3
+import pytest
+from moto import mock_aws
+
+path = os.path.dirname(__file__)
+idx = path.rfind('/tests/')
+SUPERVISOR = os.path.join(path[:idx] + path[idx + 6 :], 'runner-supervisor.py')
+
+
+@pytest.fixture(scope='session')
+def supervisor():
+    """The runner-supervisor script, imported as a module"""
+    spec = importlib.util.spec_from_file_location('runner_supervisor', SUPERVISOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore
+    return module
+
+
+@pytest.fixture
+def aws(monkeypatch, supervisor):
+    """A moto-backed AWS account with the counter and credential lock tables created"""
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(supervisor, 'OWN_ASG', 'AshbRunnerASG')
+    monkeypatch.setattr(supervisor, 'INSTANCE_ID', 'i-0123456789')
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=supervisor.TABLE_NAME,
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        boto3.client('dynamodb').create_table(
+            TableName=supervisor.LOCK_TABLE,
+            KeySchema=[
+                {'AttributeName': 'lock_key', 'KeyType': 'HASH'},
+                {'AttributeName': 'sort_key', 'KeyType': 'RANGE'},
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'lock_key', 'AttributeType': 'S'},
+                {'AttributeName': 'sort_key', 'AttributeType': 'S'},
+            ],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        yield
+
+
+@pytest.fixture
+def proc_connector_datagram():
+    """Return a function that builds a netlink message from the proc connector, as the kernel sends it"""
+    return make_proc_connector_datagram
+
+
+def make_proc_connector_datagram(what: int, pid: int) -> bytes:
+    event = struct.pack('=IIQ', what, 0, 0) + struct.pack('=iiii', pid, pid, 0, 0)
+    connector = struct.pack('=IIIIHH', 1, 1, 0, 0, len(event), 0)
+    return struct.pack('=IHHII', 16 + len(connector) + len(event), 3, 0, 0, 0) + connector + event
@@ -0,0 +1,155 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Thundering-herd benchmark for claiming runner credentials
+
+A fleet of instances that all boot at once each claim one of the pool's credential indexes, either by
+trying to lock each index in turn (what the supervisor did with python-dynamodb-lock: a GetItem, then a
+conditional PutItem if it's free) or with :class:`CredentialLease`. Writes to the same item are
+serialised the way DynamoDB does.
+
+Under moto the wall-clock time is mostly moto's own request handling, which the GIL serialises across
+the whole herd, so each instance's claim latency is also estimated from how many sequential DynamoDB
+round trips it made at ``RTT`` seconds each. Run with ``pytest -s`` to see the report.
+"""
+import collections
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+
+RTT = 0.01
+INSTANCES = 50
+POOL = 60
+# Leases already held by the instances that are running jobs, so the herd takes every one that is left
+HELD = POOL - INSTANCES
+REPO = 'apache/airflow'
+
+
+class SerialisedItems:
+    """Count every call, and only let one PutItem at a time at each item"""
+
+    def __init__(self, locks):
+        self.locks = locks
+        self.held = threading.local()
+        self.calls = 0
+
+    def register(self, client):
+        client.meta.events.register('before-call.dynamodb', self.count)
+        client.meta.events.register('before-parameter-build.dynamodb.PutItem', self.acquire)
+        client.meta.events.register('after-call.dynamodb.PutItem', self.release)
+
+    def count(self, **kwargs):
+        self.calls += 1
+
+    def acquire(self, params, **kwargs):
+        self.held.lock = self.locks[params['Item']['lock_key']['S']]
+        self.held.lock.acquire()
+
+    def release(self, **kwargs):
+        self.held.lock.release()
+
+
+def lock_each_index(supervisor, dynamodb, possibles):
+    possibles = list(possibles)
+    random.shuffle(possibles)
+    for index in possibles:
+        key = supervisor.CredentialLease.key(REPO, index)
+        if 'Item' in dynamodb.get_item(TableName=supervisor.LOCK_TABLE, Key=key):
+            continue
+        try:
+            dynamodb.put_item(
+                TableName=supervisor.LOCK_TABLE,
+                Item={**key, 'expiry_time': {'N': str(int(time.time()) + 300)}},
+                ConditionExpression='attribute_not_exists(lock_key)',
+            )
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            continue
+        return index
+    return None
+
+
+def lease(supervisor, dynamodb, possibles):
+    claimed = supervisor.CredentialLease.claim(REPO, possibles, dynamodb)
+    return claimed.index if claimed else None
+
+
+def herd(supervisor, claim) -> dict:
+    possibles = [str(n) for n in range(POOL)]
+    # The same ones every run; which ones the herd then races for is down to the thread scheduling
+    for index in random.Random(0).sample(possibles, HELD):
+        supervisor.CredentialLease.claim(REPO, [index])
+    locks = collections.defaultdict(threading.Lock)
+    instances = []
+    for _ in range(INSTANCES):
+        counter = SerialisedItems(locks)
+        client = boto3.client('dynamodb')
+        counter.register(client)
+        instances.append((client, counter))
+    barrier = threading.Barrier(INSTANCES)
+
+    def boot(instance):
+        client, counter = instance
+        barrier.wait()
+        start = time.perf_counter()
+        index = claim(supervisor, client, possibles)
+        return index, time.perf_counter() - start, counter.calls
+
+    with ThreadPoolExecutor(INSTANCES) as pool:
+        results = list(pool.map(boot, instances))
+
+    latencies = sorted(latency for _, latency, _ in results)
+    calls = sorted(calls for _, _, calls in results)
+    return {
+        'indexes': [index for index, _, _ in results],
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[int(len(latencies) * 0.95)],
+        'max': latencies[-1],
+        'calls_p50': calls[len(calls) // 2],
+        'calls_p95': calls[int(len(calls) * 0.95)],
+        'calls_max': calls[-1],
+        'calls_mean': statistics.mean(calls),
+    }
+
+
+@pytest.mark.parametrize('method', [lock_each_index, lease], ids=['lock_each_index', 'lease'])
+def test_credential_herd(aws, supervisor, method):
+    result = herd(supervisor, method)
+
+    print(
+        "\n{method}: wall p50={p50:.3f}s p95={p95:.3f}s max={max:.3f}s; round trips mean={calls_mean:.1f} "
+        "p50={calls_p50} p95={calls_p95} max={calls_max}; "
+        "at {rtt}s RTT p50={est_p50:.2f}s p95={est_p95:.2f}s max={est_max:.2f}s".format(
+            method=method.__name__,
+            rtt=RTT,
+            est_p50=result['calls_p50'] * RTT,
+            est_p95=result['calls_p95'] * RTT,
+            est_max=result['calls_max'] * RTT,
+            **result,
+        )
+    )
+    # Everyone got a credential, and no two instances got the same one
+    assert None not in result['indexes']
+    assert len(set(result['indexes'])) == INSTANCES
+    if method is lease:
+        # One batch read and a single write for most of the herd. How many races the unluckiest instances
+        # lose depends on the thread scheduling, so the tail is only reported
+        assert result['calls_p50'] <= 2
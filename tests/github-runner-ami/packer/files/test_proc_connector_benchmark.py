@@ -0,0 +1,64 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Microbenchmark of the proc connector parser
+
+Compares decoding a burst of EXEC/EXIT datagrams with the ctypes ``proc_event.from_netlink_packet``
+(a ``bytes`` per datagram from ``recvfrom``, a slice and a ``from_buffer_copy`` per structure, and an
+``IntFlag`` per event) against ``parse_proc_events`` unpacking in place from the one ``recvfrom_into``
+buffer. Run with ``pytest -s`` to see the report.
+"""
+import json
+import timeit
+
+EVENTS = 1000
+
+
+def test_proc_connector_parser_microbenchmark(supervisor, proc_connector_datagram):
+    what = [supervisor.PROC_EVENT_EXEC, supervisor.PROC_EVENT_EXIT]
+    datagrams = [proc_connector_datagram(what[n % 2], 1000 + n) for n in range(EVENTS)]
+    buf = bytearray(supervisor.PROC_CONNECTOR_BUFFER)
+
+    def ctypes_parser():
+        events = []
+        for data in datagrams:
+            event, detail = supervisor.proc_event.from_netlink_packet(data)
+            events.append((event.what, detail.pid))
+        return events
+
+    def struct_parser():
+        events = []
+        for data in datagrams:
+            # Stands in for recvfrom_into filling the buffer
+            buf[: len(data)] = data
+            events.extend(supervisor.parse_proc_events(buf, len(data)))
+        return events
+
+    assert struct_parser() == ctypes_parser()
+
+    ctypes_time = min(timeit.repeat(ctypes_parser, number=5, repeat=3)) / 5
+    struct_time = min(timeit.repeat(struct_parser, number=5, repeat=3)) / 5
+    print(
+        "\n"
+        + json.dumps(
+            {
+                'events': EVENTS,
+                'ctypes_us_per_event': round(ctypes_time / EVENTS * 1e6, 2),
+                'struct_us_per_event': round(struct_time / EVENTS * 1e6, 2),
+            }
+        )
+    )
@@ -0,0 +1,350 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import errno
+import getpass
+import json
+import os
+import selectors
+import shutil
+import socket
+import subprocess
+import time
+
+import boto3
+import psutil
+import pytest
+
+
+def fleet_items(supervisor):
+    dynamodb = boto3.client('dynamodb')
+    total = dynamodb.get_item(TableName=supervisor.TABLE_NAME, Key={'id': {'S': 'fleet#AshbRunnerASG'}})
+    own = dynamodb.get_item(
+        TableName=supervisor.TABLE_NAME, Key={'id': {'S': 'fleet#AshbRunnerASG#i-0123456789'}}
+    )
+    return int(total.get('Item', {}).get('busy', {}).get('N', 0)), own['Item']['busy']['BOOL']
+
+
+def test_publish_fleet_state_counts_each_transition_once(aws, supervisor):
+    # Starting up idle doesn't take anything off the total
+    supervisor.publish_fleet_state(busy=False)
+    assert fleet_items(supervisor) == (0, False)
+
+    supervisor.publish_fleet_state(busy=True)
+    assert fleet_items(supervisor) == (1, True)
+    # Repeated
+    supervisor.publish_fleet_state(busy=True)
+    assert fleet_items(supervisor) == (1, True)
+
+    supervisor.publish_fleet_state(busy=False)
+    supervisor.publish_fleet_state(busy=False)
+    assert fleet_items(supervisor) == (0, False)
+
+
+def test_credential_lease_claim_renew_release(aws, supervisor, monkeypatch):
+    dynamodb = boto3.client('dynamodb')
+    possibles = ['1', '2', '3']
+
+    first = supervisor.CredentialLease.claim('apache/airflow', possibles)
+    second = supervisor.CredentialLease.claim('apache/airflow', possibles)
+    assert first.index != second.index
+    assert supervisor.CredentialLease.free_indexes(dynamodb, 'apache/airflow', possibles) == [
+        index for index in possibles if index not in (first.index, second.index)
+    ]
+
+    # A lease that wasn't renewed in time can be taken over, after which the old holder can't renew it
+    monkeypatch.setattr(supervisor, 'LEASE_SECONDS', -10)
+    assert first.renew()
+    third = supervisor.CredentialLease.claim('apache/airflow', [first.index])
+    assert third.index == first.index
+    assert not first.renew()
+    # Nor release it
+    first.release()
+    item = dynamodb.get_item(TableName=supervisor.LOCK_TABLE, Key=third.key('apache/airflow', third.index))
+    assert item['Item']['record_version_number']['S'] == third.version
+
+    monkeypatch.setattr(supervisor, 'LEASE_SECONDS', 300)
+    assert supervisor.CredentialLease.claim('apache/airflow', [second.index]) is None
+    with second:
+        pass
+    assert supervisor.CredentialLease.claim('apache/airflow', [second.index]).index == second.index
+
+
+def test_parameter_store_batches_and_caches(aws, supervisor, tmp_path):
+    ssm = boto3.client('ssm')
+    runners_list = supervisor.runners_list_name('apache/airflow')
+    overlay = supervisor.config_overlay_name('apache/airflow')
+    ssm.put_parameter(Name=runners_list, Type='StringList', Value='1,2')
+    ssm.put_parameter(Name=overlay, Type='String', Value='{"labels": ["a"]}')
+    names = supervisor.runner_parameter_names('apache/airflow', '1')
+    for name in names:
+        ssm.put_parameter(Name=name, Type='SecureString', Value=json.dumps({os.path.basename(name): 1}))
+
+    calls = []
+
+    def store():
+        client = boto3.client('ssm')
+        client.meta.events.register('before-call.ssm', lambda model, **kwargs: calls.append(model.name))
+        return supervisor.ParameterStore(client, str(tmp_path / 'ssm-cache.json'))
+
+    assert supervisor.get_possible_credentials('apache/airflow', store()) == ['1', '2']
+    assert calls == ['GetParameters']
+    # A restarted supervisor doesn't fetch the list again
+    restarted = store()
+    assert supervisor.get_possible_credentials('apache/airflow', restarted) == ['1', '2']
+    assert calls == ['GetParameters']
+
+    ssm.put_parameter(Name=overlay, Type='String', Value='{"labels": ["b"]}', Overwrite=True)
+    # The credentials and both cached parameters in one call, which picks up the new overlay
+    params = restarted.get(names + [runners_list, overlay])
+    assert calls == ['GetParameters', 'GetParameters']
+
+    out = tmp_path / 'actions-runner'
+    out.mkdir()
+    supervisor.write_credentials_to_files('apache/airflow', '1', str(out), getpass.getuser(), params)
+    supervisor.merge_in_settings('apache/airflow', str(out), params)
+    assert json.loads((out / '.runner').read_text()) == {'config': 1, 'labels': ['b']}
+    assert json.loads((out / '.credentials_rsaparams').read_text()) == {'rsaparams': 1}
+
+    cache = json.loads((tmp_path / 'ssm-cache.json').read_text())
+    assert cache == {
+        runners_list: {'value': '1,2', 'version': 1},
+        # Only the non-secret parameters are cached
+        overlay: {'value': '{"labels": ["b"]}', 'version': 2},
+    }
+
+
+def test_warm_start_state_saved_and_used_once(aws, supervisor, monkeypatch, tmp_path):
+    boto3.client('ssm').put_parameter(
+        Name=supervisor.runners_list_name('apache/airflow'), Type='StringList', Value='1,2'
+    )
+    store = supervisor.ParameterStore(boto3.client('ssm'), str(tmp_path / 'ssm-cache.json'))
+    monkeypatch.setattr(supervisor, 'WARM_STATE_FILE', str(tmp_path / 'state' / 'warm-state.json'))
+    monkeypatch.setattr(supervisor, 'get_lifecycle_state', lambda: 'Warmed:Pending:Wait')
+    completed = []
+    monkeypatch.setattr(supervisor, 'complete_asg_lifecycle_hook', lambda: completed.append(True))
+
+    supervisor.prepare_warm_start('apache/airflow', store)
+    # Let in to the warm pool
+    assert completed == [True]
+
+    # Saved for another repo
+    assert supervisor.load_warm_state('apache/other') is None
+    supervisor.prepare_warm_start('apache/airflow', store)
+    assert supervisor.load_warm_state('apache/airflow') == {'repo': 'apache/airflow', 'possibles': ['1', '2']}
+    # Only used once
+    assert supervisor.load_warm_state('apache/airflow') is None
+
+
+def test_warm_start_state_unreadable(supervisor, monkeypatch, tmp_path):
+    state_file = tmp_path / 'warm-state.json'
+    monkeypatch.setattr(supervisor, 'WARM_STATE_FILE', str(state_file))
+    assert supervisor.load_warm_state('apache/airflow') is None
+
+    state_file.write_text('{"repo": ')
+    assert supervisor.load_warm_state('apache/airflow') is None
+
+
+def test_wait_to_leave_warm_pool(supervisor, monkeypatch):
+    states = ['Warmed:Hibernated', 'Warmed:Pending', 'Pending:Wait']
+    monkeypatch.setattr(supervisor, 'get_lifecycle_state', lambda: states.pop(0))
+    sleeps = []
+    monkeypatch.setattr(supervisor.time, 'sleep', sleeps.append)
+
+    supervisor.wait_to_leave_warm_pool()
+    assert states == []
+    assert sleeps == [5, 5]
+
+
+@pytest.fixture
+def watcher(supervisor, monkeypatch):
+    watcher = supervisor.ProcessWatcher()
+    watcher.interesting_processes = {}
+    watcher.pidfds = {}
+    watcher.sel = selectors.DefaultSelector()
+    watcher.stats = dict.fromkeys(watcher.stats, 0)
+    protections = []
+    monkeypatch.setattr(watcher, 'protect_from_scale_in', lambda protect=True: protections.append(protect))
+    watcher.protections = protections
+    yield watcher
+    watcher.sel.close()
+
+
+def test_pidfd_reports_exit_immediately(supervisor, watcher):
+    child = subprocess.Popen(['sleep', '60'])
+    watcher.track(psutil.Process(child.pid))
+    assert child.pid in watcher.pidfds
+
+    # Nothing to report while it's running
+    assert watcher.sel.select(timeout=0) == []
+
+    child.kill()
+    child.wait()
+    events = watcher.sel.select(timeout=5)
+    assert len(events) == 1
+    key, mask = events[0]
+    key.data(key.fileobj, mask)
+
+    assert watcher.interesting_processes == {}
+    assert watcher.pidfds == {}
+    assert watcher.protections == [False]
+
+
+def test_pidfd_and_proc_connector_exit_in_same_batch(supervisor, watcher):
+    child = subprocess.Popen(['sleep', '60'])
+    watcher.track(psutil.Process(child.pid))
+    fd = watcher.pidfds[child.pid]
+
+    child.kill()
+    child.wait()
+    events = watcher.sel.select(timeout=5)
+    assert len(events) == 1
+
+    # The proc connector's EXIT is handled first, closing the pidfd, and a new worker re-uses its number
+    watcher.handle_proc_message(supervisor.PROC_EVENT_EXIT, child.pid)
+    newer = subprocess.Popen(['sleep', '60'])
+    try:
+        watcher.track(psutil.Process(newer.pid))
+        assert watcher.pidfds[newer.pid] == fd
+
+        key, mask = events[0]
+        key.data(key.fileobj, mask)
+
+        assert list(watcher.interesting_processes) == [newer.pid]
+        assert watcher.protections == [False]
+    finally:
+        newer.kill()
+        newer.wait()
+
+
+def test_pidfd_open_syscall(supervisor, monkeypatch):
+    # The ctypes fallback that Python < 3.9 uses
+    monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    fd = supervisor.pidfd_open(os.getpid())
+    try:
+        assert os.fstat(fd)
+    finally:
+        os.close(fd)
+
+    with pytest.raises(OSError) as e:
+        supervisor.pidfd_open(2**22 + 1)
+    assert e.value.errno == errno.ESRCH
+
+
+def test_polls_without_pidfd(supervisor, watcher, monkeypatch):
+    def unsupported(pid):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    monkeypatch.setattr(supervisor, 'pidfd_open', unsupported)
+    monkeypatch.setattr(supervisor.ProcessWatcher, 'pidfd_supported', True)
+    monkeypatch.setattr(supervisor, 'get_lifecycle_state', lambda: 'InService')
+    child = subprocess.Popen(['sleep', '60'])
+    watcher.track(psutil.Process(child.pid))
+    assert watcher.pidfds == {}
+    assert not supervisor.ProcessWatcher.pidfd_supported
+
+    watcher.protected = True
+    watcher.check_still_alive()
+    assert child.pid in watcher.interesting_processes
+    child.kill()
+    child.wait()
+    watcher.check_still_alive()
+    assert watcher.interesting_processes == {}
+    assert watcher.protections == [False]
+
+
+def test_parse_several_messages_per_datagram(supervisor, proc_connector_datagram):
+    datagram = (
+        proc_connector_datagram(supervisor.ProcEventWhat.EXEC, 10)
+        + proc_connector_datagram(supervisor.ProcEventWhat.FORK, 11)
+        + proc_connector_datagram(supervisor.ProcEventWhat.EXIT, 12)
+    )
+    buf = bytearray(supervisor.PROC_CONNECTOR_BUFFER)
+    buf[: len(datagram)] = datagram
+
+    events = list(supervisor.parse_proc_events(buf, len(datagram)))
+    assert events == [
+        (supervisor.PROC_EVENT_EXEC, 10),
+        (int(supervisor.ProcEventWhat.FORK), 11),
+        (supervisor.PROC_EVENT_EXIT, 12),
+    ]
+    # A message cut short (by a too-small buffer) is dropped, not misread
+    assert list(supervisor.parse_proc_events(buf, len(datagram) - 4)) == events[:2]
+
+    # The same as the ctypes parser
+    event, detail = supervisor.proc_event.from_netlink_packet(bytes(datagram))
+    assert (event.what, detail.pid) == events[0]
+
+
+class FakeNetlinkSocket:
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def recvfrom_into(self, buf):
+        result = self.results.pop(0) if self.results else BlockingIOError()
+        if isinstance(result, Exception):
+            raise result
+        buf[: len(result)] = result
+        return len(result), (0, 1)
+
+
+@pytest.fixture
+def runner_processes(tmp_path):
+    """A Runner.Listener and a Runner.Worker (both really sleep)"""
+    children = []
+    for name in ('Runner.Listener', 'Runner.Worker'):
+        shutil.copy(shutil.which('sleep'), tmp_path / name)
+        children.append(subprocess.Popen([str(tmp_path / name), '60']))
+    yield children
+    for child in children:
+        child.kill()
+        child.wait()
+
+
+def test_overrun_drains_and_rescans(
+    supervisor, watcher, runner_processes, proc_connector_datagram, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(watcher, 'dynamodb_atomic_decrement', lambda: None)
+    listener, worker = runner_processes
+    while psutil.Process(worker.pid).name() != 'Runner.Worker':
+        time.sleep(0.01)
+
+    # The Runner.Worker's EXEC event was dropped in the overrun
+    sock = FakeNetlinkSocket(
+        proc_connector_datagram(supervisor.ProcEventWhat.EXIT, 1),
+        OSError(errno.ENOBUFS, os.strerror(errno.ENOBUFS)),
+        proc_connector_datagram(supervisor.ProcEventWhat.EXIT, 2),
+    )
+    watcher.handle_proc_event(sock, selectors.EVENT_READ)
+
+    assert sock.results == []
+    assert watcher.stats == {'datagrams': 2, 'events': 2, 'overruns': 1, 'resyncs': 1}
+    assert list(watcher.interesting_processes) == [worker.pid]
+    assert watcher.protections == [True]
+
+    monkeypatch.setattr(supervisor, 'PROC_STATS_FILE', str(tmp_path / 'proc-connector.json'))
+    watcher.report_stats()
+    stats = json.loads((tmp_path / 'proc-connector.json').read_text())
+    assert stats['overruns'] == 1
+    assert stats['events_per_second'] >= 0
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="Going over net.core.rmem_max needs CAP_NET_ADMIN")
+def test_set_receive_buffer(supervisor):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        # The kernel doubles it to allow for its own overhead
+        assert supervisor.set_receive_buffer(sock, 8 * 1024 * 1024) >= 8 * 1024 * 1024
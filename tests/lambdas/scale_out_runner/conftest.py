@@ -15,11 +15,18 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import hmac
+import itertools
+import json
 import os
 import sys
+from typing import Optional
 
+import boto3
 import pytest
+from chalice import Rate
 from chalice.test import Client
+from moto import mock_aws
 
 path = os.path.dirname(__file__)
 idx = path.rfind('/tests/')
@@ -33,3 +40,128 @@ def client(request):
 
     with Client(app) as client:
         yield client
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """A moto-backed AWS account with the counter table, runner ASG and config overlay created"""
+    import app
+
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr(app, '_clients', {})
+    monkeypatch.setattr(app, '_queue_urls', {})
+    app._commiters.invalidate()
+    app._recent_deliveries.clear()
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName=app.TABLE_NAME,
+            KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+
+        asg = boto3.client('autoscaling')
+        asg.create_launch_configuration(
+            LaunchConfigurationName='runner', ImageId='ami-12c6146b', InstanceType='m5.large'
+        )
+        asg.create_auto_scaling_group(
+            AutoScalingGroupName=app.ASG_GROUP_NAME,
+            LaunchConfigurationName='runner',
+            MinSize=0,
+            MaxSize=5,
+            DesiredCapacity=0,
+            AvailabilityZones=['us-east-1a'],
+        )
+
+        boto3.client('ssm').put_parameter(
+            Name='/runners/apache/airflow/configOverlay',
+            Type='String',
+            Value=json.dumps({'pullRequestSecurity': {'allowedAuthors': ['ashb']}}),
+        )
+        yield
+
+
+@pytest.fixture
+def scheduled(monkeypatch):
+    """Return a function that schedules one of the app's functions, as if its feature had been enabled"""
+    import app
+
+    monkeypatch.setattr(app.app, 'handler_map', dict(app.app.handler_map))
+    monkeypatch.setattr(app.app, 'event_sources', list(app.app.event_sources))
+
+    def schedule(name: str):
+        app.app.schedule(Rate(1, unit=Rate.MINUTES))(getattr(app, name))
+
+    return schedule
+
+
+@pytest.fixture
+def webhook(client):
+    """Return a function that posts a correctly signed GitHub webhook delivery"""
+    counter = itertools.count()
+
+    def post(body: dict, event: str = 'check_run', delivery: Optional[str] = None):
+        raw = json.dumps(body).encode()
+        sig = hmac.new(b'abc', raw, digestmod='SHA256').hexdigest()
+        return client.http.post(
+            '/',
+            headers={
+                'Content-Type': 'application/json',
+                'X-GitHub-Event': event,
+                'X-GitHub-Delivery': delivery or f'delivery-{next(counter)}',
+                'X-Hub-Signature-256': 'sha256=' + sig,
+            },
+            body=raw,
+        )
+
+    return post
+
+
+@pytest.fixture
+def check_run_event():
+    """Return a function that builds a (minimal) check_run webhook payload"""
+    return make_check_run_event
+
+
+def make_check_run_event(
+    action: str = 'created',
+    status: str = 'queued',
+    conclusion: Optional[str] = None,
+    sender: str = 'ashb',
+    branch: str = 'my-feature',
+    repo: str = 'apache/airflow',
+) -> dict:
+    return {
+        'action': action,
+        'repository': {'full_name': repo},
+        'sender': {'login': sender},
+        'check_run': {
+            'status': status,
+            'conclusion': conclusion,
+            'check_suite': {'head_branch': branch},
+        },
+    }
+
+
+@pytest.fixture
+def workflow_job_event():
+    """Return a function that builds a (minimal) workflow_job webhook payload"""
+
+    def make(
+        action: str,
+        job_id: int = 1,
+        labels=('self-hosted', 'airflow-runner'),
+        repo='apache/airflow',
+        run_id: int = 100,
+    ):
+        return {
+            'action': action,
+            'repository': {'full_name': repo},
+            'sender': {'login': 'ashb'},
+            'workflow_job': {'id': job_id, 'run_id': run_id, 'status': action, 'labels': list(labels)},
+        }
+
+    return make
@@ -15,10 +15,18 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import io
 import json
+import threading
+import time
+import types
 
+import app as scale_out_runner
+import boto3
 import pytest
 from app import app  # noqa
+from botocore.exceptions import ClientError
+from chalice.app import ScheduledEventConfig, SQSEventConfig
 
 
 @pytest.fixture(autouse=True)
@@ -59,3 +67,634 @@ def test_auth(client):
         body=json.dumps({'hello': 'world'}),
     )
     assert response.status_code == 200
+
+
+def test_aws_clients_reused_between_invocations(aws, webhook, check_run_event, monkeypatch):
+    created = []
+    real_client = scale_out_runner.boto3.client
+
+    def client(service_name, **kwargs):
+        created.append(service_name)
+        return real_client(service_name, **kwargs)
+
+    monkeypatch.setattr(scale_out_runner.boto3, 'client', client)
+
+    response = webhook(check_run_event())
+    assert response.status_code == 200
+    assert response.json_body['new_capcity'] == 1
+    assert sorted(created) == ['autoscaling', 'dynamodb', 'ssm']
+
+    created.clear()
+    response = webhook(check_run_event())
+    assert response.json_body['new_capcity'] == 2
+    assert created == []
+
+
+def test_invocation_timings_emitted_as_emf(aws, webhook, check_run_event, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(scale_out_runner.metrics, 'stream', stream)
+
+    webhook(check_run_event(), delivery='abc-123')
+    webhook(check_run_event(action='completed', status='completed', conclusion='success'))
+
+    scaled, ignored = [json.loads(line) for line in stream.getvalue().splitlines()]
+    definition = scaled['_aws']['CloudWatchMetrics'][0]
+    assert definition['Dimensions'] == [['Outcome']]
+    names = {metric['Name'] for metric in definition['Metrics']}
+    assert {
+        'Total',
+        'SignatureCheck',
+        'ssm.GetParameter',
+        'dynamodb.UpdateItem',
+        'autoscaling.DescribeAutoScalingGroups',
+        'autoscaling.SetDesiredCapacity',
+    } <= names
+    assert all(scaled[name] >= 0 for name in names)
+    assert scaled['Outcome'] == 'scaled'
+    assert scaled['delivery'] == 'abc-123'
+    assert scaled['event'] == 'check_run'
+
+    assert ignored['Outcome'] == 'ignored'
+    # The committers are cached, so the second webhook made no calls to SSM
+    assert 'ssm.GetParameter' not in ignored
+
+
+def test_emf_metrics_can_be_disabled(aws, webhook, check_run_event, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(scale_out_runner.metrics, 'stream', stream)
+    monkeypatch.setattr(scale_out_runner.metrics, 'enabled', False)
+
+    assert webhook(check_run_event()).json_body['new_capcity'] == 1
+    assert stream.getvalue() == ''
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiry_and_stale_refresh(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scale_out_runner.time, 'monotonic', clock)
+
+    values = iter([{'a'}, {'a', 'b'}])
+    release = threading.Event()
+
+    def loader():
+        if cache.stats['refreshes']:
+            release.wait(5)
+        return next(values)
+
+    cache = scale_out_runner.TTLCache(loader, ttl=60, stale_ttl=600, negative_ttl=10, default=frozenset())
+
+    assert cache.get() == {'a'}
+    clock.now += 30
+    assert cache.get() == {'a'}
+    assert cache.stats['misses'] == 1 and cache.stats['hits'] == 1
+
+    # Stale: the old value is served straight away, and a refresh happens in the background
+    clock.now += 60
+    assert cache.get() == {'a'}
+    release.set()
+    for _ in range(100):
+        if not cache._refreshing:
+            break
+        time.sleep(0.01)
+    assert cache.get() == {'a', 'b'}
+    assert cache.stats == {'hits': 2, 'stale_hits': 1, 'misses': 1, 'refreshes': 1, 'negative': 0}
+
+
+def test_commiters_negative_cache(aws, webhook, check_run_event, monkeypatch):
+    boto3.client('ssm').delete_parameter(Name='/runners/apache/airflow/configOverlay')
+
+    calls = []
+    real_loader = scale_out_runner._commiters.loader
+    monkeypatch.setattr(scale_out_runner._commiters, 'loader', lambda: calls.append(1) or real_loader())
+
+    for _ in range(3):
+        response = webhook(check_run_event())
+        assert response.json_body['use_self_hosted'] is False
+
+    # The missing overlay was only looked up once
+    assert len(calls) == 1
+    assert scale_out_runner._commiters.stats['negative'] == 1
+
+
+@pytest.mark.parametrize('shards', [1, 4])
+def test_sharded_counter_never_below_zero(aws, monkeypatch, shards):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SHARDS', shards)
+
+    for n in range(10):
+        assert scale_out_runner.increment_dynamodb_counter(shard_hint=f'delivery-{n}') == n + 1
+
+    assert scale_out_runner.increment_dynamodb_counter(-3) == 7
+    # Bigger than any one shard, so has to be spread over several
+    assert scale_out_runner.increment_dynamodb_counter(-6) == 1
+    assert scale_out_runner.increment_dynamodb_counter(-5) == 0
+    assert scale_out_runner.increment_dynamodb_counter(-1) == 0
+
+    table = boto3.resource('dynamodb').Table(scale_out_runner.TABLE_NAME)
+    for key in scale_out_runner.counter_shard_keys():
+        item = table.get_item(Key={'id': key}).get('Item', {})
+        assert item.get('queued', 0) == 0
+
+
+def test_duplicate_delivery_counted_once(aws, webhook, check_run_event):
+    first = webhook(check_run_event(), delivery='abc-123')
+    assert first.json_body['new_capcity'] == 1
+
+    # Retried on the same container
+    assert webhook(check_run_event(), delivery='abc-123').json_body == first.json_body
+
+    # Retried on a different container
+    scale_out_runner._recent_deliveries.clear()
+    assert webhook(check_run_event(), delivery='abc-123').json_body == first.json_body
+
+    assert scale_out_runner.read_dynamodb_counter() == 1
+    assert webhook(check_run_event(), delivery='abc-456').json_body['new_capcity'] == 2
+
+
+def test_failed_delivery_can_be_retried(aws, webhook, check_run_event, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    with monkeypatch.context() as m:
+        m.setattr(scale_out_runner, 'scale_asg_if_needed', fail)
+        assert webhook(check_run_event(), delivery='abc-123').status_code == 500
+
+    assert webhook(check_run_event(), delivery='abc-123').json_body['new_capcity'] == 1
+    assert scale_out_runner.read_dynamodb_counter() == 1
+
+
+def test_abandoned_delivery_claim_lapses(aws, webhook, check_run_event, monkeypatch):
+    # The first attempt timed out after claiming the delivery, before counting it
+    now = time.time()
+    boto3.client('dynamodb').put_item(
+        TableName=scale_out_runner.DELIVERY_TABLE,
+        Item={
+            'id': {'S': 'delivery#abc-123'},
+            'expires': {'N': str(int(now) + scale_out_runner.DELIVERY_LEASE)},
+        },
+    )
+    assert webhook(check_run_event(), delivery='abc-123').json_body == {'ignored': 'duplicate delivery'}
+
+    monkeypatch.setattr(scale_out_runner.time, 'time', lambda: now + scale_out_runner.DELIVERY_LEASE + 1)
+    assert webhook(check_run_event(), delivery='abc-123').json_body['new_capcity'] == 1
+    assert scale_out_runner.read_dynamodb_counter() == 1
+
+    # Once counted, the claim is kept for the full DELIVERY_TTL
+    item = boto3.client('dynamodb').get_item(
+        TableName=scale_out_runner.DELIVERY_TABLE, Key={'id': {'S': 'delivery#abc-123'}}
+    )['Item']
+    assert int(item['expires']['N']) > now + scale_out_runner.DELIVERY_TTL
+
+
+def test_workflow_job_ledger(aws, webhook, workflow_job_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SOURCE', 'workflow_job')
+
+    def post(action, job_id):
+        return webhook(workflow_job_event(action, job_id), event='workflow_job').json_body
+
+    assert post('queued', 1)['new_capcity'] == 1
+    assert post('queued', 2)['new_capcity'] == 2
+    # Redelivered
+    assert post('queued', 1)['ignored'] == 'duplicate or out of order'
+    assert post('in_progress', 1)['new_queue'] == 1
+    assert 'new_queue' not in post('completed', 1)
+    # Cancelled before it started
+    assert post('completed', 2)['new_queue'] == 0
+    # in_progress arriving after completed doesn't change anything
+    assert post('in_progress', 2)['ignored'] == 'duplicate or out of order'
+
+    # We never saw it queued, so it was never counted
+    assert 'new_queue' not in post('in_progress', 3)
+    assert post('queued', 3)['ignored'] == 'duplicate or out of order'
+
+    assert scale_out_runner.read_dynamodb_counter() == 0
+
+
+def test_workflow_job_other_labels_and_check_runs_ignored(
+    aws, webhook, workflow_job_event, check_run_event, monkeypatch
+):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SOURCE', 'workflow_job')
+
+    response = webhook(workflow_job_event('queued', labels=['ubuntu-latest']), event='workflow_job')
+    assert response.json_body == {'ignored': 'not for a self-hosted runner'}
+
+    response = webhook(check_run_event())
+    assert response.json_body == {'ignored': 'queue is counted from workflow_job events'}
+
+
+def test_workflow_job_routed_by_labels(aws, webhook, workflow_job_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SOURCE', 'workflow_job')
+    arm = scale_out_runner.Route('arm', 'ArmRunnerASG', labels=frozenset({'airflow-runner', 'arm64'}))
+    monkeypatch.setattr(scale_out_runner, 'ROUTING_TABLE', [arm])
+
+    boto3.client('autoscaling').create_auto_scaling_group(
+        AutoScalingGroupName='ArmRunnerASG',
+        LaunchConfigurationName='runner',
+        MinSize=0,
+        MaxSize=5,
+        DesiredCapacity=0,
+        AvailabilityZones=['us-east-1a'],
+    )
+
+    def post(job_id, labels):
+        event = workflow_job_event('queued', job_id, labels=labels)
+        return webhook(event, event='workflow_job').json_body
+
+    assert post(1, ['self-hosted', 'airflow-runner', 'arm64']) == {'job': 1, 'route': 'arm', 'new_capcity': 1}
+    assert post(2, ['self-hosted', 'airflow-runner', 'arm64'])['new_capcity'] == 2
+    assert post(3, ['self-hosted', 'airflow-runner']) == {'job': 3, 'route': 'default', 'new_capcity': 1}
+
+    assert scale_out_runner.read_dynamodb_counter('queued_jobs:arm') == 2
+    assert scale_out_runner.read_dynamodb_counter() == 1
+
+    groups = boto3.client('autoscaling').describe_auto_scaling_groups()['AutoScalingGroups']
+    assert {g['AutoScalingGroupName']: g['DesiredCapacity'] for g in groups} == {
+        'AshbRunnerASG': 1,
+        'ArmRunnerASG': 2,
+    }
+
+    # Started on the arm fleet, so taken off the arm counter
+    event = workflow_job_event('in_progress', 1, labels=['self-hosted', 'airflow-runner', 'arm64'])
+    assert webhook(event, event='workflow_job').json_body['new_queue'] == 1
+    assert scale_out_runner.read_dynamodb_counter('queued_jobs:arm') == 1
+    assert scale_out_runner.read_dynamodb_counter() == 1
+
+
+def test_scale_spills_over_to_overflow_groups(aws, monkeypatch):
+    asg = boto3.client('autoscaling')
+    asg.update_auto_scaling_group(AutoScalingGroupName='AshbRunnerASG', MaxSize=2)
+    for name, max_size in [('BrokenASG', 5), ('OverflowASG', 2)]:
+        asg.create_auto_scaling_group(
+            AutoScalingGroupName=name,
+            LaunchConfigurationName='runner',
+            MinSize=0,
+            MaxSize=max_size,
+            DesiredCapacity=0,
+            AvailabilityZones=['us-east-1a'],
+        )
+    route = scale_out_runner.DEFAULT_ROUTE._replace(overflow=(('BrokenASG', None), ('OverflowASG', None)))
+    # Pretend BrokenASG recently failed to launch anything
+    monkeypatch.setitem(scale_out_runner._overflow_cooldown, ('BrokenASG', None), time.monotonic() + 60)
+
+    assert scale_out_runner.scale_asg_if_needed(1, route) == {'new_capcity': 1}
+    assert scale_out_runner.scale_asg_if_needed(3, route) == {
+        'new_capcity': 2,
+        'overflow': [{'asg': 'OverflowASG', 'region': None, 'new_capacity': 1}],
+    }
+    # Everything is now at MaxSize
+    assert scale_out_runner.scale_asg_if_needed(6, route) == {
+        'overflow': [{'asg': 'OverflowASG', 'region': None, 'new_capacity': 2}],
+        'unplaced': 2,
+    }
+    assert scale_out_runner.scale_asg_if_needed(7, route) == {'capacity_at_max': True}
+
+
+def test_warm_pool_sized_from_recent_demand(aws, client, scheduled, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'WARM_POOL', True)
+    scheduled('size_warm_pools')
+    monkeypatch.setattr(scale_out_runner, 'WARM_POOL_FACTOR', 0.5)
+    now = time.time()
+    monkeypatch.setattr(scale_out_runner.time, 'time', lambda: now)
+
+    history = scale_out_runner.arrival_history(scale_out_runner.DEFAULT_ROUTE)
+    # Too long ago to count
+    history.record(now - 2 * 3600, 10)
+    history.record(now - 1800, 5)
+    history.record(now - 60, 2)
+    assert history.recent_arrivals(now, 60) == 7
+
+    client.lambda_.invoke('size_warm_pools', client.events.generate_cw_event('Scheduled Event', '', {}, []))
+
+    config = boto3.client('autoscaling').describe_warm_pool(AutoScalingGroupName='AshbRunnerASG')
+    assert config['WarmPoolConfiguration']['MinSize'] == 4
+    assert config['WarmPoolConfiguration']['PoolState'] == 'Hibernated'
+
+
+def warm_pool_pages(asg_client, pages):
+    """Answer DescribeWarmPool with ``pages`` of instance lifecycle states (moto's warm pools are empty)"""
+    calls = []
+
+    def describe_warm_pool(params, **kwargs):
+        # The query string parameters, as they are about to be sent
+        calls.append(params['body'])
+        page = int(params['body'].get('NextToken', 0))
+        response = {'Instances': [{'LifecycleState': state} for state in pages[page]]}
+        if page + 1 < len(pages):
+            response['NextToken'] = str(page + 1)
+        return types.SimpleNamespace(status_code=200), response
+
+    asg_client.meta.events.register('before-call.auto-scaling.DescribeWarmPool', describe_warm_pool)
+    return calls
+
+
+def test_scale_out_reports_warm_pool_use(aws, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'WARM_POOL', True)
+    asg = scale_out_runner.aws_client('autoscaling')
+    asg.put_warm_pool(AutoScalingGroupName='AshbRunnerASG', MinSize=3, PoolState='Hibernated')
+    calls = warm_pool_pages(
+        asg, [['Warmed:Hibernated', 'Warmed:Pending'], ['Warmed:Stopped', 'Warmed:Terminating']]
+    )
+
+    assert scale_out_runner.scale_asg_if_needed(3) == {
+        'new_capcity': 3,
+        'from_warm_pool': 2,
+        'cold_starts': 1,
+    }
+    assert len(calls) == 2
+
+
+def test_scale_out_without_warm_pool_doesnt_describe_it(aws, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'WARM_POOL', True)
+    calls = warm_pool_pages(scale_out_runner.aws_client('autoscaling'), [['Warmed:Hibernated']])
+
+    assert scale_out_runner.scale_asg_if_needed(1) == {'new_capcity': 1}
+    assert calls == []
+
+
+def test_scale_spills_over_unscalable_overflow_group(aws, monkeypatch):
+    asg = boto3.client('autoscaling')
+    asg.update_auto_scaling_group(AutoScalingGroupName='AshbRunnerASG', MaxSize=1)
+    for name in ('DeniedASG', 'OverflowASG'):
+        asg.create_auto_scaling_group(
+            AutoScalingGroupName=name,
+            LaunchConfigurationName='runner',
+            MinSize=0,
+            MaxSize=5,
+            DesiredCapacity=0,
+            AvailabilityZones=['us-east-1a'],
+        )
+    route = scale_out_runner.DEFAULT_ROUTE._replace(overflow=(('DeniedASG', None), ('OverflowASG', None)))
+    monkeypatch.setattr(scale_out_runner, '_overflow_cooldown', {})
+
+    client = scale_out_runner.aws_client('autoscaling')
+    real_set_desired_capacity = client.set_desired_capacity
+
+    def set_desired_capacity(AutoScalingGroupName, **kwargs):
+        if AutoScalingGroupName == 'DeniedASG':
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Nope'}}, 'SetDesiredCapacity')
+        return real_set_desired_capacity(AutoScalingGroupName=AutoScalingGroupName, **kwargs)
+
+    monkeypatch.setattr(client, 'set_desired_capacity', set_desired_capacity)
+
+    assert scale_out_runner.scale_asg_if_needed(3, route) == {
+        'new_capcity': 1,
+        'overflow': [{'asg': 'OverflowASG', 'region': None, 'new_capacity': 2}],
+    }
+    assert ('DeniedASG', None) in scale_out_runner._overflow_cooldown
+
+
+def test_workflow_run_reserves_learned_fanout(aws, webhook, workflow_job_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SOURCE', 'workflow_job')
+    monkeypatch.setattr(scale_out_runner, 'BURST_PRESCALING', True)
+
+    def run_event(action, run_id):
+        body = {
+            'action': action,
+            'repository': {'full_name': 'apache/airflow'},
+            'sender': {'login': 'ashb'},
+            'workflow_run': {'id': run_id, 'name': 'CI Build', 'head_branch': 'my-feature'},
+        }
+        return webhook(body, event='workflow_run').json_body
+
+    def job_event(action, job_id, run_id):
+        return webhook(workflow_job_event(action, job_id, run_id=run_id), event='workflow_job').json_body
+
+    # Nothing learned about this workflow yet
+    assert run_event('requested', 1) == {'run': 1, 'reserved': 0}
+    for job_id in range(3):
+        assert job_event('queued', job_id, run_id=1)['reserved'] is False
+    for job_id in range(3):
+        job_event('in_progress', job_id, run_id=1)
+    assert run_event('completed', 1) == {'run': 1, 'released': 0}
+
+    # Those instances have since been scaled in
+    boto3.client('autoscaling').set_desired_capacity(AutoScalingGroupName='AshbRunnerASG', DesiredCapacity=0)
+
+    # The next run reserves capacity for three jobs in one go
+    assert run_event('requested', 2) == {'run': 2, 'reserved': 3, 'new_capcity': 3}
+    # Redelivery of the requested event doesn't reserve it twice
+    assert run_event('requested', 2) == {'run': 2, 'reserved': 0}
+    assert scale_out_runner.read_dynamodb_counter(scale_out_runner.RESERVED_COUNTER) == 3
+
+    assert job_event('queued', 10, run_id=2)['reserved'] is True
+    assert job_event('queued', 11, run_id=2)['reserved'] is True
+    assert scale_out_runner.read_dynamodb_counter(scale_out_runner.RESERVED_COUNTER) == 1
+    assert scale_out_runner.queue_demand(scale_out_runner.DEFAULT_ROUTE) == 3
+
+    # The third job was skipped, so its reservation is released
+    assert run_event('completed', 2) == {'run': 2, 'released': 1}
+    assert scale_out_runner.read_dynamodb_counter(scale_out_runner.RESERVED_COUNTER) == 0
+
+
+@pytest.fixture
+def scaling_queue(aws, monkeypatch):
+    """Turn on ASYNC_SCALING, and return a function that takes the message bodies off the queue"""
+    monkeypatch.setattr(scale_out_runner, 'ASYNC_SCALING', True)
+    # As if the app had been deployed with it on
+    monkeypatch.setattr(app, 'handler_map', dict(app.handler_map))
+    monkeypatch.setattr(app, 'event_sources', list(app.event_sources))
+    scale_out_runner.subscribe_to_scaling_queue()
+    sqs = boto3.client('sqs')
+    url = sqs.create_queue(QueueName='GithubRunnerScaling')['QueueUrl']
+
+    def receive():
+        messages = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10).get('Messages', [])
+        for message in messages:
+            sqs.delete_message(QueueUrl=url, ReceiptHandle=message['ReceiptHandle'])
+        return [message['Body'] for message in messages]
+
+    return receive
+
+
+def test_schedules_only_added_when_enabled():
+    schedules = [source.name for source in app.event_sources if isinstance(source, ScheduledEventConfig)]
+    assert schedules == []
+    for name in ('predictive_scale', 'size_warm_pools', 'scale_in_idle', 'reconcile_queue'):
+        assert name not in app.handler_map
+
+
+def test_scaling_queue_only_subscribed_when_async():
+    assert 'process_scaling_intents' not in app.handler_map
+    assert not [source for source in app.event_sources if isinstance(source, SQSEventConfig)]
+
+
+def desired_capacity():
+    group = boto3.client('autoscaling').describe_auto_scaling_groups()['AutoScalingGroups'][0]
+    return group['DesiredCapacity']
+
+
+def test_async_scaling_acks_then_scales_once_per_batch(
+    scaling_queue, client, webhook, check_run_event, monkeypatch
+):
+    responses = [webhook(check_run_event(), delivery=f'delivery-{n}') for n in range(3)]
+    responses.append(webhook(check_run_event(action='completed', status='completed', conclusion='success')))
+    assert [response.status_code for response in responses] == [202, 202, 202, 200]
+    assert desired_capacity() == 0
+
+    scaled = []
+    real_scale = scale_out_runner.scale_asg_if_needed
+    monkeypatch.setattr(
+        scale_out_runner, 'scale_asg_if_needed', lambda *a, **kw: scaled.append(a) or real_scale(*a, **kw)
+    )
+
+    bodies = scaling_queue()
+    assert len(bodies) == 3
+    # SQS delivers one of them twice
+    event = client.events.generate_sqs_event(bodies + bodies[:1], queue_name='GithubRunnerScaling')
+    client.lambda_.invoke('process_scaling_intents', event)
+
+    assert scale_out_runner.read_dynamodb_counter() == 3
+    assert desired_capacity() == 3
+    assert scaled == [(3,)]
+
+
+def test_async_scaling_retries_while_asg_busy(scaling_queue, client, webhook, check_run_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'SCALING_RETRY_DELAY', 0)
+    assert webhook(check_run_event()).status_code == 202
+
+    with monkeypatch.context() as m:
+        m.setattr(
+            scale_out_runner, 'scale_asg_if_needed', lambda *a, **kw: {'error': 'ScalingActivityInProgress'}
+        )
+        event = client.events.generate_sqs_event(scaling_queue(), queue_name='GithubRunnerScaling')
+        client.lambda_.invoke('process_scaling_intents', event)
+
+    assert desired_capacity() == 0
+    retry = scaling_queue()
+    assert [json.loads(body) for body in retry] == [{'retry': 1}]
+
+    client.lambda_.invoke(
+        'process_scaling_intents', client.events.generate_sqs_event(retry, queue_name='GithubRunnerScaling')
+    )
+    assert desired_capacity() == 1
+    assert scaling_queue() == []
+
+
+def test_async_scaling_redelivered_after_failure(
+    scaling_queue, client, webhook, check_run_event, monkeypatch
+):
+    assert webhook(check_run_event()).status_code == 202
+    event = client.events.generate_sqs_event(scaling_queue(), queue_name='GithubRunnerScaling')
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    with monkeypatch.context() as m:
+        m.setattr(scale_out_runner, 'scale_asg_if_needed', fail)
+        with pytest.raises(RuntimeError):
+            client.lambda_.invoke('process_scaling_intents', event)
+
+    # SQS delivers the batch again: the job is already counted, but still needs a runner
+    client.lambda_.invoke('process_scaling_intents', event)
+    assert scale_out_runner.read_dynamodb_counter() == 1
+    assert desired_capacity() == 1
+
+
+def test_scaling_batch_coalesced(aws, check_run_event, monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(scale_out_runner.metrics, 'stream', stream)
+
+    def intent(delivery, **kwargs):
+        return scale_out_runner.check_run_intent(check_run_event(**kwargs), delivery)
+
+    # Processed by an earlier batch
+    scale_out_runner.scale_for_intents([intent('d-0')])
+    scale_out_runner._recent_deliveries.clear()
+
+    batch = [intent(f'd-{n}') for n in range(5)]
+    batch += [
+        intent('d-1'),
+        intent('d-5', action='completed', status='completed', conclusion='cancelled'),
+        intent('d-6', action='completed', status='completed', conclusion='success'),
+    ]
+    with scale_out_runner.metrics.invocation():
+        result = scale_out_runner.scale_for_intents(batch)
+
+    assert result == {
+        'batch_size': 8,
+        'counted': 5,
+        'duplicates': 2,
+        'new_capcity': 4,
+        # 5 * 3 + 4 * 2 one at a time, against 2 transactions (the first finds d-0 already claimed), 1 read,
+        # 1 describe and 1 SetDesiredCapacity
+        'api_calls_saved': 18,
+    }
+    assert scale_out_runner.read_dynamodb_counter() == 4
+
+    emf = json.loads(stream.getvalue().splitlines()[-1])
+    assert emf['BatchSize'] == 8
+    assert emf['IntentsCounted'] == 5
+    assert emf['ApiCallsSaved'] == 18
+
+
+def test_fleet_state_replaces_describe(aws, webhook, check_run_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'FLEET_STATE', True)
+    described = []
+    real_describe = scale_out_runner._describe_groups
+    monkeypatch.setattr(
+        scale_out_runner, '_describe_groups', lambda groups: described.append(groups) or real_describe(groups)
+    )
+    dynamodb = boto3.client('dynamodb')
+    key = {'id': {'S': 'fleet#AshbRunnerASG'}}
+
+    # No fleet item yet, so the ASG is described and the item created from it
+    assert webhook(check_run_event()).json_body['new_capcity'] == 1
+    assert len(described) == 1
+    item = dynamodb.get_item(TableName='GithubRunnerQueue', Key=key)['Item']
+    assert (item['busy']['N'], item['desired']['N'], item['max_size']['N']) == ('0', '1', '5')
+
+    # A runner-supervisor says it has picked up the job -- which the ASG doesn't know about
+    dynamodb.update_item(
+        TableName='GithubRunnerQueue',
+        Key=key,
+        UpdateExpression='ADD busy :one, version :one',
+        ExpressionAttributeValues={':one': {'N': '1'}},
+    )
+    assert webhook(check_run_event()).json_body['new_capcity'] == 3
+    assert len(described) == 1
+
+    # Time to reconcile
+    monkeypatch.setattr(scale_out_runner, 'FLEET_RECONCILE_SECONDS', -1)
+    assert webhook(check_run_event()).json_body == {
+        'sender': 'ashb',
+        'use_self_hosted': True,
+        'idle_instances': True,
+    }
+    assert len(described) == 2
+    item = dynamodb.get_item(TableName='GithubRunnerQueue', Key=key)['Item']
+    assert (item['busy']['N'], item['desired']['N']) == ('0', '3')
+
+
+def test_scale_in_idle(aws, client, scheduled, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'SCALE_IN', True)
+    scheduled('scale_in_idle')
+    monkeypatch.setattr(scale_out_runner, 'SCALE_IN_WARM_BUFFER', 1)
+    asg = boto3.client('autoscaling')
+    asg.set_desired_capacity(AutoScalingGroupName='AshbRunnerASG', DesiredCapacity=5)
+    instances = asg.describe_auto_scaling_groups()['AutoScalingGroups'][0]['Instances']
+    asg.set_instance_protection(
+        AutoScalingGroupName='AshbRunnerASG',
+        InstanceIds=[instance['InstanceId'] for instance in instances[:2]],
+        ProtectedFromScaleIn=True,
+    )
+    scale_out_runner.increment_dynamodb_counter(1)
+
+    def run():
+        client.lambda_.invoke('scale_in_idle', client.events.generate_cw_event('Scheduled Event', '', {}, []))
+        return desired_capacity()
+
+    # 2 busy, 1 for the queued job, and the buffer of 1
+    assert run() == 4
+    # Nothing more to remove
+    assert run() == 4
+
+    # Busy instances are never removed
+    scale_out_runner.increment_dynamodb_counter(-1)
+    monkeypatch.setattr(scale_out_runner, 'SCALE_IN_WARM_BUFFER', 0)
+    assert run() == 2
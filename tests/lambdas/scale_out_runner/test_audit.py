@@ -0,0 +1,80 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+
+import app as scale_out_runner
+import boto3
+import pytest
+from app import app  # noqa
+from chalicelib import audit
+from chalicelib.scaling import decide
+
+
+@pytest.fixture(autouse=True)
+def no_requests(monkeypatch):
+    monkeypatch.setenv("GH_WEBHOOK_TOKEN", "abc")
+
+
+def keep_a_spare(num_queued_jobs, groups):
+    return decide(num_queued_jobs + 1, groups)
+
+
+def test_decisions_audited_and_replayed(aws, webhook, check_run_event, capsys):
+    webhook(check_run_event(), delivery='first')
+    webhook(check_run_event(), delivery='second')
+    boto3.client('autoscaling').update_auto_scaling_group(AutoScalingGroupName='AshbRunnerASG', MaxSize=2)
+    webhook(check_run_event(), delivery='third')
+
+    lines = capsys.readouterr().out.splitlines()
+    # As exported from CloudWatch Logs, with a timestamp in front of each message
+    records = list(audit.read_log(f'2021-04-01T12:00:00.000Z\t{line}' for line in lines))
+    assert [record['deliveries'] for record in records] == [['first'], ['second'], ['third']]
+    assert [record['queued'] for record in records] == [1, 2, 3]
+    assert records[0]['groups'] == [['AshbRunnerASG', None, 0, 5, 0]]
+    assert records[0]['changes'] == [[0, 1]]
+    assert records[0]['result'] == {'new_capcity': 1}
+    assert 'autoscaling.DescribeAutoScalingGroups' in records[0]['timings']
+    assert records[2]['result'] == {'capacity_at_max': True}
+
+    report = audit.replay(records, keep_a_spare)
+    assert report['records'] == 3
+    assert report['not_as_recorded'] == 0
+    assert report['changed'] == 3
+    assert report['baseline'] == {'scale_outs': 2, 'instances_added': 2, 'unplaced': 1}
+    assert report['alternative'] == {'scale_outs': 2, 'instances_added': 4, 'unplaced': 2}
+    assert report['differences'][0]['baseline'] == [[0, 1]]
+    assert report['differences'][0]['alternative'] == [[0, 2]]
+
+
+def test_decisions_audited_to_table(aws, monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(scale_out_runner, 'AUDIT_LOG', False)
+    monkeypatch.setattr(scale_out_runner, 'AUDIT_TABLE', scale_out_runner.TABLE_NAME)
+
+    assert scale_out_runner.scale_asg_if_needed(2) == {'new_capcity': 2}
+    assert scale_out_runner.scale_asg_if_needed(1) == {'idle_instances': True}
+    assert capsys.readouterr().out == ''
+
+    records = list(audit.read_table(boto3.client('dynamodb'), scale_out_runner.TABLE_NAME))
+    assert sorted(record['queued'] for record in records) == [1, 2]
+
+    log = tmp_path / 'decisions.log'
+    log.write_text(''.join(audit.format_record(record) + '\n' for record in records))
+    audit.main([str(log), '--decide', 'chalicelib.scaling:decide'])
+    report = json.loads(capsys.readouterr().out)
+    assert report['records'] == 2
+    assert report['changed'] == 0
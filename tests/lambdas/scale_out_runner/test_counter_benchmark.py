@@ -0,0 +1,100 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Contention benchmark for the sharded queue counter
+
+moto doesn't model DynamoDB's per-partition write throughput, so each UpdateItem has to go through a
+per-item "partition" that admits one write at a time, each taking ``WRITE_COST`` seconds. That makes a
+single hot counter item serialise its writers the way it does in production. Run with ``pytest -s`` to
+see the report.
+"""
+import collections
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as scale_out_runner
+import pytest
+
+WRITE_COST = 0.01
+WORKERS = 16
+OPS = 120
+
+
+class HotPartition:
+    """Only let one write at a time at each item, each taking at least ``WRITE_COST`` seconds"""
+
+    def __init__(self, client):
+        self.locks = collections.defaultdict(threading.Lock)
+        self.held = threading.local()
+        client.meta.events.register('before-parameter-build.dynamodb.UpdateItem', self.acquire)
+        client.meta.events.register('after-call.dynamodb.UpdateItem', self.release)
+
+    def acquire(self, params, **kwargs):
+        self.held.lock = self.locks[params['Key']['id']['S']]
+        self.held.lock.acquire()
+        time.sleep(WRITE_COST)
+
+    def release(self, **kwargs):
+        self.held.lock.release()
+
+
+def run(shards: int) -> dict:
+    dynamodb = scale_out_runner.aws_client('dynamodb')
+    counts = collections.Counter()
+    dynamodb.meta.events.register('before-call.dynamodb', lambda model, **kw: counts.update([model.name]))
+    HotPartition(dynamodb)
+
+    scale_out_runner.QUEUE_SHARDS = shards
+
+    def op(n):
+        start = time.perf_counter()
+        # Two increments for every decrement, like a queue that is growing during a burst
+        delta = -1 if n % 3 == 2 else 1
+        scale_out_runner.increment_dynamodb_counter(delta, shard_hint=f'delivery-{n}')
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(WORKERS) as pool:
+        latencies = sorted(pool.map(op, range(OPS)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'shards': shards,
+        'elapsed': elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[int(len(latencies) * 0.95)],
+        'mean': statistics.mean(latencies),
+        'calls': dict(counts),
+        'total': scale_out_runner.read_dynamodb_counter(),
+    }
+
+
+@pytest.mark.parametrize('shards', [1, 8])
+def test_counter_contention(aws, monkeypatch, shards):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SHARDS', shards)
+
+    result = run(shards)
+
+    print(
+        "\nshards={shards} elapsed={elapsed:.3f}s p50={p50:.4f}s p95={p95:.4f}s mean={mean:.4f}s "
+        "calls={calls}".format(**result)
+    )
+    # A decrement that races ahead of its increments is dropped at zero, so the total can only be higher
+    assert result['total'] >= OPS - 2 * (OPS // 3)
+    assert min(scale_out_runner._read_counter_shards(scale_out_runner.counter_shard_keys()).values()) >= 0
@@ -0,0 +1,115 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import random
+
+import app as scale_out_runner
+import boto3
+import pytest
+from app import app  # noqa
+from chalicelib.forecast import (
+    WEEK_MINUTES,
+    DynamoDBArrivalHistory,
+    MemoryArrivalHistory,
+    backtest,
+    prescale_target,
+)
+
+# A Monday, 00:00 UTC
+MONDAY = 1700438400
+WEEK = WEEK_MINUTES * 60
+
+
+@pytest.fixture(params=['memory', 'dynamodb'])
+def history(request):
+    if request.param == 'memory':
+        return MemoryArrivalHistory(bucket_minutes=15)
+    request.getfixturevalue('aws')
+    return DynamoDBArrivalHistory(boto3.client('dynamodb'), scale_out_runner.TABLE_NAME, 'arrivals:test', 15)
+
+
+def test_expected_arrivals_from_last_week(history):
+    nine_am = MONDAY + 9 * 3600
+    for n in range(5):
+        history.record(nine_am + n * 60)
+    history.record(nine_am + 20 * 60, count=3)
+
+    # Nothing recorded yet for this week
+    assert history.expected_arrivals(nine_am, 30) == 0
+    assert history.expected_arrivals(nine_am + WEEK - 600, 30) == 8
+    assert history.expected_arrivals(nine_am + WEEK + 15 * 60, 10) == 3
+    assert history.expected_arrivals(nine_am + WEEK + 3600, 30) == 0
+
+    # The same bucket this week replaces last week's count
+    history.record(nine_am + WEEK)
+    assert history.expected_arrivals(nine_am + 2 * WEEK, 5) == 1
+    # And more than a week old isn't used
+    assert history.expected_arrivals(nine_am + 3 * WEEK + 15 * 60, 5) == 0
+
+
+def test_prescale_target_capped():
+    assert prescale_target(0, 0.5, 10) == 0
+    assert prescale_target(5, 0.5, 10) == 3
+    assert prescale_target(100, 0.5, 10) == 10
+
+
+def test_backtest_prescaling_cuts_queue_wait():
+    rnd = random.Random(1)
+    arrivals = []
+    # Two weeks of a 30 job burst at 09:00 every weekday
+    for day in range(14):
+        if day % 7 < 5:
+            start = MONDAY + day * 86400 + 9 * 3600
+            arrivals += sorted(start + rnd.uniform(0, 600) for _ in range(30))
+
+    reactive = backtest(arrivals, predictive=False, max_instances=30, factor=1)
+    predictive = backtest(arrivals, predictive=True, max_instances=30, factor=1)
+
+    assert reactive['jobs'] == predictive['jobs'] == len(arrivals)
+    assert predictive['queue_wait_minutes'] < reactive['queue_wait_minutes']
+    # Those instances were waiting around for the burst instead
+    assert predictive['idle_instance_minutes'] > reactive['idle_instance_minutes']
+
+
+@pytest.mark.parametrize(
+    "arrivals, options",
+    [
+        # Every job is still waiting for an instance to boot when the last one would have finished
+        ([0.0] * 20, {'boot_minutes': 5, 'job_minutes': 1}),
+        ([0, 60], {'boot_minutes': 50}),
+    ],
+)
+def test_backtest_serves_whole_queue(arrivals, options):
+    result = backtest(arrivals, predictive=False, **options)
+    assert result['jobs'] == len(arrivals)
+    assert result['unserved'] == 0
+    assert result['p95_wait'] >= options['boot_minutes'] - 1
+
+
+def test_predictive_scale_schedule(aws, client, scheduled, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'PREDICTIVE_SCALING', True)
+    scheduled('predictive_scale')
+    monkeypatch.setattr(scale_out_runner.time, 'time', lambda: MONDAY + WEEK + 9 * 3600)
+
+    history = scale_out_runner.arrival_history(scale_out_runner.DEFAULT_ROUTE)
+    for n in range(6):
+        history.record(MONDAY + 9 * 3600 + n * 60)
+
+    client.lambda_.invoke('predictive_scale', client.events.generate_cw_event('Scheduled Event', '', {}, []))
+
+    group = boto3.client('autoscaling').describe_auto_scaling_groups()['AutoScalingGroups'][0]
+    assert group['DesiredCapacity'] == 3
@@ -0,0 +1,141 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import fnmatch
+import json
+import timeit
+
+import app as scale_out_runner
+import pytest
+from app import app  # noqa
+from chalicelib.policy import Decision, Policy
+
+CONFIG = {
+    'apache/airflow': {
+        'branches': ['main', 'v2-*-test', 'v?-stable'],
+        'senders': ['dependabot'],
+        'labels': ['airflow-runner'],
+    },
+    'apache/airflow-site': {'branches': ['main'], 'commiters': False},
+    # The original format
+    'apache/airflow-ci-infra': ['main', 'master'],
+    'apache/*-providers': {'branches': ['release-*']},
+    'apache/*': {'branches': ['main']},
+}
+
+
+@pytest.fixture(autouse=True)
+def no_requests(monkeypatch):
+    monkeypatch.setenv("GH_WEBHOOK_TOKEN", "abc")
+
+
+@pytest.fixture
+def policy():
+    return Policy(CONFIG, default_labels=['vm-runner'])
+
+
+@pytest.mark.parametrize(
+    'repo, branch, sender, expected',
+    [
+        ('apache/airflow', 'main', 'someone', Decision(True, True, 'branch')),
+        ('apache/airflow', 'v2-3-test', 'someone', Decision(True, True, 'branch')),
+        ('apache/airflow', 'v2-3-test-extra', 'someone', Decision(True, False, 'no rule matched')),
+        ('apache/airflow', 'v2-stable', 'someone', Decision(True, True, 'branch')),
+        ('apache/airflow', 'v22-stable', 'someone', Decision(True, False, 'no rule matched')),
+        ('apache/airflow', 'my-feature', 'dependabot', Decision(True, True, 'sender')),
+        ('apache/airflow', 'my-feature', 'ashb', Decision(True, True, 'commiter')),
+        ('apache/airflow', None, 'someone', Decision(True, False, 'no rule matched')),
+        ('apache/airflow-site', 'my-feature', 'ashb', Decision(True, False, 'no rule matched')),
+        ('apache/airflow-ci-infra', 'master', 'someone', Decision(True, True, 'branch')),
+        # Globs apply in the order they were configured
+        ('apache/google-providers', 'release-1', 'someone', Decision(True, True, 'branch')),
+        ('apache/google-providers', 'main', 'someone', Decision(True, False, 'no rule matched')),
+        ('apache/beam', 'main', 'someone', Decision(True, True, 'branch')),
+        ('someone/airflow', 'main', 'ashb', Decision(False, False, 'other repo')),
+    ],
+)
+def test_decide(policy, repo, branch, sender, expected):
+    assert policy.decide(repo, branch, sender, lambda: {'ashb'}) == expected
+
+
+def test_commiters_only_loaded_when_needed(policy):
+    def commiters():
+        raise AssertionError("shouldn't be needed")
+
+    assert policy.decide('apache/airflow', 'main', 'someone', commiters).use_self_hosted
+    assert not policy.decide('apache/airflow', 'my-feature', 'ashb').use_self_hosted
+
+
+def test_labels(policy):
+    assert policy.repo('apache/airflow').wants_labels(['self-hosted', 'airflow-runner'])
+    assert not policy.repo('apache/airflow').wants_labels(['self-hosted', 'vm-runner'])
+    assert policy.repo('apache/beam').wants_labels(['vm-runner'])
+    assert policy.repos() == ['apache/airflow', 'apache/airflow-site', 'apache/airflow-ci-infra']
+
+
+def test_branch_glob_routes_webhook(aws, webhook, check_run_event, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'POLICY', Policy(CONFIG, scale_out_runner.RUNNER_LABELS))
+    response = webhook(check_run_event(sender='someone', branch='v2-3-test'))
+    assert response.json_body['use_self_hosted'] is True
+    assert response.json_body['new_capcity'] == 1
+
+    response = webhook(check_run_event(sender='someone', branch='v2-3-stable'))
+    assert response.json_body == {'sender': 'someone', 'use_self_hosted': False}
+
+
+def test_policy_microbenchmark():
+    # Thousands of rules: 2000 repos by name, each with a few literal and glob branches, and 200 repo globs
+    config = {
+        f'org{n}/repo{n}': {'branches': ['main', f'release-{n}', f'v{n}-*-test', f'hotfix-{n}-*']}
+        for n in range(2000)
+    }
+    config.update({f'glob{n}-*/*': {'branches': ['main', f'v{n}-*']} for n in range(200)})
+    policy = Policy(config, default_labels=['vm-runner'])
+    events = [
+        ('org1500/repo1500', 'v1500-3-test', 'someone'),
+        ('org7/repo7', 'my-feature', 'someone'),
+        ('glob150-x/project', 'v150-1', 'someone'),
+        ('unknown/repo', 'main', 'someone'),
+    ]
+
+    def naive(repo, branch, sender):
+        # What matching the rules one by one would cost
+        for repo_pattern, rules in config.items():
+            if fnmatch.fnmatchcase(repo, repo_pattern):
+                return any(fnmatch.fnmatchcase(branch, pattern) for pattern in rules['branches'])
+        return None
+
+    for repo, branch, sender in events:
+        decision = policy.decide(repo, branch, sender)
+        assert decision.use_self_hosted == bool(naive(repo, branch, sender))
+        assert decision.configured == (naive(repo, branch, sender) is not None)
+
+    number = 2000
+    compiled = min(
+        timeit.repeat(lambda: [policy.decide(*event) for event in events], number=number, repeat=3)
+    )
+    baseline = min(timeit.repeat(lambda: [naive(*event) for event in events], number=10, repeat=3))
+    print(
+        "\n"
+        + json.dumps(
+            {
+                'rules': len(config),
+                'compiled_us_per_event': round(compiled / number / len(events) * 1e6, 2),
+                'naive_us_per_event': round(baseline / 10 / len(events) * 1e6, 2),
+            }
+        )
+    )
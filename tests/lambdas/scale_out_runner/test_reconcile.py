@@ -0,0 +1,190 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import io
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app as scale_out_runner
+import pytest
+from app import app  # noqa
+
+REPO = '/repos/apache/airflow/actions/runs'
+
+
+class StubGitHub(BaseHTTPRequestHandler):
+    """Serves runs (one per page, to exercise the pagination) and their jobs"""
+
+    runs = {}
+    jobs = {}
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if self.headers['Authorization'] != 'Bearer gh-token':
+            return self.send_error(401)
+
+        if url.path == REPO:
+            runs = self.runs.get(query['status'], [])
+            page = int(query.get('page', 1))
+            body = {'workflow_runs': [{'id': run} for run in runs[page - 1 : page]]}
+            link = None
+            if page < len(runs):
+                next_page = f'{REPO}?status={query["status"]}&page={page + 1}'
+                link = f'<http://{self.headers["Host"]}{next_page}>; rel="next"'
+        elif url.path.startswith(REPO):
+            run_id = int(url.path.split('/')[-2])
+            body = {'jobs': self.jobs[run_id]}
+            link = None
+        else:
+            return self.send_error(404)
+
+        raw = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        if link:
+            self.send_header('Link', link)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github(aws, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_RECONCILIATION', True)
+    monkeypatch.setattr(scale_out_runner, 'GH_API_TOKEN', None)
+    monkeypatch.setenv('GH_API_TOKEN', 'gh-token')
+    monkeypatch.setattr(StubGitHub, 'runs', {})
+    monkeypatch.setattr(StubGitHub, 'jobs', {})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGitHub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(scale_out_runner, 'GITHUB_API_URL', f'http://127.0.0.1:{server.server_port}')
+    yield StubGitHub
+    server.shutdown()
+    server.server_close()
+
+
+def job(status='queued', labels=('self-hosted', 'airflow-runner')):
+    return {'status': status, 'labels': list(labels)}
+
+
+@pytest.fixture
+def reconcile(client, scheduled, monkeypatch):
+    scheduled('reconcile_queue')
+    stream = io.StringIO()
+    monkeypatch.setattr(scale_out_runner.metrics, 'stream', stream)
+
+    def run():
+        client.lambda_.invoke(
+            'reconcile_queue', client.events.generate_cw_event('Scheduled Event', '', {}, [])
+        )
+        lines = stream.getvalue().splitlines()
+        # No metrics when it didn't reconcile at all
+        return json.loads(lines[-1]) if lines else None
+
+    return run
+
+
+def test_queued_jobs_listed_across_pages(github):
+    github.runs = {'queued': [1, 2], 'in_progress': [3, 2]}
+    github.jobs = {
+        1: [job()],
+        2: [job(), job(labels=['ubuntu-latest'])],
+        3: [job(status='in_progress'), job()],
+    }
+    api = scale_out_runner.GitHubAPI('gh-token', scale_out_runner.GITHUB_API_URL)
+    assert len(api.queued_jobs('apache/airflow')) == 4
+
+
+def test_only_persistent_drift_is_corrected(github, reconcile):
+    github.runs = {'queued': [1, 2]}
+    github.jobs = {1: [job()], 2: [job(), job(labels=['ubuntu-latest'])]}
+    scale_out_runner.increment_dynamodb_counter(5)
+
+    # Seen once: it might be webhooks still on their way
+    assert reconcile()['QueueCorrection'] == 0
+    assert scale_out_runner.read_dynamodb_counter() == 5
+
+    emf = reconcile()
+    assert emf['QueueCorrection'] == 3
+    assert emf['corrections'] == {'queued_jobs': -3}
+    assert scale_out_runner.read_dynamodb_counter() == 2
+
+    # A webhook catches the counter up before the next run, so there is nothing to correct
+    github.jobs[2].append(job())
+    assert reconcile()['QueueCorrection'] == 0
+    scale_out_runner.increment_dynamodb_counter(1)
+    assert reconcile()['QueueCorrection'] == 0
+    assert scale_out_runner.read_dynamodb_counter() == 3
+
+
+def test_sharded_counter_corrected(github, reconcile, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SHARDS', 4)
+    for delivery in range(8):
+        scale_out_runner.increment_dynamodb_counter(1, shard_hint=str(delivery))
+    github.runs = {'queued': [1]}
+    github.jobs = {1: [job()]}
+
+    reconcile()
+    assert reconcile()['corrections'] == {'queued_jobs': -7}
+    assert scale_out_runner.read_dynamodb_counter() == 1
+
+
+def test_ledger_counter_not_reconciled(github, reconcile, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SOURCE', 'workflow_job')
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SHARDS', 4)
+    labels = ['self-hosted', 'airflow-runner']
+    for job_id in range(3):
+        scale_out_runner.record_job_transition(job_id, 'queued', labels)
+    github.runs = {'queued': [1]}
+    github.jobs = {1: [job()]}
+
+    assert reconcile() is None
+    assert reconcile() is None
+    assert scale_out_runner.read_dynamodb_counter() == 3
+
+    for job_id in range(3):
+        assert scale_out_runner.record_job_transition(job_id, 'in_progress', labels) == -1
+    shards = scale_out_runner._read_counter_shards(scale_out_runner.counter_shard_keys('queued_jobs'))
+    assert all(queued == 0 for queued in shards.values())
+
+
+def test_ledger_decrement_never_takes_shard_below_zero(aws, monkeypatch):
+    monkeypatch.setattr(scale_out_runner, 'QUEUE_SHARDS', 4)
+    labels = ['self-hosted', 'airflow-runner']
+    for job_id in range(3):
+        scale_out_runner.record_job_transition(job_id, 'queued', labels)
+
+    # Everything moved on to the first shard, as an older reconcile_counter would have done
+    keys = scale_out_runner.counter_shard_keys('queued_jobs')
+    dynamodb = scale_out_runner.aws_client('dynamodb')
+    for n, key in enumerate(keys):
+        dynamodb.put_item(
+            TableName=scale_out_runner.TABLE_NAME,
+            Item={'id': {'S': key}, 'queued': {'N': '3' if n == 0 else '0'}},
+        )
+
+    for job_id in range(3):
+        assert scale_out_runner.record_job_transition(job_id, 'in_progress', labels) == -1
+    assert scale_out_runner._read_counter_shards(keys) == {key: 0 for key in keys}
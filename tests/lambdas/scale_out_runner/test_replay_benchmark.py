@@ -0,0 +1,276 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+"""
+Replay a burst of signed check_run deliveries through the handler, with AWS provided by moto
+
+Every AWS API call the handler makes is recorded, so the calls-per-event budgets below are exact and
+catch regressions in CI; the latency numbers are printed for comparison (run with ``pytest -s``). The
+size of the burst can be changed with ``REPLAY_EVENTS``.
+"""
+import collections
+import copy
+import hmac
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import timeit
+import types
+import uuid
+from typing import Dict, List, Set, Tuple
+
+import app as scale_out_runner
+import boto3
+import pytest
+from app import app  # noqa
+
+REPLAY_EVENTS = int(os.getenv('REPLAY_EVENTS', '500'))
+
+with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'check_run.json')) as fh:
+    CHECK_RUN = json.load(fh)
+
+
+@pytest.fixture(autouse=True)
+def no_requests(monkeypatch):
+    monkeypatch.setenv("GH_WEBHOOK_TOKEN", "abc")
+
+
+def build_corpus(n: int, seed: int = 0) -> Tuple[List[dict], dict]:
+    """
+    Build ``n`` check_run deliveries, in roughly the mix a big PR push produces
+
+    Returns the deliveries, and the queue counter and desired capacity they should leave behind.
+    """
+    rnd = random.Random(seed)
+    corpus = []
+    queued = peak = 0
+    for n in range(n):
+        body = copy.deepcopy(CHECK_RUN)
+        check_run = body['check_run']
+        check_run['id'] += n
+        check_run['check_suite']['head_branch'] = rnd.choice(['main', 'my-feature', 'fix-the-thing'])
+        body['sender']['login'] = rnd.choice(['ashb', 'potiuk', 'some-contributor', 'another-contributor'])
+        self_hosted = body['sender']['login'] in ('ashb', 'potiuk') or check_run['check_suite'][
+            'head_branch'
+        ] in ('main',)
+
+        kind = rnd.choices(
+            ['queued', 'skipped', 'in_progress', 'success', 'cancelled'], [40, 10, 20, 20, 10]
+        )[0]
+        if kind == 'queued':
+            if self_hosted:
+                queued += 1
+                peak = max(peak, queued)
+        elif kind == 'skipped':
+            check_run.update(status='completed', conclusion='skipped')
+        elif kind == 'in_progress':
+            body['action'] = 'in_progress'
+            check_run['status'] = 'in_progress'
+        else:
+            body['action'] = 'completed'
+            check_run.update(status='completed', conclusion=kind)
+            if kind == 'cancelled' and self_hosted:
+                queued = max(0, queued - 1)
+
+        raw = json.dumps(body).encode()
+        corpus.append(
+            {
+                'Content-Type': 'application/json',
+                'X-GitHub-Event': 'check_run',
+                'X-GitHub-Delivery': str(uuid.UUID(int=rnd.getrandbits(128))),
+                'X-Hub-Signature-256': 'sha256=' + hmac.new(b'abc', raw, digestmod='SHA256').hexdigest(),
+                'body': raw,
+            }
+        )
+    return corpus, {'queued': queued, 'desired': peak}
+
+
+class CallRecorder:
+    """
+    Count (and optionally slow down) every AWS API call made through newly created clients
+
+    With a ``delay``, each call also counts which other services it was in flight at the same time as,
+    keyed by ``((service, operation), other_service)``.
+    """
+
+    def __init__(self, monkeypatch, delay: float = 0):
+        self.calls = collections.Counter()
+        self.delay = delay
+        self.in_flight: Dict[object, Tuple[Tuple[str, str], Set[str]]] = {}
+        self.overlaps: collections.Counter = collections.Counter()
+        self.lock = threading.Lock()
+        real_client = scale_out_runner.boto3.client
+
+        def client(service_name, **kwargs):
+            client = real_client(service_name, **kwargs)
+            client.meta.events.register('before-call', self.before_call)
+            return client
+
+        monkeypatch.setattr(scale_out_runner.boto3, 'client', client)
+
+    def before_call(self, model, **kwargs):
+        call = (model.service_model.service_name, model.name)
+        self.calls[call] += 1
+        if self.delay:
+            token = object()
+            with self.lock:
+                services = set()
+                for other, other_services in self.in_flight.values():
+                    other_services.add(call[0])
+                    services.add(other[0])
+                self.in_flight[token] = (call, services)
+            time.sleep(self.delay)
+            with self.lock:
+                _, services = self.in_flight.pop(token)
+                for service in services:
+                    self.overlaps[call, service] += 1
+
+    def by_service(self) -> dict:
+        services = collections.Counter()
+        for (service, _), count in self.calls.items():
+            services[service] += count
+        return dict(services)
+
+
+def replay(client, corpus: List[dict]) -> List[float]:
+    latencies = []
+    for delivery in corpus:
+        headers = dict(delivery)
+        body = headers.pop('body')
+        start = time.perf_counter()
+        response = client.http.post('/', headers=headers, body=body)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.body
+    return latencies
+
+
+def percentiles(latencies: List[float]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        f'p{p}': round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+        for p in (50, 95, 99)
+    }
+
+
+@pytest.fixture
+def burst_asg(aws):
+    boto3.client('autoscaling').update_auto_scaling_group(AutoScalingGroupName='AshbRunnerASG', MaxSize=1000)
+    boto3.client('ssm').put_parameter(
+        Name='/runners/apache/airflow/configOverlay',
+        Type='String',
+        Value=json.dumps({'pullRequestSecurity': {'allowedAuthors': ['ashb', 'potiuk']}}),
+        Overwrite=True,
+    )
+
+
+def test_replay_burst(burst_asg, client, monkeypatch):
+    recorder = CallRecorder(monkeypatch)
+    corpus, expected = build_corpus(REPLAY_EVENTS)
+
+    latencies = replay(client, corpus)
+
+    queue = scale_out_runner.read_dynamodb_counter()
+    group = boto3.client('autoscaling').describe_auto_scaling_groups()['AutoScalingGroups'][0]
+    per_event = {service: round(count / len(corpus), 3) for service, count in recorder.by_service().items()}
+    print(
+        f"\nreplayed={len(corpus)} latency_ms={percentiles(latencies)} "
+        f"mean_ms={statistics.mean(latencies) * 1000:.2f} calls_per_event={per_event} "
+        f"queue={queue} desired_capacity={group['DesiredCapacity']}"
+    )
+
+    assert queue == expected['queued']
+    assert group['DesiredCapacity'] == expected['desired']
+
+    # The AWS call budget: one SSM lookup per container, and at most 4 DynamoDB calls (claim delivery,
+    # update counter, record payload + an occasional read) and 2 AutoScaling calls per event.
+    assert recorder.by_service()['ssm'] == 1
+    assert per_event['dynamodb'] <= 4
+    assert per_event['autoscaling'] <= 2
+    assert 'kms' not in per_event
+
+
+def test_replay_with_call_latency(burst_asg, client, monkeypatch):
+    # With every AWS call taking DELAY, making the independent ones at the same time shows up directly in
+    # the end-to-end latency
+    delay = 0.02
+    recorder = CallRecorder(monkeypatch, delay=delay)
+    corpus, expected = build_corpus(40, seed=1)
+    dynamodb = boto3.client('dynamodb')
+    autoscaling = boto3.client('autoscaling')
+
+    results = {}
+    overlaps = {}
+    describe_during_dynamodb = (('autoscaling', 'DescribeAutoScalingGroups'), 'dynamodb')
+    for concurrency in (0, 4):
+        recorder.overlaps.clear()
+        monkeypatch.setattr(scale_out_runner, 'AWS_CALL_CONCURRENCY', concurrency)
+        # Start from the same (cold) state each time
+        scale_out_runner._commiters.invalidate()
+        scale_out_runner._recent_deliveries.clear()
+        for key in scale_out_runner.counter_shard_keys():
+            dynamodb.delete_item(TableName='GithubRunnerQueue', Key={'id': {'S': key}})
+        autoscaling.set_desired_capacity(AutoScalingGroupName='AshbRunnerASG', DesiredCapacity=0)
+        replayed = [dict(delivery, **{'X-GitHub-Delivery': str(uuid.uuid4())}) for delivery in corpus]
+
+        results[concurrency] = sum(replay(client, replayed))
+        overlaps[concurrency] = recorder.overlaps[describe_during_dynamodb]
+
+        assert scale_out_runner.read_dynamodb_counter() == expected['queued']
+        group = autoscaling.describe_auto_scaling_groups()['AutoScalingGroups'][0]
+        assert group['DesiredCapacity'] == expected['desired']
+
+    print(
+        f"\nreplayed={len(corpus)} call_delay_ms={delay * 1000:.0f} "
+        f"serial_s={results[0]:.2f} concurrent_s={results[4]:.2f} overlapped={overlaps[4]}"
+    )
+    # Each queued event saves (at least) one DELAY: the ASG describe overlaps claiming the delivery and
+    # updating the counter. Check that they did overlap, rather than the wall clock time, which depends on
+    # how busy the machine is
+    queued = 0
+    for delivery in corpus:
+        body = json.loads(delivery['body'])
+        queued += (
+            body['action'] == 'created'
+            and body['check_run']['status'] == 'queued'
+            and (
+                body['sender']['login'] in ('ashb', 'potiuk')
+                or body['check_run']['check_suite']['head_branch'] == 'main'
+            )
+        )
+    assert overlaps[0] == 0
+    assert overlaps[4] >= queued
+
+
+def test_validate_gh_sig_microbenchmark():
+    # A large payload: a check_suite with a lot of pull requests attached
+    body = copy.deepcopy(CHECK_RUN)
+    body['check_run']['pull_requests'] = [copy.deepcopy(body['repository']) for _ in range(100)]
+    raw = json.dumps(body).encode()
+    request = types.SimpleNamespace(
+        headers={'X-Hub-Signature-256': 'sha256=' + hmac.new(b'abc', raw, digestmod='SHA256').hexdigest()},
+        raw_body=raw,
+    )
+
+    number = 200
+    sig = min(timeit.repeat(lambda: scale_out_runner.validate_gh_sig(request), number=number, repeat=3))
+    parse = min(timeit.repeat(lambda: json.loads(raw), number=number, repeat=3))
+    print(
+        f"\npayload={len(raw) / 1024:.0f}KiB validate_gh_sig={sig / number * 1e6:.1f}us "
+        f"json.loads={parse / number * 1e6:.1f}us"
+    )
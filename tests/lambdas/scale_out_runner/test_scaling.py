@@ -0,0 +1,30 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from chalicelib.scaling import Decision, GroupState, decide
+
+
+def test_decide_fills_groups_in_priority_order():
+    groups = [
+        GroupState('Primary', None, desired=2, max_size=3, busy=2),
+        GroupState('Broken', None, desired=0, max_size=5, busy=0, available=False),
+        GroupState('Overflow', None, desired=1, max_size=4, busy=0),
+    ]
+    # One idle instance in the overflow group already
+    assert decide(1, groups) == Decision(idle=1, needed=0, changes=(), unplaced=0)
+    assert decide(3, groups) == Decision(idle=1, needed=2, changes=((0, 3), (2, 2)), unplaced=0)
+    assert decide(9, groups) == Decision(idle=1, needed=8, changes=((0, 3), (2, 4)), unplaced=4)